@@ -0,0 +1,773 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Exporters for the P1 meter plugin: every reading to InfluxDB as line protocol (HTTP or
+#   UDP) and to an MQTT broker, straight from the plugin instead of a script that scrapes
+#   the Indigo states. Same license as plugin.py
+#
+#   Both are sinks like the SQLite writer: add() never blocks, a thread of their own sends
+#   batches over one persistent connection and batches that cannot be delivered wait in a
+#   spool folder until the target is back. tools/exportserver.py is a local stand-in for
+#   InfluxDB and a broker to try them against
+#
+#   JsonEndpoint works the other way around: clients poll it for the latest reading
+#
+##########################################################################################
+
+import os
+import json
+import time
+import zlib
+import socket
+import struct
+import threading
+
+try:
+   import Queue
+except ImportError:
+   import queue as Queue
+
+try:
+   import httplib
+   from urlparse import urlsplit, parse_qs
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+   from SocketServer import ThreadingMixIn
+except ImportError:
+   import http.client as httplib
+   from urllib.parse import urlsplit, parse_qs
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+   from socketserver import ThreadingMixIn
+
+from smartmeter import Reading
+
+
+
+class ExportError(Exception):
+   # retry is False when the target refused the data itself, sending it again will not help
+   def __init__(self, message, retry=True):
+      Exception.__init__(self, message)
+      self.retry = retry
+
+
+
+class Spool(object):
+   ##########################################################################################
+   #
+   #   Batches that could not be delivered, one compressed file each, sent again oldest
+   #   first. Holds at most max_bytes; beyond that the oldest batches are deleted
+   #
+   ##########################################################################################
+
+   def __init__(self, folder, max_bytes):
+      self.folder = folder
+      self.max_bytes = max_bytes
+      self.sequence = 0
+      self.dropped = 0                   # Batches deleted to stay within max_bytes
+      if not os.path.isdir(folder):
+         os.makedirs(folder)
+      self.files = sorted(name for name in os.listdir(folder) if name.endswith(".batch"))
+      self.size = sum(os.path.getsize(os.path.join(folder, name)) for name in self.files)
+
+
+
+   def __len__(self):
+      return len(self.files)
+
+
+
+   def put(self, payload):
+      data = zlib.compress(payload)
+      self.sequence = self.sequence % 999999 + 1
+      name = "{:013d}-{:06d}.batch".format(int(time.time() * 1000), self.sequence)
+      path = os.path.join(self.folder, name)
+      with open(path + ".new", "wb") as f:
+         f.write(data)
+      os.rename(path + ".new", path)
+      self.files.append(name)
+      self.size += len(data)
+      while self.size > self.max_bytes and len(self.files) > 1:
+         self.remove(self.files[0])
+         self.dropped += 1
+
+
+
+   def oldest(self):
+      # (name, payload) of the oldest batch, None when the spool is empty
+      while self.files:
+         name = self.files[0]
+         try:
+            with open(os.path.join(self.folder, name), "rb") as f:
+               return name, zlib.decompress(f.read())
+         except (IOError, OSError, zlib.error):
+            # Unreadable, e.g. cut short by a full disk
+            self.remove(name)
+            self.dropped += 1
+      return None
+
+
+
+   def remove(self, name):
+      path = os.path.join(self.folder, name)
+      try:
+         self.size -= os.path.getsize(path)
+         os.remove(path)
+      except OSError:
+         pass
+      self.files.remove(name)
+
+
+
+class ExportSink(threading.Thread):
+   ##########################################################################################
+   #
+   #   Base of the exporters. add() only puts the reading on a bounded queue and never blocks
+   #   the reader; when the queue is full the reading is dropped and counted. Every reading
+   #   keeps the Indigo device id of its meter, so meters can be told apart. The thread
+   #   sends a batch every batch_rows readings or batch_seconds seconds with send(). A batch
+   #   that fails goes to the spool, and so does every batch after it until the spool is
+   #   empty again, which keeps them in order. The spool is tried again after min_retry
+   #   seconds, doubling up to max_retry while the target stays down
+   #
+   ##########################################################################################
+   kind          = "Export"              # Name in log messages
+   batch_rows    = 300                   # Readings per batch...
+   batch_seconds = 10                    # ...or seconds, whichever comes first
+   queue_size    = 10000                 # Readings waiting for the thread before dropping
+   spool_bytes   = 50 * 1024 * 1024      # Most the spool keeps on disk
+   min_retry     = 5                     # Seconds before sending to a failed target again
+   max_retry     = 300
+   drain_batches = 10                    # Spooled batches sent per round, so new readings keep flowing
+   tagged        = True                  # Readings of every meter, tagged with its device id
+
+   def __init__(self, folder, logger):
+      threading.Thread.__init__(self, name="P1 {} exporter".format(self.kind))
+      self.daemon = True
+      self.folder = folder
+      self.logger = logger
+      self.queue = Queue.Queue(self.queue_size)
+      self.stopping = threading.Event()
+      self.spool = None
+      self.failing = False               # Target not reachable, reported once until it is back
+      self.retry = self.min_retry
+      self.retryAt = 0                   # New batches go to the spool until then
+      self.dropped = 0
+      self.start()
+
+
+
+   def add(self, reading, wait=False, meter=None):
+      # wait is for backfilling, where readings come faster than any target can take them.
+      # meter is the device id of the meter the reading came from
+      try:
+         self.queue.put((meter, reading), wait)
+      except Queue.Full:
+         self.dropped += 1
+
+
+
+   def close(self):
+      self.stopping.set()
+      self.join(30)
+      if self.dropped:
+         self.logger.warning("{} exporter dropped {} readings because it could not keep up".format(self.kind, self.dropped))
+      if self.spool is not None and self.spool.dropped:
+         self.logger.warning("{} spool was full, {} of the oldest batches were deleted".format(self.kind, self.spool.dropped))
+
+
+
+   def run(self):
+      try:
+         self.spool = Spool(self.folder, self.spool_bytes)
+      except (IOError, OSError) as e:
+         self.logger.error("Cannot open {} spool in {}: {}".format(self.kind, self.folder, e))
+         return
+      if len(self.spool):
+         self.logger.info("{} batches for {} are waiting in {}".format(len(self.spool), self.kind, self.folder))
+
+      batch = []
+      deadline = 0
+      while True:
+         stopping = self.stopping.is_set()
+         try:
+            if stopping:
+               reading = self.queue.get_nowait()
+            else:
+               reading = self.queue.get(timeout=1)
+            batch.append(reading)
+            if len(batch) == 1:
+               deadline = time.time() + self.batch_seconds
+         except Queue.Empty:
+            if stopping:
+               self.flush(batch)
+               break
+
+         if len(batch) >= self.batch_rows or (batch and time.time() >= deadline):
+            self.flush(batch)
+            batch = []
+         elif not stopping:
+            self.drain()
+            self.idle()
+
+      self.disconnect()
+
+
+
+   def flush(self, batch):
+      if not batch:
+         return
+      payload = self.encode(batch)
+      if len(self.spool) or time.time() < self.retryAt or not self.deliver(payload):
+         try:
+            self.spool.put(payload)
+         except (IOError, OSError) as e:
+            self.logger.error("Cannot spool {} readings for {}, they are lost: {}".format(len(batch), self.kind, e))
+
+
+
+   def drain(self):
+      # Send spooled batches again once the retry time has passed
+      for count in range(self.drain_batches):
+         if not len(self.spool) or time.time() < self.retryAt:
+            return
+         oldest = self.spool.oldest()
+         if oldest is None or not self.deliver(oldest[1]):
+            return
+         self.spool.remove(oldest[0])
+
+
+
+   def deliver(self, payload):
+      # True when the batch is done with: delivered, or refused for good
+      try:
+         self.send(payload)
+      except ExportError as e:
+         if not e.retry:
+            self.logger.error("{} refused a batch, it is dropped: {}".format(self.kind, e))
+            return True
+         self.disconnect()
+         if not self.failing:
+            self.logger.error("{} is not reachable, keeping readings in {}: {}".format(self.kind, self.folder, e))
+         self.failing = True
+         self.retryAt = time.time() + self.retry
+         self.retry = min(self.retry * 2, self.max_retry)
+         return False
+
+      if self.failing:
+         self.logger.info("{} is back, sending {} spooled batches".format(self.kind, len(self.spool)))
+      self.failing = False
+      self.retry = self.min_retry
+      self.retryAt = 0                   # No backoff, new batches are sent right away again
+      return True
+
+
+
+   def encode(self, batch):
+      # Payload of a batch of (meter, reading) as bytes, the way it is spooled
+      raise NotImplementedError
+
+
+
+   def send(self, payload):
+      # Deliver one payload, raise ExportError when that failed
+      raise NotImplementedError
+
+
+
+   def idle(self):
+      # Called about every second without a batch to send
+      pass
+
+
+
+   def disconnect(self):
+      pass
+
+
+
+def _gzip(data):
+   compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+   return compressor.compress(data) + compressor.flush()
+
+
+
+def _escape(name):
+   # Measurement names escape commas and spaces in line protocol
+   return name.replace(",", "\\,").replace(" ", "\\ ")
+
+
+
+def _tag(value):
+   # Tag values also escape the equals sign
+   return _escape(value).replace("=", "\\=")
+
+
+
+class InfluxSink(ExportSink):
+   ##########################################################################################
+   #
+   #   Readings as InfluxDB line protocol, one point per reading with its own timestamp and
+   #   the device id of the meter as tag:
+   #     p1meter,meter=1234567 tariff=2i,usedT1=7342.728,...,gasTimestamp=1609924500i 1609924729
+   #   To http(s)://host:8086/write?db=... (1.x) or /api/v2/write?org=...&bucket=... (2.x)
+   #   gzip compressed over a keep-alive connection, a token goes in the Authorization
+   #   header. udp://host:8089 sends datagrams of at most max_datagram bytes, which cannot
+   #   tell whether InfluxDB got them; only errors of the socket itself spool a batch
+   #
+   ##########################################################################################
+   kind         = "InfluxDB"
+   timeout      = 10                     # Seconds to wait for InfluxDB
+   max_datagram = 1400                   # Bytes, stays below the usual MTU
+   int_fields   = ('tariff', 'gasTimestamp')
+
+   def __init__(self, url, token, measurement, folder, logger):
+      parts = urlsplit(url)
+      self.scheme = parts.scheme
+      self.address = (parts.hostname, parts.port or (8089 if parts.scheme == "udp" else 8086))
+      query = parts.query
+      if "precision=" not in query:
+         query += ("&" if query else "") + "precision=s"
+      self.path = "{}?{}".format(parts.path or "/write", query)
+      self.token = token
+      self.measurement = _escape(measurement)
+      self.connection = None
+      ExportSink.__init__(self, folder, logger)
+
+
+
+   def encode(self, batch):
+      lines = []
+      for meter, reading in batch:
+         tags = "" if meter is None else ",meter=" + _tag(str(meter))
+         fields = []
+         for name in Reading.__slots__[1:]:
+            value = getattr(reading, name)
+            if name in self.int_fields:
+               fields.append("{}={}i".format(name, int(value)))
+            else:
+               fields.append("{}={!r}".format(name, float(value)))
+         lines.append("{}{} {} {}".format(self.measurement, tags, ",".join(fields), int(reading.timestamp)))
+      return "\n".join(lines).encode("utf-8")
+
+
+
+   def send(self, payload):
+      if self.scheme == "udp":
+         self.sendDatagrams(payload)
+         return
+
+      body = _gzip(payload)
+      headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+      if self.token:
+         headers["Authorization"] = "Token " + self.token
+      for attempt in range(2):
+         reused = self.connection is not None
+         try:
+            if self.connection is None:
+               if self.scheme == "https":
+                  self.connection = httplib.HTTPSConnection(self.address[0], self.address[1], timeout=self.timeout)
+               else:
+                  self.connection = httplib.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+            self.connection.request("POST", self.path, body, headers)
+            response = self.connection.getresponse()
+            text = response.read()
+            break
+         except (httplib.HTTPException, socket.error) as e:
+            self.disconnect()
+            if not reused:
+               raise ExportError(e)
+            # InfluxDB may have closed the idle keep-alive connection, try a new one once
+
+      if response.status in (200, 204):
+         return
+      message = "HTTP {} {}".format(response.status, text[:200].decode("utf-8", "replace").strip())
+      raise ExportError(message, retry=response.status == 429 or response.status >= 500)
+
+
+
+   def sendDatagrams(self, payload):
+      try:
+         if self.connection is None:
+            self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+         datagram = b""
+         for line in payload.split(b"\n"):
+            if datagram and len(datagram) + 1 + len(line) > self.max_datagram:
+               self.connection.sendto(datagram, self.address)
+               datagram = b""
+            datagram = datagram + b"\n" + line if datagram else line
+         if datagram:
+            self.connection.sendto(datagram, self.address)
+      except socket.error as e:
+         raise ExportError(e)
+
+
+
+   def disconnect(self):
+      connection = self.connection
+      self.connection = None
+      if connection is not None:
+         connection.close()
+
+
+
+def _mqtt_string(text):
+   data = text.encode("utf-8")
+   return struct.pack("!H", len(data)) + data
+
+
+
+def _mqtt_packet(kind, body):
+   # Fixed header: packet type and flags, then the remaining length in 7 bit groups
+   header = bytearray([kind])
+   length = len(body)
+   while True:
+      byte = length % 128
+      length //= 128
+      header.append(byte | 0x80 if length else byte)
+      if not length:
+         return bytes(header) + body
+
+
+
+MQTT_CONNECT    = 0x10
+MQTT_CONNACK    = 0x20
+MQTT_PUBLISH    = 0x30
+MQTT_PUBACK     = 0x40
+MQTT_PINGREQ    = 0xC0
+MQTT_PINGRESP   = 0xD0
+MQTT_DISCONNECT = 0xE0
+
+
+
+class MqttSink(ExportSink):
+   ##########################################################################################
+   #
+   #   Readings to an MQTT 3.1.1 broker over one persistent connection. Every reading is
+   #   published as JSON on <topic>/<meter>/reading, meter being the Indigo device id; the
+   #   newest values are also retained on <topic>/<meter>/<field> for dashboards. All
+   #   messages of a batch go out in one write with QoS 1, and the batch is delivered when
+   #   the broker acknowledged every one of them. A publisher needs only a few packet
+   #   types, so no client library is needed
+   #
+   ##########################################################################################
+   kind      = "MQTT"
+   timeout   = 10                        # Seconds to wait for the broker
+   keepalive = 60                        # Seconds; a ping is sent after half of it without traffic
+
+   def __init__(self, host, port, user, password, topic, folder, logger):
+      self.address = (host, port)
+      self.user = user
+      self.password = password
+      self.topic = topic.strip("/")
+      self.clientId = "indigo-p1meter-{}".format(socket.gethostname().split(".")[0])[:23]
+      self.sock = None
+      self.packetId = 0
+      self.sentAt = 0
+      self.retainedAt = {}               # Per meter: timestamp of the reading last retained
+      ExportSink.__init__(self, folder, logger)
+
+
+
+   def encode(self, batch):
+      # One JSON object per line and reading, with the meter it came from
+      lines = []
+      for meter, reading in batch:
+         values = dict((name, getattr(reading, name)) for name in Reading.__slots__)
+         if meter is not None:
+            values['meter'] = meter
+         lines.append(json.dumps(values, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+      return b"\n".join(lines)
+
+
+
+   def prefix(self, values):
+      # Topic of a meter; batches spooled by older versions have no meter
+      if values.get('meter') is None:
+         return self.topic
+      return "{}/{}".format(self.topic, values['meter'])
+
+
+
+   def send(self, payload):
+      lines = payload.split(b"\n")
+      messages = []
+      newest = {}
+      for line in lines:
+         values = json.loads(line.decode("utf-8"))
+         messages.append(("{}/reading".format(self.prefix(values)), line, False))
+         newest[values.get('meter')] = values
+      for meter, values in newest.items():
+         if values['timestamp'] > self.retainedAt.get(meter, 0):
+            # Spooled batches are older than what is retained already
+            messages += [("{}/{}".format(self.prefix(values), name), json.dumps(value).encode("utf-8"), True)
+                         for name, value in sorted(values.items()) if name != 'meter']
+
+      try:
+         if self.sock is None:
+            self.connect()
+         waiting = set()
+         packets = []
+         for topic, body, retain in messages:
+            self.packetId = self.packetId % 65535 + 1
+            waiting.add(self.packetId)
+            packets.append(_mqtt_packet(MQTT_PUBLISH | 0x02 | (0x01 if retain else 0),
+                                        _mqtt_string(topic) + struct.pack("!H", self.packetId) + body))
+         self.sock.sendall(b"".join(packets))
+         self.sentAt = time.time()
+         while waiting:
+            kind, body = self.readPacket()
+            if kind == MQTT_PUBACK:
+               waiting.discard(struct.unpack("!H", body[:2])[0])
+      except (socket.error, struct.error) as e:
+         raise ExportError(e)
+      for meter, values in newest.items():
+         self.retainedAt[meter] = max(self.retainedAt.get(meter, 0), values['timestamp'])
+
+
+
+   def connect(self):
+      self.sock = socket.create_connection(self.address, self.timeout)
+      flags = 0x02                       # Clean session
+      payload = _mqtt_string(self.clientId)
+      if self.user:
+         flags |= 0x80
+         payload += _mqtt_string(self.user)
+         if self.password:
+            flags |= 0x40
+            payload += _mqtt_string(self.password)
+      self.sock.sendall(_mqtt_packet(MQTT_CONNECT, _mqtt_string("MQTT") + struct.pack("!BBH", 4, flags, self.keepalive) + payload))
+      kind, body = self.readPacket()
+      if kind != MQTT_CONNACK or len(body) < 2:
+         raise ExportError("broker did not accept the connection")
+      code = bytearray(body)[1]
+      if code:
+         raise ExportError("broker refused the connection, return code {}".format(code))
+      self.sentAt = time.time()
+
+
+
+   def readPacket(self):
+      # (packet type, body) of the next packet from the broker
+      kind = bytearray(self.recv(1))[0] & 0xF0
+      length = 0
+      shift = 0
+      while True:
+         byte = bytearray(self.recv(1))[0]
+         length += (byte & 0x7F) << shift
+         shift += 7
+         if not byte & 0x80:
+            break
+      return kind, self.recv(length)
+
+
+
+   def recv(self, count):
+      data = b""
+      while len(data) < count:
+         chunk = self.sock.recv(count - len(data))
+         if not chunk:
+            raise ExportError("connection closed by the broker")
+         data += chunk
+      return data
+
+
+
+   def idle(self):
+      # Keep the connection open between batches
+      if self.sock is None or time.time() - self.sentAt < self.keepalive / 2:
+         return
+      try:
+         self.sock.sendall(_mqtt_packet(MQTT_PINGREQ, b""))
+         self.sentAt = time.time()
+         while self.readPacket()[0] != MQTT_PINGRESP:
+            pass
+      except (socket.error, ExportError):
+         # The next batch connects again
+         self.disconnect()
+
+
+
+   def disconnect(self):
+      sock = self.sock
+      self.sock = None
+      if sock is None:
+         return
+      try:
+         sock.sendall(_mqtt_packet(MQTT_DISCONNECT, b""))
+      except socket.error:
+         pass
+      sock.close()
+
+
+
+class JsonEndpoint(object):
+   ##########################################################################################
+   #
+   #   The latest reading of every meter as JSON over HTTP, served from memory so clients
+   #   do not poll Indigo for the device states:
+   #     GET /              all meters, {"meters": [...]}
+   #     GET /meters/<id>   one meter by Indigo device id
+   #   update() only stores what the document callback needs; the JSON of a meter is built
+   #   at the first request after a telegram, outside the lock so update() never waits for
+   #   it, and then served as is. Every response has an
+   #   ETag and If-None-Match gets 304 Not Modified. With ?wait=<seconds> too, the request
+   #   is held until the next telegram (long-polling), for at most max_wait seconds. The
+   #   ETags start with a nonce of this endpoint, so after a restart, when the counters
+   #   start over, a client never gets 304 for the readings it saw before. Browsers on
+   #   other sites may only read it when cors is set
+   #
+   ##########################################################################################
+   max_wait    = 60                      # Seconds a long-poll is held at most
+   max_waiting = 32                      # Long-polls held at the same time, more get 304 right away
+
+   def __init__(self, host, port, document, logger, cors=False):
+      self.document = document
+      self.logger = logger
+      self.cors = cors                   # Send Access-Control-Allow-Origin: *
+      self.changed = threading.Condition()
+      self.sources = {}                  # Key -> what update() got last, passed to document
+      self.versions = {}                 # Key -> number of updates
+      self.cache = {}                    # Key -> (version, JSON)
+      self.version = 0                   # Updates of all meters together, the ETag of /
+      self.nonce = "{:08x}".format(struct.unpack("!I", os.urandom(4))[0])
+      self.waiting = 0
+      self.closing = False
+      self.server = _EndpointServer((host, port), _EndpointHandler)
+      self.server.endpoint = self
+      self.thread = threading.Thread(target=self.server.serve_forever, name="P1 JSON endpoint")
+      self.thread.daemon = True
+      self.thread.start()
+
+
+
+   def update(self, key, source):
+      with self.changed:
+         self.sources[key] = source
+         self.versions[key] = self.versions.get(key, 0) + 1
+         self.version += 1
+         self.changed.notify_all()
+
+
+
+   def remove(self, key):
+      with self.changed:
+         if self.sources.pop(key, None) is not None:
+            del self.versions[key]
+            self.cache.pop(key, None)
+            self.version += 1
+            self.changed.notify_all()
+
+
+
+   def close(self):
+      with self.changed:
+         self.closing = True
+         self.changed.notify_all()
+      self.server.shutdown()
+      self.server.server_close()
+
+
+
+   def etag(self, key):
+      # Current ETag of all meters (None) or of one, None for a meter without readings
+      if key is None:
+         return '"{}-{}"'.format(self.nonce, self.version)
+      if key not in self.versions:
+         return None
+      return '"{}-{}-{}"'.format(self.nonce, key, self.versions[key])
+
+
+
+   def body(self, key, version, source, cached):
+      # JSON of one meter as it was at version. Called without the lock; the result is only
+      # cached when no newer telegram came in the meantime
+      if cached is not None and cached[0] == version:
+         return cached[1]
+      data = json.dumps(self.document(source), sort_keys=True, separators=(",", ":")).encode("utf-8")
+      with self.changed:
+         if self.versions.get(key) == version:
+            self.cache[key] = (version, data)
+      return data
+
+
+
+   def get(self, key, etag=None, wait=0):
+      # (status, ETag, body) for all meters (None) or one. A request with the current ETag
+      # waits up to wait seconds for the next telegram, and gets 304 when none came
+      with self.changed:
+         current = self.etag(key)
+         if etag is not None and etag == current and wait > 0 and self.waiting < self.max_waiting:
+            self.waiting += 1
+            deadline = time.time() + min(wait, self.max_wait)
+            try:
+               while current == etag and not self.closing:
+                  remaining = deadline - time.time()
+                  if remaining <= 0:
+                     break
+                  self.changed.wait(remaining)
+                  current = self.etag(key)
+            finally:
+               self.waiting -= 1
+
+         if current is None:
+            return 404, None, b'{"error":"no readings of this meter"}'
+         if etag == current:
+            return 304, current, b""
+         parts = [(each, self.versions[each], self.sources[each], self.cache.get(each))
+                  for each in (sorted(self.versions) if key is None else [key])]
+
+      bodies = [self.body(*part) for part in parts]
+      if key is None:
+         return 200, current, b'{"meters":[' + b",".join(bodies) + b']}'
+      return 200, current, bodies[0]
+
+
+
+class _EndpointServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+
+
+class _EndpointHandler(BaseHTTPRequestHandler):
+   protocol_version = "HTTP/1.1"          # Keep-alive, a polling client reuses its connection
+
+   def do_GET(self):
+      url = urlsplit(self.path)
+      path = url.path.rstrip("/")
+      if not path:
+         key = None
+      elif path.startswith("/meters/") and path[8:].isdigit():
+         key = int(path[8:])
+      else:
+         self.answer(404, None, b'{"error":"use / or /meters/<device id>"}')
+         return
+
+      try:
+         wait = float(parse_qs(url.query).get("wait", ["0"])[0])
+      except ValueError:
+         wait = 0
+      self.answer(*self.server.endpoint.get(key, self.headers.get("If-None-Match"), wait))
+
+
+
+   def answer(self, status, etag, body):
+      self.send_response(status)
+      if etag is not None:
+         self.send_header("ETag", etag)
+      self.send_header("Cache-Control", "no-cache")
+      if self.server.endpoint.cors:
+         self.send_header("Access-Control-Allow-Origin", "*")
+         self.send_header("Access-Control-Expose-Headers", "ETag")
+      if status != 304:
+         self.send_header("Content-Type", "application/json")
+         self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      if status != 304:
+         self.wfile.write(body)
+
+
+
+   def log_message(self, format, *args):
+      # Requests come several times a minute, only log them when debugging
+      self.server.endpoint.logger.debug("JSON endpoint: " + format % args)
@@ -0,0 +1,548 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   What the P1 meter plugin derives from the telegrams of a meter, apart from Indigo so
+#   it can be tested on its own. Same license as plugin.py
+#
+#   Aggregator collects the telegrams between two Indigo updates and PublishQueue hands
+#   them to the one thread that stores them in Indigo. DailyExtremes keeps the extremes of
+#   the day, EnergyAccount the energy per period, PeakDemand the quarter-hour demand. These
+#   are fed by add() from the reader thread, give device states as a list of {'key',
+#   'value'} like plugin.py sends them, and snapshot() what is needed to continue after a
+#   restart. StateCache sends only the states that changed
+#
+##########################################################################################
+
+import time
+import threading
+import collections
+
+
+
+def _kwh(value):
+   # Rounded to Wh. Registers that went down can leave a tiny negative rest, which must not
+   # show as -0.0 in a device state
+   return round(value, 3) + 0.0
+
+
+
+class RunningStat(object):
+   ##########################################################################################
+   #
+   #   Count, sum, minimum and maximum of a series, updated in constant time per value
+   #
+   ##########################################################################################
+   __slots__ = ('count', 'total', 'minimum', 'maximum', 'minAt', 'maxAt')
+
+   def __init__(self):
+      self.count = 0
+      self.total = 0.0
+      self.minimum = 0.0
+      self.maximum = 0.0
+      self.minAt = 0
+      self.maxAt = 0
+
+
+
+   def add(self, value, at):
+      if self.count == 0 or value < self.minimum:
+         self.minimum = value
+         self.minAt = at
+      if self.count == 0 or value > self.maximum:
+         self.maximum = value
+         self.maxAt = at
+      self.count += 1
+      self.total += value
+
+
+
+   def mean(self):
+      if self.count == 0:
+         return 0.0
+      return self.total / self.count
+
+
+
+class AggregateWindow(object):
+   ##########################################################################################
+   #
+   #   Statistics over the telegrams between two Indigo updates
+   #
+   ##########################################################################################
+   __slots__ = ('usage', 'generation', 'usedWh', 'generatedWh', 'started')
+
+   def __init__(self, started=0):
+      self.usage = RunningStat()
+      self.generation = RunningStat()
+      self.usedWh = 0.0
+      self.generatedWh = 0.0
+      self.started = started
+
+
+
+class Aggregator(object):
+   ##########################################################################################
+   #
+   #   Collects every telegram into the current window: running min, max and mean power and
+   #   the energy from integrating power over time (trapezoid rule). add() is called from
+   #   the reader thread, take() hands the window to the Indigo side and starts a new one
+   #
+   ##########################################################################################
+   max_gap = 60                          # Seconds; longer gaps between telegrams are not integrated
+
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.last = None
+      self.window = AggregateWindow(int(time.time()))
+
+
+
+   def add(self, reading):
+      with self.lock:
+         window = self.window
+         window.usage.add(reading.nowUsage, reading.timestamp)
+         window.generation.add(reading.nowGenerated, reading.timestamp)
+
+         last = self.last
+         if last is not None and 0 < reading.timestamp - last.timestamp <= self.max_gap:
+            hours = (reading.timestamp - last.timestamp) / 3600.0
+            window.usedWh += (last.nowUsage + reading.nowUsage) / 2 * hours
+            window.generatedWh += (last.nowGenerated + reading.nowGenerated) / 2 * hours
+         self.last = reading
+
+
+
+   def take(self):
+      with self.lock:
+         window = self.window
+         self.window = AggregateWindow(int(time.time()))
+      return window
+
+
+
+class PublishQueue(threading.Thread):
+   ##########################################################################################
+   #
+   #   Hand-off from the meter side (readers and pool workers) to the one thread that stores
+   #   telegrams in Indigo, so a slow Indigo server never holds up reading a meter. put()
+   #   never blocks. Each meter has one slot: a newer telegram replaces one that was not
+   #   published yet (coalesced), which is fine as the aggregator already has its reading.
+   #   The queue holds at most max_meters slots; the telegram of yet another meter is dropped
+   #
+   ##########################################################################################
+   max_meters = 32
+
+   def __init__(self, publish, logger):
+      threading.Thread.__init__(self, name="P1 Indigo writer")
+      self.daemon = True
+      self.publish = publish
+      self.logger = logger
+      self.slots = collections.OrderedDict()   # devId -> (meter, packet), oldest first
+      self.ready = threading.Condition()
+      self.stopping = False
+
+
+
+   def put(self, meter, packet):
+      with self.ready:
+         if meter.devId in self.slots:
+            meter.coalesced += 1
+         elif len(self.slots) >= self.max_meters:
+            meter.dropped += 1
+            return False
+         # Replacing keeps the place in line, so a busy meter cannot starve the others
+         self.slots[meter.devId] = (meter, packet)
+         self.ready.notify()
+      return True
+
+
+
+   def run(self):
+      while True:
+         with self.ready:
+            while not self.slots and not self.stopping:
+               self.ready.wait(1)
+            if self.stopping:
+               break
+            devId, (meter, packet) = self.slots.popitem(last=False)
+         try:
+            self.publish(meter, packet)
+         except Exception as e:
+            # Keep the writer alive for the other meters
+            self.logger.error("Storing telegram of {} failed: {}".format(meter.name, e))
+
+
+
+   def stop(self):
+      with self.ready:
+         self.stopping = True
+         self.ready.notify()
+      self.join(15)
+
+
+
+class DailyExtremes(object):
+   ##########################################################################################
+   #
+   #   Highest use and generation of the day and the lowest use at night, when only the base
+   #   load is on, with the time of each. The local day they belong to is kept with them: a
+   #   reading of another day starts over, and a restart does not
+   #
+   ##########################################################################################
+   night = 6                             # The lowest use only counts before this hour
+
+   def __init__(self, saved=None):
+      self.lock = threading.Lock()
+      self.reset("")
+      if saved:
+         for name in ('day', 'minUsed', 'minUsedAt', 'maxUsed', 'maxUsedAt', 'maxProduced', 'maxProducedAt'):
+            setattr(self, name, saved.get(name, getattr(self, name)))
+
+
+
+   def reset(self, day):
+      self.day = day                     # YYYYMMDD of the extremes
+      self.minUsed = None                # None until the first reading at night
+      self.minUsedAt = 0
+      self.maxUsed = 0.0
+      self.maxUsedAt = 0
+      self.maxProduced = 0.0
+      self.maxProducedAt = 0
+
+
+
+   def add(self, reading):
+      local = time.localtime(reading.timestamp)
+      day = time.strftime('%Y%m%d', local)
+      with self.lock:
+         if day != self.day:
+            if day < self.day:
+               # Clock of the meter went back over midnight
+               return
+            self.reset(day)
+         if reading.nowUsage > self.maxUsed:
+            self.maxUsed = reading.nowUsage
+            self.maxUsedAt = reading.timestamp
+         if reading.nowGenerated > self.maxProduced:
+            self.maxProduced = reading.nowGenerated
+            self.maxProducedAt = reading.timestamp
+         if local.tm_hour < self.night and (self.minUsed is None or reading.nowUsage < self.minUsed):
+            self.minUsed = reading.nowUsage
+            self.minUsedAt = reading.timestamp
+
+
+
+   def states(self):
+      def clock(at):
+         return time.strftime('%H:%M:%S', time.localtime(at)) if at else ""
+      with self.lock:
+         return [
+               {'key':'minUsedToday',               'value': "" if self.minUsed is None else self.minUsed},
+               {'key':'maxUsedToday',               'value': self.maxUsed},
+               {'key':'maxProducedToday',           'value': self.maxProduced},
+               {'key':'minUsedTime',                'value': clock(self.minUsedAt)},
+               {'key':'maxUsedTime',                'value': clock(self.maxUsedAt)},
+               {'key':'maxProducedTime',            'value': clock(self.maxProducedAt)},
+         ]
+
+
+
+   def snapshot(self):
+      with self.lock:
+         return {'day': self.day, 'minUsed': self.minUsed, 'minUsedAt': self.minUsedAt,
+                 'maxUsed': self.maxUsed, 'maxUsedAt': self.maxUsedAt,
+                 'maxProduced': self.maxProduced, 'maxProducedAt': self.maxProducedAt}
+
+
+
+class EnergyAccount(object):
+   ##########################################################################################
+   #
+   #   Energy used, generated and net per tariff for the interval since the last Indigo
+   #   update, today, this month and this year. At the start of every period the registers
+   #   are saved as its base; a total is the register now minus that base, so add() costs
+   #   the same for every telegram. Periods follow the local calendar of the telegram
+   #   timestamps, a DST day just has 23 or 25 hours. A register that goes down means the
+   #   meter was replaced: all bases move along with it, so the totals continue
+   #
+   ##########################################################################################
+   registers = ('usedT1', 'usedT2', 'generatedT1', 'generatedT2', 'gasUsed')
+   periods   = (('today', 8), ('month', 6), ('year', 4))   # Length of the YYYYMMDD key used
+   max_gap   = 3600                      # Seconds; after a longer silence the next reading starts a period
+
+   def __init__(self, saved=None):
+      self.lock = threading.Lock()
+      self.last = None                   # Registers of the last reading
+      self.lastAt = 0
+      self.keys = {}                     # Period -> YYYYMMDD, YYYYMM or YYYY it covers
+      self.bases = {}                    # Period -> registers at its start
+      self.started = set()               # Periods that started since the last take()
+      self.changed = False               # Bases changed since the last snapshot()
+      if saved:
+         self.last = saved.get('last')
+         self.lastAt = saved.get('lastAt', 0)
+         self.keys = saved.get('keys', {})
+         self.bases = saved.get('bases', {})
+
+
+
+   def add(self, reading):
+      values = dict((name, getattr(reading, name)) for name in self.registers)
+      day = time.strftime('%Y%m%d', time.localtime(reading.timestamp))
+      with self.lock:
+         last = self.last
+         if last is not None:
+            for name in self.registers:
+               if not values[name]:
+                  # Not in this telegram, e.g. a gas meter that did not report
+                  values[name] = last[name]
+               elif values[name] < last[name]:
+                  shift = values[name] - last[name]
+                  for base in self.bases.values():
+                     base[name] += shift
+                  self.changed = True
+
+         start = values if last is None or reading.timestamp - self.lastAt > self.max_gap else last
+         self.bases.setdefault('interval', dict(start))
+         for period, length in self.periods:
+            if self.keys.get(period) != day[:length]:
+               # The last reading before the boundary is the best guess for the registers at it
+               if period in self.keys:
+                  self.started.add(period)
+               self.keys[period] = day[:length]
+               self.bases[period] = dict(start)
+               self.changed = True
+         self.last = values
+         self.lastAt = reading.timestamp
+
+
+
+   def take(self):
+      # Device states of all periods and the periods that started since the previous call.
+      # The interval starts again from here
+      with self.lock:
+         states = []
+         for period in ('interval',) + tuple(period for period, length in self.periods):
+            states += self.states(period)
+         started = self.started
+         self.started = set()
+         if self.last is not None:
+            self.bases['interval'] = dict(self.last)
+      return states, started
+
+
+
+   def states(self, period):
+      base = self.bases.get(period)
+      if base is None or self.last is None:
+         total = dict.fromkeys(self.registers, 0.0)
+      else:
+         total = dict((name, self.last[name] - base[name]) for name in self.registers)
+      used = total['usedT1'] + total['usedT2']
+      generated = total['generatedT1'] + total['generatedT2']
+      return [
+            {'key':period + 'Used',              'value': _kwh(used)},
+            {'key':period + 'UsedT1',            'value': _kwh(total['usedT1'])},
+            {'key':period + 'UsedT2',            'value': _kwh(total['usedT2'])},
+            {'key':period + 'Generated',         'value': _kwh(generated)},
+            {'key':period + 'GeneratedT1',       'value': _kwh(total['generatedT1'])},
+            {'key':period + 'GeneratedT2',       'value': _kwh(total['generatedT2'])},
+            {'key':period + 'Net',               'value': _kwh(used - generated)},
+            {'key':period + 'Gas',               'value': _kwh(total['gasUsed'])},
+      ]
+
+
+
+   def snapshot(self):
+      # What is needed to continue the totals after a restart
+      with self.lock:
+         self.changed = False
+         bases = dict((period, dict(base)) for period, base in self.bases.items() if period != 'interval')
+         return {'last': self.last, 'lastAt': self.lastAt, 'keys': dict(self.keys), 'bases': bases}
+
+
+
+class PeakDemand(object):
+   ##########################################################################################
+   #
+   #   Quarter-hour demand for capacity tariffs: the average import per aligned 15-minute
+   #   window, a projection for the running window and the highest complete window of the
+   #   month. Import comes from the 1.8.1 + 1.8.2 registers, or from integrating 1.7.0 when
+   #   a telegram has no registers. Only the import at the start of the window is kept, so
+   #   add() costs the same for every telegram. The import at a window boundary is
+   #   interpolated between the readings around it; after a longer gap the window is
+   #   incomplete and does not count for the peak
+   #
+   ##########################################################################################
+   window  = 900                         # Seconds; windows start on whole quarters
+   max_gap = 300                         # Seconds; longer gaps are not interpolated or integrated
+
+   def __init__(self, saved=None):
+      self.lock = threading.Lock()
+      self.total = None                  # kWh imported: the registers or the integrated power
+      self.source = None                 # registers or power
+      self.lastAt = 0
+      self.lastPower = 0.0               # kW of the last reading
+      self.start = 0                     # Start of the running window
+      self.base = None                   # Import at the start of the running window, None if incomplete
+      self.previous = 0.0                # Average kW of the previous complete window
+      self.month = ""                    # YYYYMM of the peak
+      self.peak = 0.0                    # Highest average kW of a complete window this month
+      self.peakAt = 0                    # Start of that window
+      self.lastMonthPeak = 0.0
+      self.changed = False               # Peak or month changed since the last snapshot()
+      if saved:
+         for name in ('total', 'source', 'lastAt', 'lastPower', 'start', 'base', 'previous',
+                      'month', 'peak', 'peakAt', 'lastMonthPeak'):
+            setattr(self, name, saved.get(name, getattr(self, name)))
+
+
+
+   def add(self, reading):
+      at = reading.timestamp
+      power = reading.nowUsage / 1000.0
+      registers = reading.usedT1 + reading.usedT2
+      source = "registers" if registers else "power"
+      start = at - at % self.window
+      with self.lock:
+         if self.total is not None and at <= self.lastAt:
+            # Same or an older telegram
+            return
+         gap = at - self.lastAt
+         connected = self.total is not None and source == self.source and (gap <= self.max_gap or
+                     (source == "registers" and start == self.start))
+         if source == "registers":
+            total = registers
+         elif connected:
+            total = self.total + (self.lastPower + power) / 2 * gap / 3600.0
+         else:
+            total = self.total or 0.0
+         if connected and total < self.total:
+            # Registers went down: the meter was replaced
+            connected = False
+
+         if start != self.start:
+            if connected:
+               boundary = self.total + (total - self.total) * float(start - self.lastAt) / gap
+               if self.base is not None:
+                  self.closeWindow(boundary - self.base)
+               self.base = boundary
+            else:
+               self.base = None
+            self.start = start
+            self.newMonth(start)
+         elif not connected:
+            self.base = None
+
+         self.total = total
+         self.source = source
+         self.lastAt = at
+         self.lastPower = power
+
+
+
+   def closeWindow(self, energy):
+      # The running window is complete, energy is its import in kWh
+      average = energy * 3600.0 / self.window
+      self.previous = average
+      self.newMonth(self.start)
+      if average > self.peak:
+         self.peak = average
+         self.peakAt = self.start
+         self.changed = True
+
+
+
+   def newMonth(self, at):
+      month = time.strftime('%Y%m', time.localtime(at))
+      if month != self.month:
+         if self.month:
+            self.lastMonthPeak = self.peak
+         self.month = month
+         self.peak = 0.0
+         self.peakAt = 0
+         self.changed = True
+
+
+
+   def states(self):
+      # Device states, power in kW. The projection assumes the last power for the rest of the window
+      with self.lock:
+         average = projected = 0.0
+         elapsed = self.lastAt - self.start
+         if self.base is not None and elapsed > 0:
+            energy = self.total - self.base
+            average = energy * 3600.0 / elapsed
+            projected = (energy + self.lastPower * (self.window - elapsed) / 3600.0) * 3600.0 / self.window
+         return [
+               {'key':'demandAverage',              'value': round(average, 3)},
+               {'key':'demandProjected',            'value': round(projected, 3)},
+               {'key':'demandWindowStart',          'value': time.strftime('%H:%M', time.localtime(self.start)) if self.start else ""},
+               {'key':'demandPrevious',             'value': round(self.previous, 3)},
+               {'key':'demandPeak',                 'value': round(self.peak, 3)},
+               {'key':'demandPeakTime',             'value': time.strftime('%Y-%m-%d %H:%M', time.localtime(self.peakAt)) if self.peakAt else ""},
+               {'key':'demandLastMonthPeak',        'value': round(self.lastMonthPeak, 3)},
+         ]
+
+
+
+   def snapshot(self):
+      # What is needed to continue the running window and the peak after a restart
+      with self.lock:
+         self.changed = False
+         return {'total': self.total, 'source': self.source, 'lastAt': self.lastAt,
+                 'lastPower': self.lastPower, 'start': self.start, 'base': self.base,
+                 'previous': self.previous, 'month': self.month, 'peak': self.peak,
+                 'peakAt': self.peakAt, 'lastMonthPeak': self.lastMonthPeak}
+
+
+
+class StateCache(object):
+   ##########################################################################################
+   #
+   #   The device states last sent to Indigo, per device, so a push only sends the states
+   #   that changed. Every fullRefresh minutes all states go out again, in case one was
+   #   changed outside the plugin. statesSent tells how many states the last push had
+   #
+   ##########################################################################################
+
+   def __init__(self):
+      self.values = {}                   # Per device: state values last sent
+      self.refreshedAt = {}              # Per device: time of the last full refresh
+
+
+
+   def changes(self, devId, states, fullRefresh, now):
+      # (states to send, how many of states that is, True for a full refresh). fullRefresh
+      # is in minutes, 0 only sends changes. Call stored() once Indigo has them
+      pushed = self.values.setdefault(devId, {})
+      refresh = fullRefresh > 0 and now - self.refreshedAt.get(devId, 0) >= fullRefresh * 60
+
+      if refresh or not pushed:
+         changed = list(states)
+         self.refreshedAt[devId] = now
+      else:
+         changed = [state for state in states if state['key'] not in pushed or pushed[state['key']] != state['value']]
+
+      sent = len(changed)
+      if pushed.get('statesSent') != sent:
+         changed.append({'key':'statesSent', 'value':sent})
+      return changed, sent, refresh
+
+
+
+   def stored(self, devId, states):
+      pushed = self.values.setdefault(devId, {})
+      for state in states:
+         pushed[state['key']] = state['value']
+
+
+
+   def forget(self, devId, key=None):
+      # Send one state, or all states of the device, again with the next push
+      if key is not None:
+         self.values.get(devId, {}).pop(key, None)
+      else:
+         self.values.pop(devId, None)
+         self.refreshedAt.pop(devId, None)
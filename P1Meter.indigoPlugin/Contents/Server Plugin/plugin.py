@@ -47,12 +47,26 @@
 ##########################################################################################
 
 import sys
-import serial
+import os
 from serial.serialutil import SerialException
-import re
 import locale
-from time import mktime
+import threading
+import time
+import struct
+import mmap
+import sqlite3
+import Queue
+import heapq
+import urlparse
+import multiprocessing
+import json
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
+from smartmeter import (SmartMeter, SmartMeterReader, TcpSource, NetworkReader, FrameAssembler,
+                        SmartMeterError, P1PacketError, P1Packet, Reading, parse_frame,
+                        CRC_VALID, CRC_INVALID, CRC_MISSING, TIMINGS)
+from exporters import InfluxSink, MqttSink, JsonEndpoint
+from meterstate import Aggregator, PublishQueue, DailyExtremes, EnergyAccount, PeakDemand, StateCache
 
 
 
@@ -69,9 +83,52 @@ class Plugin(indigo.PluginBase):
    usbDevice           = "None"          # On which USB port do we find the P1 neter
    dsmrversion         = "0"             # Not defined yet
    sleeptime           = 60              # Pause between reading telegrarms
+   schedule            = "poll"          # poll: read every sleeptime, event: publish as telegrams arrive
+   publishInterval     = 10              # Event schedule: least seconds between two updates of a device
+   alignTo             = 0               # Event schedule: publish on whole minutes (60) or quarters (900)
+   watchInterval       = 10              # Event schedule: seconds between checks that all readers run
    show_raw            = 0               # Show all raw telegrams
-   max_telegram_length = 40              # Prevent looping over garbish
-   reset_flag          = 0               # Prevent resetting min and max multiple times/day
+   readMode            = "cycle"         # cycle: open/read/close per cycle, stream: keep port open
+   transport           = "serial"        # serial: USB cable, tcp: network P1 bridge
+   tcpHost             = ""              # Host name or address of the network P1 bridge
+   tcpPort             = 23              # TCP port of the network P1 bridge
+   max_telegram_size   = 8192            # Prevent looping over garbish (bytes)
+   devices             = None            # Per device id: started p1meter device, see deviceStartComm
+   meters              = None            # Per device: Meter with its settings, reader and counters
+   pool                = None            # Worker threads reading the meters
+   poolSize            = 4               # Workers in the pool, grows with the number of meters
+   network             = None            # NetworkReader thread serving all TCP sources
+   writer              = None            # PublishQueue: the only thread that stores telegrams in Indigo
+   fullRefresh         = 60              # Minutes between sending all states, 0 = only changes
+   timingsEnabled      = False           # Time every stage of reading and storing telegrams
+   timingStates        = False           # Also show p50/p95/p99 per stage as device states
+   pushedStates        = None            # StateCache: per device the states last sent to Indigo
+   historyEnabled      = False           # Keep a history of all readings on disk
+   historyFolder       = ""              # Where the history files go, empty for the default
+   history             = None            # HistoryStore when historyEnabled
+   sqliteEnabled       = False           # Write all readings to a SQLite database
+   sqlitePath          = ""              # Database file, empty for the default
+   influxEnabled       = False           # Export all readings to InfluxDB
+   influxUrl           = ""              # http(s)://host:8086/write?db=... or udp://host:8089
+   influxToken         = ""              # InfluxDB 2.x API token, empty for none
+   influxMeasurement   = "p1meter"       # Measurement the readings are written to, tagged meter=<device id>
+   mqttEnabled         = False           # Publish all readings to an MQTT broker
+   mqttHost            = ""              # Host name or address of the broker
+   mqttPort            = 1883            # TCP port of the broker
+   mqttUser            = ""              # Empty when the broker needs no login
+   mqttPassword        = ""
+   mqttTopic           = "p1meter"       # Readings go to <topic>/<device id>/reading and .../<field>
+   httpEnabled         = False           # Serve the latest reading of every meter as JSON
+   httpPort            = 8177            # TCP port of the JSON endpoint
+   httpAddress         = "127.0.0.1"     # Address it listens on, empty for all interfaces
+   httpCors            = False           # Let web pages on other sites read it
+   endpoint            = None            # JsonEndpoint when httpEnabled
+   sinks               = ()              # Everything that gets each reading (history, ...)
+   replay              = None            # Running replay of captured telegrams
+   savedState          = None            # Per device id: snapshot of its derived state, see saveState
+   stateLock           = None            # Serializes writing the state file
+   stateInterval       = 300             # Seconds between writing the state file
+   stateSavedAt        = 0
    
 
 
@@ -82,6 +139,11 @@ class Plugin(indigo.PluginBase):
       #
       ##########################################################################################
       indigo.PluginBase.__init__(self,pluginId,pluginDisplayName,pluginVersion,pluginPrefs)
+      self.meters = {}
+      self.devices = {}
+      self.savedState = {}
+      self.stateLock = threading.Lock()
+      self.pushedStates = StateCache()
 
 
    def __del__(self):
@@ -109,29 +171,96 @@ class Plugin(indigo.PluginBase):
    def GetMasterDevList(self):
       ##########################################################################################
       #
-      #   Get List of Master Devices
+      #   Get List of Master Devices. Comes from the cache kept by deviceStartComm and
+      #   deviceStopComm, so this does not ask the Indigo server
       #
       ##########################################################################################
-      MasterDevList = indigo.devices.keys(filter="self.p1meter")
-      if len(MasterDevList) == 0:
-         # No Device yet so let's create it
-         DevCreated = indigo.device.create(indigo.kProtocol.Plugin, name="P1 Master",
-             description="Energy Management", deviceTypeId="p1meter")
-         MasterDevList.append(DevCreated)
-      return MasterDevList
+      return sorted(self.devices)
+
+
+
+   def createMasterDevice(self, valuesDict=None, typeId=""):
+      ##########################################################################################
+      #
+      #   Menu item: create a P1 Master device. Indigo starts it through deviceStartComm
+      #
+      ##########################################################################################
+      P1Dev = indigo.device.create(indigo.kProtocol.Plugin, name="P1 Master",
+          description="Energy Management", deviceTypeId="p1meter")
+      self.logger.info("Created device {}".format(P1Dev.name))
+      return
 
 
 
    def SetMasterState(self,tekst):
       ##########################################################################################
       #
-      #   Get List of Master Devices
+      #   Set the summary state of all Master Devices
       #
       ##########################################################################################
-      MasterDevList = indigo.devices.keys(filter="self.p1meter")
-      if len(MasterDevList) > 0:
-         P1Dev = indigo.devices[MasterDevList[0]]
-         P1Dev.updateStateOnServer("masterState",tekst)
+      for P1Dev in self.devices.values():
+         self.setDeviceState(P1Dev, tekst)
+      return
+
+
+
+   def setDeviceState(self, P1Dev, tekst):
+      ##########################################################################################
+      #
+      #   Set the summary state of one Master Device, outside of pushStates
+      #
+      ##########################################################################################
+      P1Dev.updateStateOnServer("masterState",tekst)
+      self.pushedStates.forget(P1Dev.id, "masterState")
+      return
+
+
+
+   def deviceStartComm(self, P1Dev):
+      ##########################################################################################
+      #
+      #   Indigo starts one of our devices: at plugin start, when it is created or enabled
+      #
+      ##########################################################################################
+      if P1Dev.deviceTypeId != "p1meter":
+         return
+      # Check if the device definition is changed
+      P1Dev.stateListOrDisplayStateIdChanged()
+      self.devices[P1Dev.id] = P1Dev
+      self.setDeviceState(P1Dev, "Started")
+      return
+
+
+
+   def deviceStopComm(self, P1Dev):
+      ##########################################################################################
+      #
+      #   Indigo stops one of our devices: at plugin stop, when it is deleted or disabled
+      #
+      ##########################################################################################
+      if self.devices.pop(P1Dev.id, None) is None:
+         return
+      meter = self.meters.pop(P1Dev.id, None)
+      if meter is not None:
+         self.stopReader(meter)
+         self.saveState(meter)
+      if self.endpoint is not None:
+         self.endpoint.remove(P1Dev.id)
+      self.pushedStates.forget(P1Dev.id)
+      self.setDeviceState(P1Dev, "Stopped")
+      return
+
+
+
+   def deviceUpdated(self, origDev, newDev):
+      ##########################################################################################
+      #
+      #   Keep the cached device current, its states and config are read every cycle
+      #
+      ##########################################################################################
+      indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+      if newDev.id in self.devices:
+         self.devices[newDev.id] = newDev
       return
 
 
@@ -150,13 +279,42 @@ class Plugin(indigo.PluginBase):
       self.usbDevice          = self.pluginPrefs.get("usbDevice_uiAddress","None")
       self.dsmrversion        = self.pluginPrefs.get("dsmrversion","4")
       self.sleeptime          = int(self.pluginPrefs.get("sleeptime",120))
+      self.schedule           = self.pluginPrefs.get("schedule","poll")
+      self.publishInterval    = int(self.pluginPrefs.get("publishInterval",10))
+      self.alignTo            = int(self.pluginPrefs.get("alignTo",0))
       self.show_raw           = int(self.pluginPrefs.get("show_raw",0))
-
-      # Check at startup if the device definition is changed
-      for dev in indigo.devices.iter("self"):
-         dev.stateListOrDisplayStateIdChanged()
-
-      self.SetMasterState("Started")
+      self.readMode           = self.pluginPrefs.get("readMode","cycle")
+      self.transport          = self.pluginPrefs.get("transport","serial")
+      self.tcpHost            = self.pluginPrefs.get("tcpHost","")
+      self.tcpPort            = int(self.pluginPrefs.get("tcpPort",23))
+      self.fullRefresh        = int(self.pluginPrefs.get("fullRefresh",60))
+      self.timingsEnabled     = bool(self.pluginPrefs.get("timingsEnabled",False))
+      self.timingStates       = bool(self.pluginPrefs.get("timingStates",False))
+      TIMINGS.enabled         = self.timingsEnabled
+      self.historyEnabled     = bool(self.pluginPrefs.get("historyEnabled",False))
+      self.historyFolder      = self.pluginPrefs.get("historyFolder","")
+      self.sqliteEnabled      = bool(self.pluginPrefs.get("sqliteEnabled",False))
+      self.sqlitePath         = self.pluginPrefs.get("sqlitePath","")
+      self.influxEnabled      = bool(self.pluginPrefs.get("influxEnabled",False))
+      self.influxUrl          = self.pluginPrefs.get("influxUrl","")
+      self.influxToken        = self.pluginPrefs.get("influxToken","")
+      self.influxMeasurement  = self.pluginPrefs.get("influxMeasurement","p1meter")
+      self.mqttEnabled        = bool(self.pluginPrefs.get("mqttEnabled",False))
+      self.mqttHost           = self.pluginPrefs.get("mqttHost","")
+      self.mqttPort           = int(self.pluginPrefs.get("mqttPort",1883))
+      self.mqttUser           = self.pluginPrefs.get("mqttUser","")
+      self.mqttPassword       = self.pluginPrefs.get("mqttPassword","")
+      self.mqttTopic          = self.pluginPrefs.get("mqttTopic","p1meter")
+      self.httpEnabled        = bool(self.pluginPrefs.get("httpEnabled",False))
+      self.httpPort           = int(self.pluginPrefs.get("httpPort",8177))
+      self.httpAddress        = self.pluginPrefs.get("httpAddress","127.0.0.1").strip()
+      self.httpCors           = bool(self.pluginPrefs.get("httpCors",False))
+
+      self.savedState = self.loadState()
+      self.openSinks()
+      self.openEndpoint()
+      self.writer = PublishQueue(self.publishQueued, self.logger)
+      self.writer.start()
       return
 
 
@@ -168,6 +326,18 @@ class Plugin(indigo.PluginBase):
       #
       ##########################################################################################
       self.verbose("....in shutdown sequence")
+      self.stopReaders()
+      if self.writer is not None:
+         self.writer.stop()
+      self.saveState()
+      if self.pool is not None:
+         # Do not wait for workers stuck on a dead port, they end with the plugin
+         self.pool.close()
+         self.pool = None
+      if self.replay is not None:
+         self.replay.stop()
+      self.closeSinks()
+      self.closeEndpoint()
       self.SetMasterState("Stopped")
       return
 
@@ -183,14 +353,66 @@ class Plugin(indigo.PluginBase):
       self.verbose(valuesDict)
       errorsDict = indigo.Dict()
 
-      # Get usb device
-      self.validateSerialPortUi(valuesDict, errorsDict, u'usbDevice') 
-      #self.usbDevice = str(valuesDict["usbDevice"])
+      # Serial cable or network P1 bridge
+      self.transport = str(valuesDict.get("transport","serial"))
+      self.validateConnection(self.transport, valuesDict, errorsDict)
+      if self.transport == "tcp":
+         self.tcpHost = str(valuesDict.get("tcpHost","")).strip()
+         self.tcpPort = int(valuesDict.get("tcpPort",23)) if "tcpPort" not in errorsDict else 23
 
       # DSMR Version
       self.dsmrversion = str(valuesDict["dsmrversion"])
       self.verbose("DSMR version %s" % self.dsmrversion)
 
+      # Keep serial port open or reopen it every cycle
+      self.readMode = str(valuesDict.get("readMode","cycle"))
+
+      # History of all readings
+      self.historyEnabled = bool(valuesDict.get("historyEnabled",False))
+      self.historyFolder  = str(valuesDict.get("historyFolder","")).strip()
+
+      # SQLite database with all readings
+      self.sqliteEnabled  = bool(valuesDict.get("sqliteEnabled",False))
+      self.sqlitePath     = str(valuesDict.get("sqlitePath","")).strip()
+
+      # Export to InfluxDB
+      self.influxEnabled     = bool(valuesDict.get("influxEnabled",False))
+      self.influxUrl         = str(valuesDict.get("influxUrl","")).strip()
+      self.influxToken       = str(valuesDict.get("influxToken","")).strip()
+      self.influxMeasurement = str(valuesDict.get("influxMeasurement","p1meter")).strip() or "p1meter"
+      if self.influxEnabled:
+         url = urlparse.urlsplit(self.influxUrl)
+         if url.scheme not in ("http", "https", "udp") or not url.hostname:
+            errorsDict["influxUrl"] = "Enter a URL like http://host:8086/write?db=energy or udp://host:8089"
+
+      # Export to an MQTT broker
+      self.mqttEnabled  = bool(valuesDict.get("mqttEnabled",False))
+      self.mqttHost     = str(valuesDict.get("mqttHost","")).strip()
+      self.mqttUser     = str(valuesDict.get("mqttUser","")).strip()
+      self.mqttPassword = str(valuesDict.get("mqttPassword",""))
+      self.mqttTopic    = str(valuesDict.get("mqttTopic","p1meter")).strip().strip("/") or "p1meter"
+      if self.mqttEnabled:
+         if not self.mqttHost:
+            errorsDict["mqttHost"] = "Enter the host name or address of the MQTT broker"
+         try:
+            self.mqttPort = int(valuesDict.get("mqttPort",1883))
+            if not 0 < self.mqttPort < 65536:
+               raise ValueError
+         except ValueError:
+            errorsDict["mqttPort"] = "The value of this field must be a TCP port (1-65535)"
+
+      # Latest reading as JSON over HTTP
+      self.httpEnabled = bool(valuesDict.get("httpEnabled",False))
+      if self.httpEnabled:
+         try:
+            self.httpPort = int(valuesDict.get("httpPort",8177))
+            if not 0 < self.httpPort < 65536:
+               raise ValueError
+         except ValueError:
+            errorsDict["httpPort"] = "The value of this field must be a TCP port (1-65535)"
+         self.httpAddress = str(valuesDict.get("httpAddress","127.0.0.1")).strip()
+         self.httpCors = bool(valuesDict.get("httpCors",False))
+
       # Log Level
       self.logLevel  = str(valuesDict["logLevel"])
       self.show_raw  = int(valuesDict["show_raw"])
@@ -200,12 +422,36 @@ class Plugin(indigo.PluginBase):
       if self.sleeptime < 10:
          errorsDict["sleeptime"] = "The value of this field must be at least 10" 
 
+      # Publish as telegrams arrive, at most every publishInterval seconds
+      self.schedule = str(valuesDict.get("schedule","poll"))
+      self.alignTo  = int(valuesDict.get("alignTo",0))
+      try:
+         self.publishInterval = int(valuesDict.get("publishInterval",10))
+         if self.publishInterval < 1:
+            raise ValueError
+      except ValueError:
+         errorsDict["publishInterval"] = "The value of this field must be at least 1"
+
+      # minutes between sending all states instead of only changed ones
+      try:
+         self.fullRefresh = int(valuesDict.get("fullRefresh",60))
+         if self.fullRefresh < 0:
+            raise ValueError
+      except ValueError:
+         errorsDict["fullRefresh"] = "The value of this field must be 0 or more"
+
+      # Stage timings
+      self.timingsEnabled = bool(valuesDict.get("timingsEnabled",False))
+      self.timingStates   = self.timingsEnabled and bool(valuesDict.get("timingStates",False))
+      TIMINGS.enabled     = self.timingsEnabled
+
       if len(errorsDict) > 0:
          # Some UI fields are invalid
          return (False, valuesDict, errorsDict)
 
-      self.usbDevice = str(valuesDict["usbDevice_uiAddress"])
-      self.verbose("USB device %s will be used" % self.usbDevice)
+      if self.transport == "serial":
+         self.usbDevice = str(valuesDict["usbDevice_uiAddress"])
+         self.verbose("USB device %s will be used" % self.usbDevice)
       # If we arrive here, all values are ok. Update Server on this
       self.logger.info("Plugin Config Updated succesfull")
 
@@ -213,181 +459,648 @@ class Plugin(indigo.PluginBase):
 
 
 
-   def store_indigo(self,P1Dev, keys):
+   def validateDeviceConfigUi(self, valuesDict, typeId, devId):
       ##########################################################################################
       #
-      #   Store the received packet in Indigo
+      #   Validation of the connection of one meter. "plugin" uses the plugin config
       #
       ##########################################################################################
+      errorsDict = indigo.Dict()
+      connection = str(valuesDict.get("connection","plugin"))
+      if connection != "plugin":
+         self.validateConnection(connection, valuesDict, errorsDict)
 
-      sumup = int(1000 * (float(keys['kwh']['current_produced']) - float(keys['kwh']['current_consumed'])))
-      if sumup > 0:
-         mstate = "Producing {} W".format(sumup)
+      if len(errorsDict) > 0:
+         return (False, valuesDict, errorsDict)
+      return (True, valuesDict)
+
+
+
+   def validateConnection(self, transport, valuesDict, errorsDict):
+      ##########################################################################################
+      #
+      #   Check the serial port or TCP fields of a config dialog
+      #
+      ##########################################################################################
+      if transport == "tcp":
+         if not str(valuesDict.get("tcpHost","")).strip():
+            errorsDict["tcpHost"] = "Enter the host name or address of the P1 bridge"
+         try:
+            if not 0 < int(valuesDict.get("tcpPort",23)) < 65536:
+               raise ValueError
+         except ValueError:
+            errorsDict["tcpPort"] = "The value of this field must be a TCP port (1-65535)"
       else:
-         mstate = "Consuming {} W".format(0-sumup)
+         # Get usb device
+         self.validateSerialPortUi(valuesDict, errorsDict, u'usbDevice') 
+      return
 
-      maxProducedTime  = P1Dev.states['maxProducedTime']
-      maxUsedTime      = P1Dev.states['maxUsedTime']
-      minUsedTime      = P1Dev.states['minUsedTime']
 
-      try:
-         maxProducedToday = float(P1Dev.states['maxProducedToday'])
-      except ValueError:
-         maxProducedToday = 0
 
+   def closedPrefsConfigUi(self, valuesDict, userCancelled):
+      ##########################################################################################
+      #
+      #   Config dialog closed. A running reader still uses the old port settings, so stop it.
+      #   The next cycle starts a new one if stream mode is (still) selected
+      #
+      ##########################################################################################
+      if not userCancelled:
+         self.stopReaders()
+         self.closeSinks()
+         self.openSinks()
+         self.closeEndpoint()
+         self.openEndpoint()
+      return
+
+
+
+   def dataFolder(self):
+      ##########################################################################################
+      #
+      #   Folder for files kept by this plugin
+      #
+      ##########################################################################################
+      return os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins", self.pluginId)
+
+
+
+   def openSinks(self):
+      ##########################################################################################
+      #
+      #   Set up the destinations that receive every reading
+      #
+      ##########################################################################################
+      sinks = []
+      if self.historyEnabled:
+         folder = self.historyFolder or os.path.join(self.dataFolder(), "history")
+         try:
+            self.history = HistoryStore(folder)
+            sinks.append(self.history)
+            self.verbose("History of readings is kept in {}".format(folder))
+         except (IOError, OSError) as e:
+            self.logger.error("Cannot keep history in {}: {}".format(folder, e))
+
+      if self.sqliteEnabled:
+         path = self.sqlitePath or os.path.join(self.dataFolder(), "p1meter.sqlite")
+         sinks.append(SqliteSink(path, self.logger))
+         self.verbose("Readings are written to SQLite database {}".format(path))
+
+      # Both keep undelivered batches in a spool folder while their target is down
+      if self.influxEnabled and self.influxUrl:
+         sinks.append(InfluxSink(self.influxUrl, self.influxToken, self.influxMeasurement,
+                                 os.path.join(self.dataFolder(), "spool", "influx"), self.logger))
+         self.verbose("Readings are exported to InfluxDB at {}".format(self.influxUrl))
+
+      if self.mqttEnabled and self.mqttHost:
+         sinks.append(MqttSink(self.mqttHost, self.mqttPort, self.mqttUser, self.mqttPassword, self.mqttTopic,
+                               os.path.join(self.dataFolder(), "spool", "mqtt"), self.logger))
+         self.verbose("Readings are published to MQTT broker {}:{} under {}".format(self.mqttHost, self.mqttPort, self.mqttTopic))
+      self.sinks = sinks
+      return
+
+
+
+   def closeSinks(self):
+      ##########################################################################################
+      #
+      #   Write out what the sinks still buffer and release them
+      #
+      ##########################################################################################
+      sinks = self.sinks
+      self.sinks = ()
+      self.history = None
+      for sink in sinks:
+         try:
+            sink.close()
+         except (IOError, OSError) as e:
+            self.logger.error("Closing {} failed: {}".format(sink.__class__.__name__, e))
+      return
+
+
+
+   def openEndpoint(self):
+      ##########################################################################################
+      #
+      #   Start serving the latest reading of every meter as JSON, see JsonEndpoint
+      #
+      ##########################################################################################
+      if not self.httpEnabled:
+         return
       try:
-         maxUsedToday     = float(P1Dev.states['maxUsedToday'])
-      except ValueError:
-         maxUsedToday     = 0
-      
+         self.endpoint = JsonEndpoint(self.httpAddress, self.httpPort, self.endpointDocument, self.logger, cors=self.httpCors)
+         self.verbose("Latest readings are served as JSON on {}:{}".format(self.httpAddress or "*", self.httpPort))
+      except (IOError, OSError) as e:
+         self.logger.error("Cannot serve readings on {}:{}: {}".format(self.httpAddress or "*", self.httpPort, e))
+      return
+
+
+
+   def closeEndpoint(self):
+      ##########################################################################################
+      #
+      #   Stop the JSON endpoint, long-polls still waiting get an answer first
+      #
+      ##########################################################################################
+      endpoint = self.endpoint
+      self.endpoint = None
+      if endpoint is not None:
+         endpoint.close()
+      return
+
+
+
+   def endpointDocument(self, source):
+      ##########################################################################################
+      #
+      #   JSON document of one meter: its last reading, energy totals and demand. Runs on a
+      #   thread of the endpoint, once per telegram that someone asks for
+      #
+      ##########################################################################################
+      meter, reading = source
+      with meter.account.lock:
+         energy = [state for period in ('today', 'month', 'year') for state in meter.account.states(period)]
+      return {
+         'id':       meter.devId,
+         'name':     meter.name,
+         'reading':  dict((name, getattr(reading, name)) for name in Reading.__slots__),
+         'energy':   dict((state['key'], state['value']) for state in energy),
+         'demand':   dict((state['key'], state['value']) for state in meter.demand.states()),
+         'crc':      dict(meter.crcCounts),
+      }
+
+
+
+   def loadState(self):
+      ##########################################################################################
+      #
+      #   Read the snapshot of every meter written by saveState, so a restart continues where
+      #   the plugin stopped without reading anything back from the Indigo states. Converts
+      #   energy.json of older versions, which only had the energy accounts and demand
+      #
+      ##########################################################################################
+      path = os.path.join(self.dataFolder(), "state.json")
+      old = os.path.join(self.dataFolder(), "energy.json")
+      if not os.path.exists(path) and os.path.exists(old):
+         path = old
+      if not os.path.exists(path):
+         return {}
       try:
-         minUsedToday     = float(P1Dev.states['minUsedToday'])
-      except ValueError:
-         minUsedToday     = 0
-
-      if maxProducedToday < float(keys['kwh']['current_produced'])*1000:
-         maxProducedToday = float(keys['kwh']['current_produced'])*1000
-         maxProducedTime  = datetime.now().strftime('%H:%M:%S')
-
-      if maxUsedToday < float(keys['kwh']['current_consumed'])*1000:
-         maxUsedToday = float(keys['kwh']['current_consumed'])*1000
-         maxUsedTime  = datetime.now().strftime('%H:%M:%S')
-         
-      if minUsedToday > float(keys['kwh']['current_consumed'])*1000 and datetime.now().hour < 6:
-         minUsedToday = float(keys['kwh']['current_consumed'])*1000
-         minUsedTime  = datetime.now().strftime('%H:%M:%S')
-
-      # Reset Min and Max
-      if datetime.now().hour < 1 and self.reset_flag != datetime.now().day:  
-         self.verbose("Reset daily min and max counters")
-         minUsedToday            = float(sys.maxint)
-         maxUsedToday            = float(0)
-         maxProducedToday        = float(0)
-         minUsedTime             = datetime.now().strftime('%H:%M:%S')
-         maxUsedTime             = datetime.now().strftime('%H:%M:%S')
-         maxProducedTime         = datetime.now().strftime('%H:%M:%S')
-         self.reset_flag = datetime.now().day # Prevent resetting twice
+         with open(path) as f:
+            saved = dict((int(devId), state) for devId, state in json.load(f).items())
+      except (IOError, OSError, ValueError) as e:
+         self.logger.error("Cannot read the saved state from {}, starting over: {}".format(path, e))
+         return {}
+      for devId, state in saved.items():
+         if 'account' not in state:
+            saved[devId] = {'account': state, 'demand': state.pop('demand', None)}
+      return saved
+
+
+
+   def saveState(self, meter=None):
+      ##########################################################################################
+      #
+      #   Write the derived state of the meters: energy accounts with their period markers,
+      #   peak demand, daily extremes and the last reading. Done every stateInterval seconds,
+      #   when a period started or a new peak was set, and at shutdown. The file is replaced
+      #   in one rename, so a crash never leaves half of it behind
+      #
+      ##########################################################################################
+      path = os.path.join(self.dataFolder(), "state.json")
+      with self.stateLock:
+         for current in ([meter] if meter is not None else self.meters.values()):
+            self.savedState[current.devId] = current.snapshot()
+         try:
+            if not os.path.isdir(self.dataFolder()):
+               os.makedirs(self.dataFolder())
+            with open(path + ".new", "w") as f:
+               json.dump(dict((str(devId), state) for devId, state in self.savedState.items()), f, separators=(",", ":"))
+            os.rename(path + ".new", path)
+            self.stateSavedAt = time.time()
+         except (IOError, OSError) as e:
+            self.logger.error("Cannot save the state in {}: {}".format(path, e))
+      return
+
+
+
+   def store_indigo(self,P1Dev, meter, keys, window):
+      ##########################################################################################
+      #
+      #   Store the received packet in Indigo, together with the statistics over all telegrams
+      #   received since the previous update, the daily extremes, the energy totals per period
+      #   and the demand
+      #
+      ##########################################################################################
+      reading = keys.reading
+      energy = meter.account.take()[0]
+
+      sumup = int(reading.nowGenerated - reading.nowUsage)
+      if sumup > 0:
+         mstate = "Producing {} W".format(sumup)
+      else:
+         mstate = "Consuming {} W".format(0-sumup)
 
       self.verbose("Device summary state changed to " + mstate)
       self.verbose("Attempting to store values in Indigo")
 
-      P1Dev.updateStatesOnServer([
+      self.pushStates(P1Dev, keys.states() + [
 
-            {'key':'meterType',                  'value':keys['header']['meterType']},
-            {'key':'netManager',                 'value':keys['header']['netManager']},
-            {'key':'textMessage',                'value':keys['msg']['text']},
-            {'key':'meterID',                    'value':keys['kwh']['eid'].decode("hex")},
-            {'key':'checkSum',                   'value':""},
-            {'key':'dsmrVersion',                'value':keys['header']['dsmrVersion']},
-            {'key':'timestamp',                  'value':keys['header']['measured_at']},
-            {'key':'masterState',                'value':mstate},
+            {'key':'queueCoalesced',             'value':meter.coalesced},
+            {'key':'queueDropped',               'value':meter.dropped},
 
-            {'key':'currentTariff',              'value':keys['kwh']['tariff']},
-            {'key':'currentNowPhase1',           'value':keys['kwh']['phase1']['amps']},
-            {'key':'currentNowPhase2',           'value':keys['kwh']['phase2']['amps']},
-            {'key':'currentNowPhase3',           'value':keys['kwh']['phase3']['amps']},
-            {'key':'usedNowPhase1',              'value':float(keys['kwh']['phase1']['usedNow'])*1000},
-            {'key':'usedNowPhase2',              'value':float(keys['kwh']['phase2']['usedNow'])*1000},
-            {'key':'usedNowPhase3',              'value':float(keys['kwh']['phase3']['usedNow'])*1000},
-            {'key':'generatedNowPhase1',         'value':float(keys['kwh']['phase1']['producedNow'])*1000},
-            {'key':'generatedNowPhase2',         'value':float(keys['kwh']['phase2']['producedNow'])*1000},
-            {'key':'generatedNowPhase3',         'value':float(keys['kwh']['phase3']['producedNow'])*1000},
-
-            {'key':'outagesLongCount',           'value':keys['kwh']['outages']['longcount']},
-            {'key':'outagesLongRecentDuration',  'value':keys['kwh']['outages']['duration']},
-            {'key':'outagesLongRecentTimestamp', 'value':keys['kwh']['outages']['timestamp']},
-            {'key':'outagesShortCount',          'value':keys['kwh']['outages']['shortcount']},
-
-            {'key':'voltageNowPhase1',           'value':keys['kwh']['phase1']['volt']},
-            {'key':'voltageNowPhase2',           'value':keys['kwh']['phase2']['volt']},
-            {'key':'voltageNowPhase3',           'value':keys['kwh']['phase3']['volt']},
-            {'key':'voltageToHighCountPhase1',   'value':keys['kwh']['phase1']['swells']},
-            {'key':'voltageToHighCountPhase2',   'value':keys['kwh']['phase2']['swells']},
-            {'key':'voltageToHighCountPhase3',   'value':keys['kwh']['phase3']['swells']},
-            {'key':'voltageToLowCountPhase1',    'value':keys['kwh']['phase1']['saggs']},
-            {'key':'voltageToLowCountPhase2',    'value':keys['kwh']['phase2']['saggs']},
-            {'key':'voltageToLowCountPhase3',    'value':keys['kwh']['phase3']['saggs']},
- 
-            {'key':'usedT1',                     'value':keys['kwh']['low']['consumed']},
-            {'key':'usedT2',                     'value':keys['kwh']['high']['consumed']},
-            {'key':'generatedT1',                'value':keys['kwh']['low']['produced']},
-            {'key':'generatedT2',                'value':keys['kwh']['high']['produced']},
-
-            {'key':'nowGenerated',               'value':float(keys['kwh']['current_produced'])*1000},
-            {'key':'nowUnit',                    'value':"W"},
-            {'key':'nowUsage',                   'value':float(keys['kwh']['current_consumed'])*1000},
+            {'key':'crcValid',                   'value':meter.crcCounts[CRC_VALID]},
+            {'key':'crcInvalid',                 'value':meter.crcCounts[CRC_INVALID]},
+            {'key':'crcMissing',                 'value':meter.crcCounts[CRC_MISSING]},
+            {'key':'masterState',                'value':mstate},
             {'key':'nowSum',                     'value':sumup},
-            {'key':'tariffUnit',                 'value':"kWh"},
-
-            {'key':'gastimestamp',               'value':keys['gas']['measured_at']},
-            {'key':'gasused',                    'value':float(keys['gas']['total'])},
-            {'key':'gastariffUnit',              'value':keys['gas']['unit']},
-            {'key':'gasMeterID',                 'value':keys['gas']['eid'].decode("hex")},
-            {'key':'gasMeterType',               'value':keys['gas']['device_type']},
-            {'key':'gasValve',                   'value':keys['gas']['valve']},
-
-            {'key':'minUsedToday',               'value': minUsedToday},
-            {'key':'maxUsedToday',               'value': maxUsedToday},
-            {'key':'maxProducedToday',           'value': maxProducedToday},
-            {'key':'minUsedTime',                'value': minUsedTime},
-            {'key':'maxUsedTime',                'value': maxUsedTime},
-            {'key':'maxProducedTime',            'value': maxProducedTime}
-      ])
+
+            {'key':'windowTelegrams',            'value': window.usage.count},
+            {'key':'windowAvgUsage',             'value': round(window.usage.mean(), 1)},
+            {'key':'windowMinUsage',             'value': window.usage.minimum},
+            {'key':'windowMaxUsage',             'value': window.usage.maximum},
+            {'key':'windowAvgGenerated',         'value': round(window.generation.mean(), 1)},
+            {'key':'windowMaxGenerated',         'value': window.generation.maximum},
+            {'key':'windowUsedWh',               'value': round(window.usedWh, 3)},
+            {'key':'windowGeneratedWh',          'value': round(window.generatedWh, 3)}
+      ] + meter.extremes.states() + energy + meter.demand.states() + self.timingStatesList())
+
+      if meter.account.changed or meter.demand.changed:
+         self.saveState(meter)
 
       self.verbose("Store in Indigo finished")
       return
 
 
 
-   def readtelegram(self,P1Dev):
+   def pushStates(self, P1Dev, states):
       ##########################################################################################
       #
-      #   Read a complete telegram from meter
+      #   Send only the states that changed since the last push to this device. Every
+      #   fullRefresh minutes (0 = never) all states are sent again, see StateCache
       #
       ##########################################################################################
-      
-      if self.usbDevice == "None":
-         self.logger.info(u"Configuration not yet complete; Please specify which device to use")
+      changed, sent, refresh = self.pushedStates.changes(P1Dev.id, states, self.fullRefresh, time.time())
+      if changed:
+         started = TIMINGS.start()
+         P1Dev.updateStatesOnServer(changed)
+         TIMINGS.stop('push', started)
+         self.pushedStates.stored(P1Dev.id, changed)
+
+      self.verbose("Sent {} of {} states to Indigo{}".format(sent, len(states), " (full refresh)" if refresh else ""))
+      return sent
+
+
+
+   def meterFor(self, P1Dev):
+      ##########################################################################################
+      #
+      #   The Meter of a device. A changed connection in the device or plugin config replaces
+      #   it, which stops the reader that still uses the old settings. The new Meter continues
+      #   the totals of the old one, or those saved before a restart
+      #
+      ##########################################################################################
+      meter = self.meters.get(P1Dev.id)
+      settings = Meter.settings(self, P1Dev)
+      if meter is not None and meter.config == settings:
+         return meter
+
+      if meter is not None:
+         self.verbose("Connection of {} changed".format(meter.name))
+         self.stopReader(meter)
+      meter = self.meters[P1Dev.id] = Meter(self, P1Dev, settings, meter)
+      if self.endpoint is not None and meter.aggregator.last is not None:
+         # Clients get the last reading from before a restart until the first telegram
+         self.endpoint.update(meter.devId, (meter, meter.aggregator.last))
+      return meter
+
+
+
+   def startReader(self, meter):
+      ##########################################################################################
+      #
+      #   Start the long-lived reader of a meter if it is not running yet. All network meters
+      #   share one NetworkReader thread; when that thread died, a new one takes over all of
+      #   its sources and they connect again
+      #
+      ##########################################################################################
+      if meter.transport == "tcp":
+         if self.network is None or not self.network.is_alive():
+            sources = self.network.sources if self.network is not None else []
+            self.network = NetworkReader(self)
+            for source in sources:
+               source.close()
+               self.network.add(source)
+            self.network.start()
+         if meter.reader is None:
+            self.verbose("Starting network reader for {}:{}".format(meter.tcpHost, meter.tcpPort))
+            meter.reader = self.network.add(TcpSource(meter, meter.tcpHost, meter.tcpPort, handler=meter.receivedPacket))
+         return meter.reader
+
+      if meter.reader is not None and meter.reader.is_alive():
+         return meter.reader
+
+      self.verbose("Starting reader thread for {}".format(meter.usbDevice))
+      meter.reader = SmartMeterReader(meter, meter.usbDevice, handler=meter.receivedPacket, **meter.serialSettings())
+      meter.reader.start()
+      return meter.reader
+
+
+
+   def stopReader(self, meter):
+      ##########################################################################################
+      #
+      #   Stop the reader of a meter and release its serial port or network connection
+      #
+      ##########################################################################################
+      reader = meter.reader
+      if reader is None:
          return
 
-      if self.dsmrversion == "2":
-         # DSMR 2.2 > 9600 7E1:
-         meter = SmartMeter(self, 
-                    self.usbDevice,
-                    baudrate=9600,
-                    bytesize=7,
-                    parity="E",
-                    stopbits=1,
-                    xonxoff=0,
-                    timeout=10,
-         )
+      self.verbose("Stopping reader for {}".format(reader.port))
+      meter.reader = None
+      if isinstance(reader, TcpSource):
+         if self.network is not None:
+            try:
+               self.network.remove(reader)
+            except ValueError:
+               reader.close()
+         return
+      reader.stop()
+      reader.join(15)
+      return
 
-      if self.dsmrversion == "4":
-         # DSMR 4.0/4.2 > 115200 8N1:
-         meter = SmartMeter(self,
-                    self.usbDevice,
-                    baudrate=115200,
-                    bytesize=8,
-                    parity="N",
-                    stopbits=1,
-                    xonxoff=0,
-                    timeout=10,
-         )
 
+
+   def stopReaders(self):
+      ##########################################################################################
+      #
+      #   Stop the readers of all meters and the network thread
+      #
+      ##########################################################################################
+      for meter in self.meters.values():
+         self.stopReader(meter)
+      if self.network is not None:
+         self.network.stop()
+         self.network.join(15)
+         self.network = None
+      return
+
+
+
+   def readMeter(self, devId):
+      ##########################################################################################
+      #
+      #   Runs on a worker of the pool: one read cycle of one meter. The busy flag makes sure
+      #   a meter that hangs is not queued again before this cycle ends
+      #
+      ##########################################################################################
+      meter = self.meters.get(devId)
+      if meter is None:
+         return
+      started = TIMINGS.start()
       try:
-        packet = meter.read_one_packet()
-      except SerialException as e:
-        parser.error(e)
+         P1Dev = self.devices.get(devId)
+         if P1Dev is not None:
+            self.readtelegram(P1Dev, meter)
+            TIMINGS.stop('cycle', started)
+      except Exception as e:
+         # Keep the worker alive for the other meters
+         self.logger.error("Reading {} failed: {}".format(meter.name, e))
       finally:
-        meter.disconnect()
+         meter.busy = False
+      return
+
+
 
+   def readtelegram(self,P1Dev,meter):
+      ##########################################################################################
+      #
+      #   Read a complete telegram from meter
+      #
+      ##########################################################################################
+      
+      if not meter.configured():
+         self.logger.info(u"Configuration of {} not yet complete; Please specify which device to use".format(meter.name))
+         return
+
+      started = TIMINGS.start()
+      if meter.readMode == "stream" or meter.transport == "tcp" or self.schedule == "event":
+         # The reader thread keeps the port open and feeds every telegram to the aggregator,
+         # take the newest telegram it has framed. A network bridge is always read this way
+         reader = self.startReader(meter)
+         packet = reader.latest(meter.serialSettings()['timeout'])
+         if packet is None:
+            self.logger.warning("No telegram received from {}".format(reader.port))
+            return
+      else:
+         self.stopReader(meter)
+         connection = None
+         try:
+            connection = SmartMeter(meter, meter.usbDevice, **meter.serialSettings())
+            connection.previous = meter.previous
+            packet = meter.previous = connection.read_one_packet()
+            meter.countCrc(packet.crc)
+            meter.receivedPacket(packet)
+         except P1PacketError as e:
+            meter.countCrc(CRC_INVALID)
+            self.logger.warning("Dropped telegram from {}: {}".format(meter.usbDevice, e))
+            return
+         except (SmartMeterError, SerialException) as e:
+            self.logger.error("Reading telegram from {} failed: {}".format(meter.usbDevice, e))
+            return
+         finally:
+            if connection is not None:
+               connection.disconnect()
+
+      TIMINGS.stop('read', started)
+      # Storing in Indigo is up to the writer thread, this worker is done
+      self.writer.put(meter, packet)
+      return
+
+
+
+   def publish(self, P1Dev, meter, packet):
+      ##########################################################################################
+      #
+      #   Store a telegram in Indigo, with the statistics since the previous update
+      #
+      ##########################################################################################
       if self.show_raw == 1:
          self.logger.info("\n" + str(packet) + "\n") # Send output to console iso print
       
-      self.store_indigo(P1Dev,packet)
+      started = TIMINGS.start()
+      self.store_indigo(P1Dev, meter, packet, meter.aggregator.take())
+      TIMINGS.stop('store', started)
+      return
+
+
+
+   def publishQueued(self, meter, packet):
+      ##########################################################################################
+      #
+      #   Runs on the writer thread for every telegram taken from the PublishQueue
+      #
+      ##########################################################################################
+      P1Dev = self.devices.get(meter.devId)
+      if P1Dev is None:
+         # Device stopped while its telegram was waiting
+         return
+      self.publish(P1Dev, meter, packet)
+      return
+
+
+
+   def nextPublish(self, now):
+      ##########################################################################################
+      #
+      #   When a meter published at now is due again: publishInterval later. With alignTo set
+      #   it is the start of a whole minute or quarter-hour, publishInterval rounded to them
+      #
+      ##########################################################################################
+      if self.alignTo > 0:
+         steps = max(1, int(round(float(self.publishInterval) / self.alignTo)))
+         return (now // self.alignTo + steps) * self.alignTo
+      return now + self.publishInterval
+
+
+
+   def receivedPacket(self, meter, packet):
+      ##########################################################################################
+      #
+      #   Called for every telegram read, from the reader thread in stream mode. The exporters
+      #   get the readings of every meter with its device id. History and SQLite have no
+      #   column for the meter, so only meters on the plugin connection fill them
+      #
+      ##########################################################################################
+      meter.aggregator.add(packet.reading)
+      meter.extremes.add(packet.reading)
+      meter.account.add(packet.reading)
+      meter.demand.add(packet.reading)
+      endpoint = self.endpoint
+      if endpoint is not None:
+         endpoint.update(meter.devId, (meter, packet.reading))
+      for sink in self.sinks:
+         if not sink.tagged and meter.connection != "plugin":
+            continue
+         try:
+            sink.add(packet.reading, meter=meter.devId)
+         except (IOError, OSError) as e:
+            self.logger.error("Storing reading in {} failed: {}".format(sink.__class__.__name__, e))
+
+      if self.schedule == "event":
+         # Hand the telegram to the writer when the meter is due, the reader goes on reading
+         now = time.time()
+         if now >= meter.publishAt and self.writer is not None:
+            meter.publishAt = self.nextPublish(now)
+            self.writer.put(meter, packet)
       return
 
 
+
+   def replayTelegrams(self, valuesDict, typeId=""):
+      ##########################################################################################
+      #
+      #   Menu item: parse a file or folder of captured raw telegrams and write the readings
+      #   to the configured history, SQLite, InfluxDB and MQTT sinks
+      #
+      ##########################################################################################
+      errorsDict = indigo.Dict()
+      path = os.path.expanduser(str(valuesDict.get("replayPath","")).strip())
+      if not os.path.exists(path):
+         errorsDict["replayPath"] = "File or folder not found"
+      elif not self.sinks:
+         errorsDict["replayPath"] = "Enable history, SQLite, InfluxDB or MQTT in the plugin config first"
+      elif self.replay is not None and self.replay.is_alive():
+         errorsDict["replayPath"] = "A replay is still running"
+      meter = int(valuesDict.get("replayMeter") or 0) or None
+      if meter is None and any(sink.tagged for sink in self.sinks):
+         errorsDict["replayMeter"] = "Choose the meter the telegrams came from, InfluxDB and MQTT keep them apart"
+
+      if len(errorsDict) > 0:
+         return (False, valuesDict, errorsDict)
+
+      self.replay = Replay(path, self.sinks, self.logger, verify=bool(valuesDict.get("replayVerify",True)), meter=meter)
+      self.replay.start()
+      self.logger.info("Replaying telegrams from {}".format(path))
+      return True
+
+
+
+   def timingStatesList(self):
+      ##########################################################################################
+      #
+      #   p50, p95 and p99 in ms per stage as device states, when enabled in the plugin config
+      #
+      ##########################################################################################
+      if not self.timingStates:
+         return []
+      states = []
+      for stage, count, mean, p50, p95, p99, maximum in TIMINGS.summary():
+         name = 'timing' + stage.capitalize()
+         states += [{'key':name + 'P50', 'value':round(p50 * 1000, 2)},
+                    {'key':name + 'P95', 'value':round(p95 * 1000, 2)},
+                    {'key':name + 'P99', 'value':round(p99 * 1000, 2)}]
+      return states
+
+
+
+   def logTimings(self, valuesDict=None, typeId=""):
+      ##########################################################################################
+      #
+      #   Menu item: time spent per stage since the start or the last reset
+      #
+      ##########################################################################################
+      if not TIMINGS.enabled:
+         self.logger.info("Stage timings are not enabled in the plugin config")
+         return
+
+      lines = ["{:<8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+      for stage, count, mean, p50, p95, p99, maximum in TIMINGS.summary():
+         lines.append("{:<8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                      stage, count, mean * 1000, p50 * 1000, p95 * 1000, p99 * 1000, maximum * 1000))
+      self.logger.info("Stage timings:\n" + "\n".join(lines))
+      return
+
+
+
+   def resetTimings(self, valuesDict=None, typeId=""):
+      ##########################################################################################
+      #
+      #   Menu item: start the stage timings over
+      #
+      ##########################################################################################
+      TIMINGS.reset()
+      self.logger.info("Stage timings reset")
+      return
+
+
+
+   def logHistorySummary(self, valuesDict=None, typeId=""):
+      ##########################################################################################
+      #
+      #   Menu item: summary of today's history
+      #
+      ##########################################################################################
+      if self.history is None:
+         self.logger.info("History is not enabled in the plugin config")
+         return
+
+      day = time.strftime('%Y%m%d')
+      summary = self.history.summary(day)
+      if summary is None:
+         self.logger.info("No history for {} yet".format(day))
+         return
+
+      self.logger.info("History {}: {} readings {} - {}, used T1 {:.3f} T2 {:.3f} kWh, generated T1 {:.3f} T2 {:.3f} kWh, gas {:.3f} m3, peak usage {:.0f} W at {}".format(
+         day, summary['readings'],
+         time.strftime('%H:%M:%S', time.localtime(summary['first'])),
+         time.strftime('%H:%M:%S', time.localtime(summary['last'])),
+         summary['usedT1'], summary['usedT2'], summary['generatedT1'], summary['generatedT2'], summary['gasUsed'],
+         summary['maxUsage'], time.strftime('%H:%M:%S', time.localtime(summary['maxUsageAt']))))
+      return
+
+
+
    #def CheckDeviceVersion(self,P1Dev):
       ##########################################################################################
       #
@@ -412,6 +1125,45 @@ class Plugin(indigo.PluginBase):
       # End 1.0.5 specific
 
 
+   def readMeters(self, MasterDevList):
+      ##########################################################################################
+      #
+      #   Queue a read cycle for every meter on the worker pool. Each meter has its own port
+      #   and reader, so a slow or dead meter only delays itself. In the event schedule the
+      #   readers publish by themselves, so only make sure every one of them runs
+      #
+      ##########################################################################################
+      for devId in list(self.meters):
+         if devId not in MasterDevList:
+            self.stopReader(self.meters.pop(devId))
+
+      if self.pool is None or self.poolSize < len(MasterDevList):
+         if self.pool is not None:
+            self.pool.close()
+         self.poolSize = max(self.poolSize, len(MasterDevList))
+         self.pool = ThreadPool(self.poolSize)
+
+      for devId in MasterDevList:
+         P1Dev = self.devices.get(devId)
+         if P1Dev is None:
+            # Stopped since the list was taken
+            continue
+         meter = self.meterFor(P1Dev)
+         if self.schedule == "event":
+            if meter.configured():
+               self.startReader(meter)
+            else:
+               self.logger.info(u"Configuration of {} not yet complete; Please specify which device to use".format(meter.name))
+            continue
+         if meter.busy:
+            self.verbose("{} is still busy with its previous read, skipped".format(meter.name))
+            continue
+         meter.busy = True
+         self.pool.apply_async(self.readMeter, (devId,))
+      return
+
+
+
    def runConcurrentThread(self):
       ##########################################################################################
       #
@@ -426,17 +1178,15 @@ class Plugin(indigo.PluginBase):
             # Act for all defined Master Devices
             MasterDevList = self.GetMasterDevList()
             if len(MasterDevList) == 0:
-               self.logger.info("There is no P1 Device defined. Recreate please.")
+               self.logger.info("There is no P1 Device defined. Create one with the plugin menu item Create P1 Master Device.")
             else: 
-               if len(MasterDevList) > 1:
-                  self.verbose("Expecting exactly 1 P1 Device but found {}. Correct please".format(len(MasterDevList)))
-               else:
-                
-                  P1Dev = indigo.devices[MasterDevList[0]] 
-                  #self.CheckDeviceVersion(P1Dev)
-                  self.readtelegram(P1Dev) # And read the next telegram
+               self.readMeters(MasterDevList)
 
-            self.sleep(self.sleeptime) # Ready for now. Sleep again till next minute
+            if time.time() - self.stateSavedAt >= self.stateInterval:
+               self.saveState()
+
+            # Ready for now. Sleep again till next minute, or till the next check on the readers
+            self.sleep(self.watchInterval if self.schedule == "event" else self.sleeptime)
 
       except self.StopThread:
          pass
@@ -444,440 +1194,526 @@ class Plugin(indigo.PluginBase):
 
 
 
-##########################################################################################
-#
-#   SmartMeter class https://github.com/nrocco/smeterd/blob/master/smeterd/meter.py
-#
-# Copyright (c) 2013, Nico Di Rocco.
-#
-# Permission is hereby granted, free of charge, to any person obtaining a copy
-# of this software and associated documentation files (the "Software"), to deal
-# in the Software without restriction, including without limitation the rights
-# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-# copies of the Software, and to permit persons to whom the Software is
-# furnished to do so, subject to the following conditions:
-# 
-# The above copyright notice and this permission notice shall be included in
-# all copies or substantial portions of the Software.
-# 
-# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
-# THE SOFTWARE.
-#
-##########################################################################################
+class Meter(object):
+   ##########################################################################################
+   #
+   #   One p1meter device: its connection, reader, aggregator and counters. The connection
+   #   comes from the device config, or from the plugin config when it is set to "plugin".
+   #   Readers get the Meter as their Plugin, so CRC results are counted per meter
+   #
+   ##########################################################################################
 
-class SmartMeter(object):
-   serial_defaults = {
-       'baudrate': 9600,
-       'bytesize': serial.SEVENBITS,
-       'parity': serial.PARITY_EVEN,
-       'stopbits': serial.STOPBITS_ONE,
-       'xonxoff': False,
-       'timeout': 10,
-   }
+   def __init__(self, Plugin, P1Dev, config, previous=None):
+      self.Plugin = Plugin
+      self.logger = Plugin.logger
+      self.max_telegram_size = Plugin.max_telegram_size
+      self.devId = P1Dev.id
+      self.name = P1Dev.name
+      self.config = config
+      self.connection, self.transport, self.usbDevice, self.tcpHost, self.tcpPort, self.dsmrversion, self.readMode = config
+      self.reader = None                 # Long-lived reader when readMode is stream or on TCP
+      self.busy = False                  # A read cycle is queued or running on the pool
+      self.publishAt = 0                 # Event schedule: time the next telegram gets published
+      self.previous = None               # Cycle mode: last telegram read, see P1Packet(previous)
+      self.coalesced = 0                 # Telegrams replaced by a newer one before they were published
+      self.dropped = 0                   # Telegrams not published because the PublishQueue was full
+      self.crcCounts = {CRC_VALID: 0, CRC_INVALID: 0, CRC_MISSING: 0}
+      self.aggregator = Aggregator()
+      if previous is not None:
+         # Same device with a new connection
+         self.account = previous.account
+         self.demand = previous.demand
+         self.extremes = previous.extremes
+         self.aggregator.last = previous.aggregator.last
+      else:
+         saved = Plugin.savedState.get(P1Dev.id) or {}
+         self.account = EnergyAccount(saved.get('account'))
+         self.demand = PeakDemand(saved.get('demand'))
+         self.extremes = DailyExtremes(saved.get('extremes'))
+         if saved.get('reading'):
+            self.aggregator.last = Reading(**saved['reading'])
 
 
 
-   def __init__(self, Plugin, port, **kwargs):
-      ##########################################################################################
-      #
-      #   Initalization of the indigo base plugin and on top of it our plugin
-      #
-      ##########################################################################################
-      config = {}
-      config.update(self.serial_defaults)
-      config.update(kwargs)
-      self.Plugin = Plugin
-      Plugin.verbose("Open serial connect to {} with: {}".format(port, ", ".join("{}={}".format(key, value) for key, value in config.items())))
+   @staticmethod
+   def settings(Plugin, P1Dev):
+      # (connection, transport, usbDevice, tcpHost, tcpPort, dsmrversion, readMode) of a device
+      props = P1Dev.pluginProps
+      connection = props.get("connection", "plugin")
+      if connection == "plugin":
+         return (connection, Plugin.transport, Plugin.usbDevice, Plugin.tcpHost, Plugin.tcpPort,
+                 Plugin.dsmrversion, Plugin.readMode)
+      return (connection, connection, props.get("usbDevice_uiAddress", "None"),
+              str(props.get("tcpHost", "")).strip(), int(props.get("tcpPort", 23)),
+              str(props.get("dsmrversion", "4")), str(props.get("readMode", "cycle")))
 
-      try:
-         self.serial = serial.Serial(port, **config)
-      except (serial.SerialException,OSError) as e:
-         raise SmartMeterError(e)
-      else:
-         self.serial.setRTS(False)
-         self.port = self.serial.name
 
-      Plugin.verbose("New serial connection opened to {}".format(self.serial.name))
 
+   def verbose(self, logtext):
+      self.Plugin.verbose(logtext)
 
 
-   def connect(self):
-      if not self.serial.isOpen():
-         Plugin.verbose("Opening connection to '{}'".format(self.serial.name))
-         self.serial.open()
-         self.serial.setRTS(False)
-      else:
-         self.Plugin.verbose("'{}' was already open".format(self.serial.name))
 
+   def configured(self):
+      # A serial port or bridge host has been chosen
+      if self.transport == "tcp":
+         return bool(self.tcpHost)
+      return self.usbDevice != "None"
 
 
-   def disconnect(self):
-      if self.serial.isOpen():
-         self.Plugin.verbose("Closing connection to '{}'".format(self.serial.name))
-         self.serial.close()
-      else:
-         self.Plugin.verbose("'{}' was already closed".format(self.serial.name))
 
+   def serialSettings(self):
+      # Serial port settings for the DSMR version of this meter
+      if self.dsmrversion == "2":
+         # DSMR 2.2 > 9600 7E1:
+         return dict(baudrate=9600,
+                     bytesize=7,
+                     parity="E",
+                     stopbits=1,
+                     xonxoff=0,
+                     timeout=10,
+         )
 
+      # DSMR 4.0/4.2 > 115200 8N1:
+      return dict(baudrate=115200,
+                  bytesize=8,
+                  parity="N",
+                  stopbits=1,
+                  xonxoff=0,
+                  timeout=10,
+      )
 
-   def connected(self):
-      return self.serial.isOpen()
 
 
+   def receivedPacket(self, packet):
+      self.Plugin.receivedPacket(self, packet)
 
-   def read_one_packet(self):
-      datagram = b''
-      testgram = b''
-      lines_read = 0
-      startFound = False
-      endFound = False
 
-      self.Plugin.verbose("Start reading lines")
 
-      while not startFound or not endFound or lines_read < Plugin.max_telegram_length:
-         try:
-            line = self.serial.readline()
-            #self.Plugin.verbose("{}".format(line.decode('ascii').rstrip()))
-         except Exception as e:
-            self.Plugin.verbose(e)
-            self.Plugin.verbose("Read a total of {} lines".format(lines_read))
-            raise SmartMeterError(e)
-
-         lines_read += 1
-
-         if re.match(b'.*(?=/)', line):
-            startFound = True
-            endFound = False
-            datagram = line.lstrip()
-         elif re.match(b'(?=!)', line):
-            endFound = True
-            datagram = datagram + line
-         else:
-            datagram = datagram + line
-
-      self.Plugin.verbose("Total lines read from serial port: {}".format(lines_read))
-
-      # Test datagram for playing with the data when errors occur. Example live data
-      testgram = ("/Ene5\T210-D ESMR5.0\n\n" + 
-                 "1-3:0.2.8(50)\n"  + 
-                 "0-0:1.0.0(210106101849W)\n" +
-                 "0-0:96.1.1(4530303438303030303235313238343138)\n" +
-                 "1-0:1.8.1(007342.728*kWh)\n" +
-                 "1-0:1.8.2(003622.485*kWh)\n" +
-                 "1-0:2.8.1(001312.715*kWh)\n" +
-                 "1-0:2.8.2(003168.188*kWh)\n" +
-                 "0-0:96.14.0(0002)\n" +
-                 "1-0:1.7.0(01.971*kW)\n" +
-                 "1-0:2.7.0(00.000*kW)\n" +
-                 "0-0:96.7.21(00994)\n" +
-                 "0-0:96.7.9(00006)\n" +
-                 "1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)\n" +
-                 "1-0:32.32.0(00002)\n" +
-                 "1-0:52.32.0(00002)\n" +
-                 "1-0:72.32.0(00002)\n" +
-                 "1-0:32.36.0(00000)\n" +
-                 "1-0:52.36.0(00000)\n" +
-                 "1-0:72.36.0(00000)\n" +
-                 "0-0:96.13.0()\n" +
-                 "1-0:32.7.0(229.0*V)\n" +
-                 "1-0:52.7.0(233.0*V)\n" +
-                 "1-0:72.7.0(238.0*V)\n" +
-                 "1-0:31.7.0(008*A)\n" +
-                 "1-0:51.7.0(001*A)\n" +
-                 "1-0:71.7.0(001*A)\n" +
-                 "1-0:21.7.0(01.793*kW)\n" +
-                 "1-0:41.7.0(00.126*kW)\n" +
-                 "1-0:61.7.0(00.051*kW)\n" +
-                 "1-0:22.7.0(00.000*kW)\n" +
-                 "1-0:42.7.0(00.000*kW)\n" +
-                 "1-0:62.7.0(00.000*kW)\n" +
-                  "0-1:24.1.0(003)\n" +
-                  "0-1:96.1.0(4730303538353330303337363337333139)\n" +
-                  "0-1:24.2.1(210106101500W)(02247.105*m3)\n"
-                 "!80B2\n")
-      #datagram = testgram
-      if datagram == testgram:
-         self.Plugin.verbose("--> Running with test telegram data")
-
-      self.Plugin.verbose("Done reading one packet (containing {} lines)".format(len(datagram.splitlines())))
-      self.Plugin.verbose("Constructing P1Packet from raw data")
-      
-      return P1Packet(datagram)
+   def snapshot(self):
+      # Everything derived from the telegrams so far, see Plugin.saveState
+      last = self.aggregator.last
+      return {'account':  self.account.snapshot(),
+              'demand':   self.demand.snapshot(),
+              'extremes': self.extremes.snapshot(),
+              'reading':  None if last is None else dict((name, getattr(last, name)) for name in Reading.__slots__)}
 
-   def __enter__(self):
-      return self
 
-   def __exit__(self, type, value, traceback):
-      self.disconnect()
 
+   def countCrc(self, result):
+      # Count a telegram by CRC result. Reported on the p1meter device with the next update
+      self.crcCounts[result] += 1
+      if result == CRC_INVALID:
+         self.verbose("CRC counters of {}: {}".format(self.name, self.crcCounts))
 
 
-class SmartMeterError(Exception):
-   pass
 
+def _view(data, start, end):
+   # Zero-copy slice of a mmap: memoryview where mmap supports it, buffer on Python 2
+   try:
+      return memoryview(data)[start:end]
+   except TypeError:
+      return buffer(data, start, end - start)
 
 
-class P1PacketError(Exception):
-   pass
 
+def _record_offsets(fields):
+   # name -> (struct for that field, offset in the record)
+   offsets = {}
+   layout = '<'
+   for name, code in fields:
+      offsets[name] = (struct.Struct('<' + code), struct.calcsize(layout))
+      layout += code
+   return offsets
 
 
-class P1Packet(object):
-   _datagram = ''
 
-   def __init__(self, datagram):
-      self._datagram = datagram
+class HistoryStore(object):
+   ##########################################################################################
+   #
+   #   Append-only history of readings, one file per day (YYYYMMDD.p1h) holding fixed-width
+   #   records. New records are packed into a bytearray and written in blocks. Reads map a
+   #   day file with mmap and hand out slices of it; only the fields asked for get unpacked
+   #
+   ##########################################################################################
+   fields = (('timestamp', 'I'), ('tariff', 'H'),
+             ('usedT1', 'd'), ('usedT2', 'd'), ('generatedT1', 'd'), ('generatedT2', 'd'),
+             ('nowUsage', 'f'), ('nowGenerated', 'f'),
+             ('usedNowPhase1', 'f'), ('usedNowPhase2', 'f'), ('usedNowPhase3', 'f'),
+             ('generatedNowPhase1', 'f'), ('generatedNowPhase2', 'f'), ('generatedNowPhase3', 'f'),
+             ('voltageNowPhase1', 'f'), ('voltageNowPhase2', 'f'), ('voltageNowPhase3', 'f'),
+             ('currentNowPhase1', 'f'), ('currentNowPhase2', 'f'), ('currentNowPhase3', 'f'),
+             ('gasUsed', 'd'), ('gasTimestamp', 'I'))
+   names = tuple(name for name, code in fields)
+   record = struct.Struct('<' + ''.join(code for name, code in fields))
+   offsets = _record_offsets(fields)
+   block_records = 60                    # Records buffered before they are written...
+   block_seconds = 300                   # ...or seconds, whichever comes first
+   tagged        = False                 # No column for the meter, see Plugin.receivedPacket
+
+   def __init__(self, folder):
+      self.folder = folder
+      self.lock = threading.Lock()
+      self.pending = bytearray()
+      self.pendingDay = None
+      self.pendingSince = 0
+      self.closed = False
+      if not os.path.isdir(folder):
+         os.makedirs(folder)
+
+
+
+   def path(self, day):
+      return os.path.join(self.folder, day + ".p1h")
+
+
+
+   def add(self, reading, wait=False, meter=None):
+      day = time.strftime('%Y%m%d', time.localtime(reading.timestamp))
+      record = self.record.pack(*[getattr(reading, name) for name in self.names])
+      with self.lock:
+         if self.closed:
+            return
+         if day != self.pendingDay:
+            self._flush()
+            self.pendingDay = day
+         if not self.pending:
+            self.pendingSince = time.time()
+         self.pending += record
+         if len(self.pending) >= self.block_records * self.record.size or time.time() - self.pendingSince >= self.block_seconds:
+            self._flush()
+
+
+
+   def flush(self):
+      with self.lock:
+         self._flush()
+
+
+
+   def _flush(self):
+      if not self.pending:
+         return
+      with open(self.path(self.pendingDay), 'ab') as f:
+         partial = f.tell() % self.record.size
+         if partial:
+            # Left over from a crash halfway a write, keep the records aligned
+            f.truncate(f.tell() - partial)
+            f.seek(0, os.SEEK_END)
+         f.write(self.pending)
+      del self.pending[:]
 
-      #self.validate()
 
-      keys = {}
-      keys['header'] = {}
-      keys['msg'] = {}
-      keys['kwh'] = {}
-      keys['kwh']['low'] = {}
-      keys['kwh']['high'] = {}
-      keys['kwh']['outages'] = {}
-      keys['kwh']['phase1'] = {}
-      keys['kwh']['phase2'] = {}
-      keys['kwh']['phase3'] = {}
-      
-      # /Ene5\T210-D ESMR5.0
-      #  ^^^
-      keys['header']['netManager'] =   self.get(b'^/s*(.{3})')
 
-      # /Ene5\T210-D ESMR5.0
-      #       ^^^^^^
-      keys['header']['meterType'] =    self.get(b'^(?:/s*.{3}.{2})(\S*)(?:.*)')
+   def close(self):
+      with self.lock:
+         self._flush()
+         self.closed = True
 
-      # 1-3:0.2.8(50)
-      #           ^^
-      keys['header']['dsmrVersion'] =  self.get(b'^(?:1\-3\:0\.2\.8\()(.*)(?:\))')
 
-      # 0-0:1.0.0(200411171526S)
-      #           ^^^^^^^^^^^^
-      keys['header']['measured_at'] =  self.ts(b'^(?:0-0:1\.0\.0\()(\d*)')
 
-      # 0-0:96.1.1(4530303438303030303235313238343138)
-      #            ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
-      keys['kwh']['eid'] =             self.get(b'^0-0:96\.1\.1\(([^)]+)\)')
+   def open_day(self, day):
+      # Read-only map of a day file, None if there is no history for that day
+      self.flush()
+      path = self.path(day)
+      if not os.path.exists(path) or os.path.getsize(path) < self.record.size:
+         return None
+      with open(path, 'rb') as f:
+         return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-      # 0-0:96.14.0(0001)
-      #             ^^^^
-      keys['kwh']['tariff'] =          self.get_int(b'^0-0:96\.14\.0\(([0-9]+)\)')
 
-      # 0-0:96.3.10(?)
-      #             ^
-      keys['kwh']['switch'] =          self.get_int(b'^0-0:96\.3\.10\((\d)\)')
 
-      # 0-0:17.0.0(????.??*kW)
-      #            ^^^^^^^
-      keys['kwh']['treshold'] =        self.get_float(b'^0-0:17\.0\.0\(([0-9]{4}\.[0-9]{2})\*kW\)')
+   def count(self, data):
+      return len(data) // self.record.size
+
+
+
+   def find(self, data, timestamp):
+      # Index of the first record at or after timestamp, binary search on the timestamps
+      size = self.record.size
+      low, high = 0, self.count(data)
+      while low < high:
+         middle = (low + high) // 2
+         if struct.unpack_from('<I', data, middle * size)[0] < timestamp:
+            low = middle + 1
+         else:
+            high = middle
+      return low
+
+
+
+   def slice(self, data, start=None, end=None):
+      # Records from start up to end (epoch seconds) as a view on the map, nothing is copied
+      size = self.record.size
+      first = 0 if start is None else self.find(data, start)
+      last = self.count(data) if end is None else self.find(data, end)
+      return _view(data, first * size, max(first, last) * size)
+
+
+
+   def reading(self, data, index):
+      # Unpack a single record
+      return Reading(**dict(zip(self.names, self.record.unpack_from(data, index * self.record.size))))
+
+
+
+   def column(self, data, name):
+      # All values of one field, e.g. nowUsage for a chart
+      field, offset = self.offsets[name]
+      size = self.record.size
+      return [field.unpack_from(data, index * size + offset)[0] for index in range(self.count(data))]
+
+
+
+   def summary(self, day):
+      # Energy per register from the first and last record of the day, and the peak usage
+      data = self.open_day(day)
+      if data is None:
+         return None
+      try:
+         first = self.reading(data, 0)
+         last = self.reading(data, self.count(data) - 1)
+         usage = self.column(data, 'nowUsage')
+         peak = usage.index(max(usage))
+         summary = {
+            'readings':    len(usage),
+            'first':       first.timestamp,
+            'last':        last.timestamp,
+            'usedT1':      last.usedT1 - first.usedT1,
+            'usedT2':      last.usedT2 - first.usedT2,
+            'generatedT1': last.generatedT1 - first.generatedT1,
+            'generatedT2': last.generatedT2 - first.generatedT2,
+            'gasUsed':     last.gasUsed - first.gasUsed,
+            'maxUsage':    usage[peak],
+            'maxUsageAt':  struct.unpack_from('<I', data, peak * self.record.size)[0],
+         }
+      finally:
+         data.close()
+      return summary
 
-      # 1-0:1.8.1(004486.031*kWh)
-      #           ^^^^^^^^^^
-      keys['kwh']['low']['consumed'] =  self.get(b'^1-0:1\.8\.1\(([0-9]+\.[0-9]+)\*kWh\)')
-      
-      # 1-0:2.8.1(000732.442*kWh)
-      #           ^^^^^^^^^^
-      keys['kwh']['low']['produced'] =  self.get(b'^1-0:2\.8\.1\(([0-9]+\.[0-9]+)\*kWh\)')
 
-       # 1-0:1.8.2(002272.913*kWh)
-      #           ^^^^^^^^^^
-      keys['kwh']['high']['consumed'] = self.get(b'^1-0:1\.8\.2\(([0-9]+\.[0-9]+)\*kWh\)')
-      
-      # 1-0:2.8.2(001838.277*kWh)
-      #           ^^^^^^^^^^
-      keys['kwh']['high']['produced'] = self.get(b'^1-0:2\.8\.2\(([0-9]+\.[0-9]+)\*kWh\)')
-
-      # 1-0:1.7.0(00.000*kW)
-      #           ^^^^^^^^^^
-      keys['kwh']['current_consumed'] = self.get(b'^1-0:1\.7\.0\(([0-9]+\.[0-9]+)\*kW\)')
-
-      # 1-0:2.7.0(02.403*kW)
-      #           ^^^^^^^^^^
-      keys['kwh']['current_produced'] = self.get(b'^1-0:2\.7\.0\(([0-9]+\.[0-9]+)\*kW\)')
-
-      # 0-0:96.7.21(00673)
-      #             ^^^^^
-      keys['kwh']['outages']['shortcount'] = int(self.get(b'^0-0:96\.7\.21\((\d*)'))
-
-      # 0-0:96.7.9(00006)
-      #             ^^^^^
-      keys['kwh']['outages']['longcount'] = int(self.get(b'^0-0:96\.7\.9\((\d*)'))
-
-      # 1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)
-      #                             ^^^^^^^^^^^^^
-      keys['kwh']['outages']['timestamp'] = self.ts(b'^(?:1-0:99\.97\.0\([0-9*]\)\(0-0\:96\.7\.19\)\()(\d*)')
-
-      # 1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)
-      #                                           ^^^^^^^^^^
-      keys['kwh']['outages']['duration'] = int(self.get(b'^(?:1-0:99\.97\.0\([0-9*]\)\(0-0\:96\.7\.19\)\()\d*[SW]\)\((\d*)'))
-
-      # 1-0:32.32.0(00002)
-      #             ^^^^^
-      keys['kwh']['phase1']['saggs'] = int(self.get(b'^(?:1-0:32\.32\.0\()(\d*)'))
-
-      # 1-0:52.32.0(00002)
-      #             ^^^^^
-      keys['kwh']['phase2']['saggs'] = int(self.get(b'^(?:1-0:52\.32\.0\()(\d*)'))
-
-      # 1-0:72.32.0(00002)
-      #             ^^^^^
-      keys['kwh']['phase3']['saggs'] = int(self.get(b'^(?:1-0:72\.32\.0\()(\d*)'))
-
-      # 1-0:32.36.0(00000)
-      #             ^^^^^
-      keys['kwh']['phase1']['swells'] = int(self.get(b'^(?:1-0:32\.36\.0\()(\d*)'))
-
-      # 1-0:52.36.0(00000)
-      #             ^^^^^
-      keys['kwh']['phase2']['swells'] = int(self.get(b'^(?:1-0:52\.36\.0\()(\d*)'))
-
-      # 1-0:72.36.0(00000)
-      #             ^^^^^
-      keys['kwh']['phase3']['swells'] = int(self.get(b'^(?:1-0:72\.36\.0\()(\d*)'))
-
-      # 1-0:32.7.0(235.0*V)
-      #            ^^^^^
-      keys['kwh']['phase1']['volt'] = int(self.get(b'^(?:1-0:32\.7\.0\()(\d*)'))
-
-      # 1-0:52.7.0(233.0*V)
-      #            ^^^^^
-      keys['kwh']['phase2']['volt'] = int(self.get(b'^(?:1-0:52\.7\.0\()(\d*)'))
-
-      # 1-0:72.7.0(238.0*V)
-      #            ^^^^^
-      keys['kwh']['phase3']['volt'] = int(self.get(b'^(?:1-0:72\.7\.0\()(\d*)'))
-
-      # 1-0:31.7.0(003*A)
-      #            ^^^
-      keys['kwh']['phase1']['amps'] = int(self.get(b'^(?:1-0:31\.7\.0\()(\d*)'))
-
-      # 1-0:51.7.0(003*A)
-      #            ^^^
-      keys['kwh']['phase2']['amps'] = int(self.get(b'^(?:1-0:51\.7\.0\()(\d*)'))
-
-      # 1-0:71.7.0(004*A)
-      #            ^^^
-      keys['kwh']['phase3']['amps'] = int(self.get(b'^(?:1-0:71\.7\.0\()(\d*)'))
-
-      # 1-0:21.7.0(00.000*kW)
-      #            ^^^^^^
-      keys['kwh']['phase1']['usedNow'] = self.get(b'^(?:1-0:21\.7\.0\()(\d*\.\d*)')
-
-      # 1-0:41.7.0(00.000*kW)
-      #            ^^^^^^
-      keys['kwh']['phase2']['usedNow'] = self.get(b'^(?:1-0:41\.7\.0\()(\d*\.\d*)')
-
-      # 1-0:61.7.0(00.000*kW)
-      #            ^^^^^^
-      keys['kwh']['phase3']['usedNow'] = self.get(b'^(?:1-0:61\.7\.0\()(\d*\.\d*)')
-
-      # 1-0:22.7.0(00.768*kW)
-      #            ^^^^^^
-      keys['kwh']['phase1']['producedNow'] = self.get(b'^(?:1-0:22\.7\.0\()(\d*\.\d*)')
-
-      # 1-0:42.7.0(00.699*kW)
-      #            ^^^^^^
-      keys['kwh']['phase2']['producedNow'] = self.get(b'^(?:1-0:42\.7\.0\()(\d*\.\d*)')
-
-      # 1-0:62.7.0(00.935*kW)
-      #            ^^^^^^
-      keys['kwh']['phase3']['producedNow'] = self.get(b'^(?:1-0:62\.7\.0\()(\d*\.\d*)')
-
-      keys['gas'] = {}
-      # 0-1:24.2.1(200411171500S)(00889.906*m3)
-      #                                     ^^
-      keys['gas']['unit'] = self.get(b'^(?:0-1:24\.2\.1(?:\(\d+[SW]\))?)?\([0-9]{5}\.[0-9]{3}(?:\*(\S*))\)', 0)
-
-      # 0-1:96.1.0(4730303538353330303337363337333139)
-      #            ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
-      keys['gas']['eid'] = self.get(b'^0-1:96\.1\.0\(([^)]+)\)',"30")
-
-      # 0-1:24.1.0(003)
-      #            ^^^
-      keys['gas']['device_type'] = self.get_int(b'^0-1:24\.1\.0\((\d)+\)',0)
-      
-      # 0-1:24.2.1(200411171500S)(00889.906*m3)
-      #            ^^^^^^^^^^^^^
-      keys['gas']['measured_at'] = self.ts(b'^(?:0-1:24\.[23]\.[01](?:\((\d+)[SW]?\))?)')
 
-      # 0-1:24.2.1(200411171500S)(00889.906*m3)
-      #                           ^^^^^^^^^
-      keys['gas']['total'] = self.get(b'^(?:0-1:24\.2\.1(?:\(\d+[SW]\))?)?\(([0-9]{5}\.[0-9]{3})(?:\*m3)\)', 0)
+class SqliteSink(threading.Thread):
+   ##########################################################################################
+   #
+   #   Writes readings to a SQLite database from its own thread. add() only puts the reading
+   #   on a bounded queue and never blocks the reader; when the queue is full the reading is
+   #   dropped and counted. The writer uses WAL mode and commits one executemany transaction
+   #   every batch_rows readings or batch_seconds seconds
+   #
+   ##########################################################################################
+   batch_rows    = 300                   # Readings per transaction...
+   batch_seconds = 10                    # ...or seconds, whichever comes first
+   queue_size    = 10000                 # Readings waiting for the writer before dropping
+   tagged        = False                 # No column for the meter, see Plugin.receivedPacket
+
+   def __init__(self, path, logger):
+      threading.Thread.__init__(self, name="P1 SQLite writer")
+      self.daemon = True
+      self.path = path
+      self.logger = logger
+      self.queue = Queue.Queue(self.queue_size)
+      self.stopping = threading.Event()
+      self.written = 0
+      self.dropped = 0
+      self.start()
+
+
+
+   def add(self, reading, wait=False, meter=None):
+      # wait is for backfilling, where readings come faster than any database can take them
+      try:
+         self.queue.put(reading, wait)
+      except Queue.Full:
+         self.dropped += 1
+
+
+
+   def close(self):
+      self.stopping.set()
+      self.join(30)
+      if self.dropped:
+         self.logger.warning("SQLite writer dropped {} readings because it could not keep up".format(self.dropped))
+
+
+
+   def connect(self):
+      folder = os.path.dirname(self.path)
+      if folder and not os.path.isdir(folder):
+         os.makedirs(folder)
+      db = sqlite3.connect(self.path)
+      db.execute("PRAGMA journal_mode=WAL")
+      db.execute("PRAGMA synchronous=NORMAL")
+      db.execute("CREATE TABLE IF NOT EXISTS readings (timestamp INTEGER PRIMARY KEY, tariff INTEGER, {})".format(
+                 ", ".join("{} REAL".format(name) for name in Reading.__slots__[2:])))
+      db.execute("CREATE INDEX IF NOT EXISTS readings_gastimestamp ON readings (gasTimestamp)")
+      db.commit()
+      return db
 
-      # 0-1:24.4.0(????)
-      #            ^^^^
-      keys['gas']['valve'] = self.get_int(b'^0-1:24\.4\.0\((\d)\)',0)
 
-      # 0-0:96.13.1( )
-      #             ^
-      keys['msg']['code'] = self.get(b'^0-0:96\.13\.1\((\d+)\)')
 
-      # 0-0:96.13.0( )
-      #             ^
-      keys['msg']['text'] = self.get(b'^0-0:96\.13\.0\((.+)\)','')
+   def run(self):
+      try:
+         db = self.connect()
+      except (sqlite3.Error, OSError) as e:
+         self.logger.error("Cannot open SQLite database {}: {}".format(self.path, e))
+         return
 
-      self._keys = keys
+      insert = "INSERT OR REPLACE INTO readings ({}) VALUES ({})".format(
+               ", ".join(Reading.__slots__), ", ".join("?" * len(Reading.__slots__)))
+      batch = []
+      deadline = 0
 
+      while True:
+         stopping = self.stopping.is_set()
+         try:
+            if stopping:
+               reading = self.queue.get_nowait()
+            else:
+               reading = self.queue.get(timeout=1)
+            batch.append(tuple(getattr(reading, name) for name in Reading.__slots__))
+            if len(batch) == 1:
+               deadline = time.time() + self.batch_seconds
+         except Queue.Empty:
+            if stopping:
+               self.commit(db, insert, batch)
+               break
 
+         if len(batch) >= self.batch_rows or (batch and time.time() >= deadline):
+            self.commit(db, insert, batch)
+            batch = []
 
-   def __getitem__(self, key):
-      return self._keys[key]
+      db.close()
 
 
 
-   def get_float(self, regex, default=None):
-      result = self.get(regex, None)
-      if not result:
-         return default
-         return float(result)
+   def commit(self, db, insert, batch):
+      if not batch:
+         return
+      try:
+         with db:
+            db.executemany(insert, batch)
+         self.written += len(batch)
+      except sqlite3.Error as e:
+         self.logger.error("Writing {} readings to {} failed: {}".format(len(batch), self.path, e))
 
 
 
-   def get_int(self, regex, default=None):
-      result = self.get(regex, None)
-      if not result:
-         return default
-      return int(result)
+class Replay(threading.Thread):
+   ##########################################################################################
+   #
+   #   Backfill from captured raw telegrams: a file, or a folder of files read in name order.
+   #   Captures are read in chunks and cut into telegrams by a FrameAssembler, so their size
+   #   does not matter. Telegrams are parsed in batches across a process pool; the next
+   #   batch is read while the previous one is parsed. A heap holds back reorder readings
+   #   so they reach the sinks in time order
+   #
+   ##########################################################################################
+   chunk_size = 1 << 20                  # Bytes read from a capture at a time
+   batch_size = 5000                     # Telegrams per batch for the process pool
+   reorder    = 10000                    # Readings held back to sort them by time
+
+   def __init__(self, path, sinks, logger, verify=True, processes=None, meter=None):
+      threading.Thread.__init__(self, name="P1 replay")
+      self.daemon = True
+      self.path = path
+      self.sinks = sinks
+      self.meter = meter                 # Device id of the meter the capture came from
+      self.logger = logger
+      self.verify = verify
+      self.processes = processes or multiprocessing.cpu_count()
+      self.stopping = threading.Event()
+      self.frames = 0
+      self.written = 0
+      self.rejected = 0
+
+
+
+   def files(self):
+      if not os.path.isdir(self.path):
+         return [self.path]
+      names = sorted(name for name in os.listdir(self.path) if not name.startswith('.'))
+      return [os.path.join(self.path, name) for name in names if os.path.isfile(os.path.join(self.path, name))]
+
+
+
+   def batches(self):
+      batch = []
+      for path in self.files():
+         assembler = FrameAssembler()
+         with open(path, 'rb') as capture:
+            while not self.stopping.is_set():
+               data = capture.read(self.chunk_size)
+               if not data:
+                  break
+               assembler.feed(data)
+               for frame in assembler.frames():
+                  batch.append((frame, self.verify))
+                  if len(batch) >= self.batch_size:
+                     yield batch
+                     batch = []
+      if batch:
+         yield batch
+
+
+
+   def run(self):
+      started = time.time()
+      pool = multiprocessing.Pool(self.processes)
+      held = []
+      finished = False
+      try:
+         pending = None
+         for batch in self.batches():
+            job = pool.map_async(parse_frame, batch, max(1, len(batch) // (self.processes * 4)))
+            self.frames += len(batch)
+            if pending is not None:
+               self.collect(pending.get(), held)
+            pending = job
+            if self.stopping.is_set():
+               break
+         if pending is not None and not self.stopping.is_set():
+            self.collect(pending.get(), held)
+         while held and not self.stopping.is_set():
+            self.write(heapq.heappop(held))
+         finished = not self.stopping.is_set()
+      except (IOError, OSError) as e:
+         self.logger.error("Replay of {} failed: {}".format(self.path, e))
+      except Exception:
+         # Raised in a worker or by a sink, the replay cannot go on
+         self.logger.exception("Replay of {} failed".format(self.path))
+      finally:
+         if finished:
+            pool.close()
+         else:
+            # Stopped or failed, parses still running are of no use
+            pool.terminate()
+         pool.join()
 
+      self.logger.info("Replay of {} finished: {} telegrams, {} readings written, {} rejected in {:.1f} s".format(
+                       self.path, self.frames, self.written, self.rejected, time.time() - started))
 
 
-   def get(self, regex, default=None):
-      results = re.search(regex, self._datagram, re.MULTILINE)
-      if not results:
-         return default
-      return results.group(1).decode('ascii')
 
+   def collect(self, results, held):
+      for values, error in results:
+         if values is None:
+            self.rejected += 1
+            continue
+         heapq.heappush(held, (values[0], self.frames + len(held), values))
+         if len(held) > self.reorder:
+            self.write(heapq.heappop(held))
 
-   def ts(self,regex, default=None):
-      results = self.get(regex, None)
-      if not results:
-         return None 
-      v = results
-      if len(v) != 12:
-         return None 
-      return  "20{}-{}-{}T{}:{}:{}".format(v[0:2],v[2:4],v[4:6],v[6:8],v[8:10],v[10:12])
-   def validate(self):
-      pattern = re.compile(b'\r\n(?=!)')
-      for match in pattern.finditer(self._datagram):
-         packet = self._datagram[:match.end() + 1]
-         checksum = self._datagram[match.end() + 1:]
 
-      if checksum.strip():
-         given_checksum = int('0x' + checksum.decode('ascii').strip(), 16)
-         #calculated_checksum = crc16(packet)
 
-         #if given_checksum != calculated_checksum:
-            #Plugin.verbose("Checksum mismatch: given={}, calculated={}".format(given_checksum, calculated_checksum))
-            #raise P1PacketError("P1Packet with invalid checksum found")
+   def write(self, item):
+      reading = Reading(**dict(zip(Reading.__slots__, item[2])))
+      for sink in self.sinks:
+         sink.add(reading, wait=True, meter=self.meter)
+      self.written += 1
 
 
 
-   def __str__(self):
-       return self._datagram.decode('ascii')
+   def stop(self):
+      self.stopping.set()
+      self.join(30)
@@ -0,0 +1,1478 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Meter side of the P1 Meter plugin: reading telegrams from the serial port, framing,
+#   CRC checking and parsing them. Nothing in here depends on Indigo, so the scripts in
+#   tools/ can load it as well
+#
+##########################################################################################
+
+import sys
+import binascii
+import serial
+from serial.serialutil import SerialException
+import errno
+import socket
+import select
+import threading
+import itertools
+import time
+import calendar
+import bisect
+from time import mktime
+from timeit import default_timer
+
+
+
+
+##########################################################################################
+#
+#   SmartMeter class https://github.com/nrocco/smeterd/blob/master/smeterd/meter.py
+#
+# Copyright (c) 2013, Nico Di Rocco.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+##########################################################################################
+
+class SmartMeter(object):
+   serial_defaults = {
+       'baudrate': 9600,
+       'bytesize': serial.SEVENBITS,
+       'parity': serial.PARITY_EVEN,
+       'stopbits': serial.STOPBITS_ONE,
+       'xonxoff': False,
+       'timeout': 10,
+   }
+
+
+
+   def __init__(self, Plugin, port, **kwargs):
+      ##########################################################################################
+      #
+      #   Initalization of the indigo base plugin and on top of it our plugin
+      #
+      ##########################################################################################
+      config = {}
+      config.update(self.serial_defaults)
+      config.update(kwargs)
+      self.Plugin = Plugin
+      Plugin.verbose("Open serial connect to {} with: {}".format(port, ", ".join("{}={}".format(key, value) for key, value in config.items())))
+
+      try:
+         self.serial = serial.Serial(port, **config)
+      except (serial.SerialException,OSError) as e:
+         raise SmartMeterError(e)
+      else:
+         self.clearRTS()
+         self.port = self.serial.name
+
+      self.assembler = FrameAssembler(Plugin.max_telegram_size)
+      self.previous = None               # Last telegram read, lines it shares are not parsed again
+      Plugin.verbose("New serial connection opened to {}".format(self.serial.name))
+
+
+
+   def connect(self):
+      if not self.serial.isOpen():
+         self.Plugin.verbose("Opening connection to '{}'".format(self.serial.name))
+         self.serial.open()
+         self.clearRTS()
+      else:
+         self.Plugin.verbose("'{}' was already open".format(self.serial.name))
+
+
+
+   def clearRTS(self):
+      # A pty or a network bridge has no modem control lines
+      try:
+         self.serial.setRTS(False)
+      except (IOError, OSError) as e:
+         self.Plugin.verbose("Cannot clear RTS on '{}': {}".format(self.serial.name, e))
+
+
+
+   def disconnect(self):
+      if self.serial.isOpen():
+         self.Plugin.verbose("Closing connection to '{}'".format(self.serial.name))
+         self.serial.close()
+      else:
+         self.Plugin.verbose("'{}' was already closed".format(self.serial.name))
+
+
+
+   def connected(self):
+      return self.serial.isOpen()
+
+
+
+   def read_one_packet(self):
+      # Read whatever the port has waiting until the assembler holds a complete telegram.
+      # Data after that telegram stays buffered for the next call
+      bytes_read = 0
+
+      self.Plugin.verbose("Start reading telegram")
+
+      datagram = self.assembler.next_frame()
+      while datagram is None:
+         started = TIMINGS.start()
+         try:
+            data = self.serial.read(self.serial.inWaiting() or 1)
+         except Exception as e:
+            self.Plugin.verbose(e)
+            self.Plugin.verbose("Read a total of {} bytes".format(bytes_read))
+            raise SmartMeterError(e)
+         finally:
+            TIMINGS.stop('wait', started)
+
+         if not data:
+            raise SmartMeterError("No telegram received from {} within {} s".format(self.port, self.serial.timeout))
+
+         bytes_read += len(data)
+         started = TIMINGS.start()
+         self.assembler.feed(data)
+         datagram = self.assembler.next_frame()
+         TIMINGS.stop('frame', started)
+
+      self.Plugin.verbose("Total bytes read from serial port: {}".format(bytes_read))
+
+      #datagram = TESTGRAM
+      if datagram == TESTGRAM:
+         self.Plugin.verbose("--> Running with test telegram data")
+
+      self.Plugin.verbose("Done reading one packet (containing {} lines)".format(datagram.count(b'\n')))
+      self.Plugin.verbose("Constructing P1Packet from raw data")
+      
+      packet = P1Packet(datagram, previous=self.previous)
+      self.previous = packet
+      return packet
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, type, value, traceback):
+      self.disconnect()
+
+
+
+class Frame(bytes):
+   # A telegram cut by a FrameAssembler, with the CRC16 up to and including the ! already
+   # calculated on the assembler's buffer. None when the telegram has no CRC trailer
+   crc16 = None
+
+
+
+class FrameAssembler(object):
+   ##########################################################################################
+   #
+   #   Cuts a byte stream into telegrams. Received data is appended to one reusable bytearray
+   #   and the / and !XXXX<CR><LF> boundaries are found with find(), so a telegram may span
+   #   any number of reads. Bytes outside a telegram (a start in the middle of a frame, line
+   #   noise) are dropped. The CRC is calculated while the telegram is still in the buffer,
+   #   so P1Packet.validate() does not need a copy of it
+   #
+   ##########################################################################################
+
+   def __init__(self, max_size=8192):
+      self.buffer = bytearray()
+      self.max_size = max_size
+      self.discarded = 0                 # Bytes dropped outside complete telegrams
+
+
+
+   def feed(self, data):
+      self.buffer += data
+
+
+
+   def next_frame(self):
+      # Oldest complete telegram as a Frame, or None when more data is needed
+      buf = self.buffer
+      while True:
+         start = buf.find(b'/')
+         if start < 0:
+            self.drop(len(buf))
+            return None
+
+         end = buf.find(b'!', start)
+         if end >= 0:
+            break
+         if len(buf) - start <= self.max_size:
+            self.drop(start)
+            return None
+         # No end in sight, try again from the next start of a telegram that still fits
+         self.drop(max(start + 1, len(buf) - self.max_size))
+
+      restart = buf.rfind(b'/', start + 1, end)
+      if restart >= 0:
+         # The end of the previous telegram got lost, only the last start is complete
+         start = restart
+
+      eol = buf.find(b'\n', end)
+      if eol < 0:
+         self.drop(start)
+         return None
+
+      frame = Frame(buf[start:eol + 1])
+      if eol - end > 2:
+         started = TIMINGS.start()
+         frame.crc16 = crc16(buf, start, end + 1)
+         TIMINGS.stop('crc', started)
+      self.discarded += start
+      del buf[:eol + 1]
+      return frame
+
+
+
+   def frames(self):
+      # All complete telegrams currently buffered
+      frame = self.next_frame()
+      while frame is not None:
+         yield frame
+         frame = self.next_frame()
+
+
+
+   def drop(self, count):
+      if count > 0:
+         self.discarded += count
+         del self.buffer[:count]
+
+
+
+class PacketHandoff(object):
+   ##########################################################################################
+   #
+   #   Hands every telegram of a reader to its handler and keeps the newest one for the
+   #   Indigo side, see latest(). Needs handler, packet, packets, lock and received
+   #
+   ##########################################################################################
+
+   def handoff(self, packet):
+      if self.handler is not None:
+         self.handler(packet)
+      with self.lock:
+         self.packet = packet
+         self.packets += 1
+      self.received.set()
+
+
+
+   def latest(self, timeout=None):
+      # Newest telegram not handed out before, waiting up to timeout seconds for one
+      if not self.received.wait(timeout):
+         return None
+      with self.lock:
+         packet = self.packet
+         self.packet = None
+         self.received.clear()
+      return packet
+
+
+
+class SmartMeterReader(threading.Thread, PacketHandoff):
+   ##########################################################################################
+   #
+   #   Reader thread owning the serial port. The port stays open and every telegram is
+   #   framed as it arrives and passed to handler; the Indigo side picks up the newest one
+   #   with latest()
+   #
+   ##########################################################################################
+   retry_delay = 10                      # Seconds between reconnect attempts
+
+   def __init__(self, Plugin, port, handler=None, **kwargs):
+      threading.Thread.__init__(self, name="P1 reader {}".format(port))
+      self.daemon = True
+      self.Plugin = Plugin
+      self.port = port
+      self.handler = handler
+      self.config = kwargs
+      self.meter = None
+      self.packet = None
+      self.packets = 0
+      self.lock = threading.Lock()
+      self.received = threading.Event()
+      self.stopping = threading.Event()
+
+
+
+   def run(self):
+      while not self.stopping.is_set():
+         try:
+            if self.meter is None:
+               self.meter = SmartMeter(self.Plugin, self.port, **self.config)
+            packet = self.meter.read_one_packet()
+         except P1PacketError as e:
+            # Corrupted telegram, the connection itself is fine
+            self.Plugin.countCrc(CRC_INVALID)
+            self.Plugin.verbose("Dropped telegram from {}: {}".format(self.port, e))
+            continue
+         except (SmartMeterError, SerialException) as e:
+            if self.stopping.is_set():
+               break
+            self.Plugin.logger.error("Reading from {} failed, reconnecting in {} s: {}".format(self.port, self.retry_delay, e))
+            self.close()
+            self.stopping.wait(self.retry_delay)
+            continue
+         except (ValueError, TypeError) as e:
+            # Framed but incomplete telegram, keep the connection and wait for the next one
+            self.Plugin.logger.warning("Skipping unreadable telegram from {}: {}".format(self.port, e))
+            continue
+
+         self.Plugin.countCrc(packet.crc)
+         try:
+            self.handoff(packet)
+         except Exception:
+            # A failing handler must not end the reader, the next telegram may well get through
+            self.Plugin.logger.exception("Handling a telegram from {} failed".format(self.port))
+
+      self.close()
+      self.Plugin.verbose("Reader thread for {} stopped after {} telegrams".format(self.port, self.packets))
+
+
+
+   def close(self):
+      meter = self.meter
+      self.meter = None
+      if meter is not None:
+         try:
+            meter.disconnect()
+         except (SerialException, OSError):
+            pass
+
+
+
+   def stop(self):
+      # Closing the port also wakes up a blocking read
+      self.stopping.set()
+      self.close()
+
+
+
+class TcpSource(PacketHandoff):
+   ##########################################################################################
+   #
+   #   A P1 telegram stream over TCP: ser2net, an Ethernet or WiFi P1 bridge. The socket is
+   #   non-blocking and driven by a NetworkReader, which can serve many sources from one
+   #   thread. Received data goes through a FrameAssembler just like serial data. Lost
+   #   connections are retried with exponential backoff, and a connection that stays silent
+   #   for idle_timeout is treated as lost: meters send every 1 or 10 seconds, and a
+   #   half-open connection would otherwise never report an error
+   #
+   ##########################################################################################
+   connect_timeout = 10                  # Seconds for a connection attempt
+   idle_timeout    = 60                  # Seconds without data before reconnecting
+   min_backoff     = 1                   # Seconds before the first reconnect attempt
+   max_backoff     = 60                  # Longest wait between reconnect attempts
+   keepalive       = (30, 10, 3)         # TCP keepalive idle time, interval and probes
+
+   def __init__(self, Plugin, host, port, handler=None):
+      self.Plugin = Plugin
+      self.address = (host, int(port))
+      self.port = "{}:{}".format(host, port)
+      self.handler = handler
+      self.sock = None
+      self.connecting = False
+      self.since = 0                     # Start of the connection attempt, or last data
+      self.retry_at = 0
+      self.backoff = self.min_backoff
+      self.assembler = FrameAssembler(Plugin.max_telegram_size)
+      self.previous = None               # Last telegram parsed, lines it shares are not parsed again
+      self.packet = None
+      self.packets = 0
+      self.lock = threading.Lock()
+      self.received = threading.Event()
+
+
+
+   def fileno(self):
+      return self.sock.fileno()
+
+
+
+   def connect(self, now):
+      # Start a non-blocking connect; the NetworkReader waits for it to become writable.
+      # The host name lookup itself still blocks
+      try:
+         family, socktype, proto, name, address = socket.getaddrinfo(self.address[0], self.address[1], 0, socket.SOCK_STREAM)[0]
+         sock = socket.socket(family, socktype, proto)
+      except socket.error as e:
+         self.fail(now, e)
+         return
+
+      sock.setblocking(False)
+      self.setKeepalive(sock)
+      result = sock.connect_ex(address)
+      self.sock = sock
+      self.since = now
+      if result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+         self.connecting = True
+      elif result == 0:
+         self.connected(now)
+      else:
+         self.fail(now, socket.error(result, errno.errorcode.get(result, "connect failed")))
+
+
+
+   def setKeepalive(self, sock):
+      idle, interval, count = self.keepalive
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+      # TCP_KEEPIDLE is called TCP_KEEPALIVE (0x10) on macOS
+      options = ((getattr(socket, "TCP_KEEPIDLE", 0x10 if sys.platform == "darwin" else None), idle),
+                 (getattr(socket, "TCP_KEEPINTVL", None), interval),
+                 (getattr(socket, "TCP_KEEPCNT", None), count))
+      for option, value in options:
+         if option is not None:
+            try:
+               sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except socket.error:
+               pass
+
+
+
+   def writable(self, now):
+      # A pending connect finished, successfully or not
+      error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+         self.fail(now, socket.error(error, errno.errorcode.get(error, "connect failed")))
+      else:
+         self.connected(now)
+
+
+
+   def connected(self, now):
+      self.connecting = False
+      self.since = now
+      self.Plugin.verbose("Connected to {}".format(self.port))
+
+
+
+   def readable(self, now):
+      try:
+         data = self.sock.recv(65536)
+      except socket.error as e:
+         if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return
+         self.fail(now, e)
+         return
+
+      if not data:
+         self.fail(now, "connection closed by the other side")
+         return
+
+      self.since = now
+      started = TIMINGS.start()
+      self.assembler.feed(data)
+      frames = list(self.assembler.frames())
+      TIMINGS.stop('frame', started)
+      for frame in frames:
+         try:
+            packet = P1Packet(frame, previous=self.previous)
+         except P1PacketError as e:
+            self.Plugin.countCrc(CRC_INVALID)
+            self.Plugin.verbose("Dropped telegram from {}: {}".format(self.port, e))
+            continue
+         except (ValueError, TypeError) as e:
+            self.Plugin.logger.warning("Skipping unreadable telegram from {}: {}".format(self.port, e))
+            continue
+         self.backoff = self.min_backoff
+         self.previous = packet
+         self.Plugin.countCrc(packet.crc)
+         try:
+            self.handoff(packet)
+         except Exception:
+            # Same as SmartMeterReader: the connection is fine, go on with the next telegram
+            self.Plugin.logger.exception("Handling a telegram from {} failed".format(self.port))
+
+
+
+   def check(self, now):
+      # Give up on connections that take too long or went silent
+      if self.connecting and now - self.since > self.connect_timeout:
+         self.fail(now, "no connection within {} s".format(self.connect_timeout))
+      elif not self.connecting and now - self.since > self.idle_timeout:
+         self.fail(now, "no data received for {} s".format(self.idle_timeout))
+
+
+
+   def fail(self, now, reason):
+      self.close()
+      self.retry_at = now + self.backoff
+      self.Plugin.logger.error("Connection to {} failed, reconnecting in {} s: {}".format(self.port, self.backoff, reason))
+      self.backoff = min(self.backoff * 2, self.max_backoff)
+
+
+
+   def close(self):
+      sock = self.sock
+      self.sock = None
+      self.connecting = False
+      if sock is not None:
+         sock.close()
+      self.assembler.drop(len(self.assembler.buffer))
+
+
+
+class NetworkReader(threading.Thread):
+   ##########################################################################################
+   #
+   #   One thread serving any number of TcpSources with select(). Nothing in the loop
+   #   blocks on a single connection, apart from host name lookups. Only this thread closes
+   #   the sockets while it runs: remove() queues the source, as it may be in a select()
+   #
+   ##########################################################################################
+   tick = 1.0                            # Longest select() wait, for timeouts and stop()
+
+   def __init__(self, Plugin):
+      threading.Thread.__init__(self, name="P1 network reader")
+      self.daemon = True
+      self.Plugin = Plugin
+      self.sources = []
+      self.removed = []                  # Sources to close in the next round
+      self.serving = False               # run() closes removed sources
+      self.lock = threading.Lock()
+      self.stopping = threading.Event()
+
+
+
+   def add(self, source):
+      with self.lock:
+         self.sources.append(source)
+      return source
+
+
+
+   def remove(self, source):
+      with self.lock:
+         self.sources.remove(source)
+         if self.serving:
+            self.removed.append(source)
+            return
+      source.close()
+
+
+
+   def run(self):
+      with self.lock:
+         self.serving = True
+      while not self.stopping.is_set():
+         now = time.time()
+         timeout = self.tick
+         readers = []
+         writers = []
+         with self.lock:
+            sources = list(self.sources)
+            removed, self.removed = self.removed, []
+         for source in removed:
+            source.close()
+         for source in sources:
+            if source.sock is None:
+               if now >= source.retry_at:
+                  self.serve(source, source.connect, now)
+               else:
+                  timeout = min(timeout, source.retry_at - now)
+            if source.sock is not None:
+               (writers if source.connecting else readers).append(source)
+
+         if not readers and not writers:
+            self.stopping.wait(timeout)
+            continue
+
+         try:
+            readable, writable, failed = select.select(readers, writers, [], timeout)
+         except (select.error, socket.error, ValueError) as e:
+            self.Plugin.verbose("select() on network sources failed: {}".format(e))
+            continue
+
+         now = time.time()
+         with self.lock:
+            # Sources removed during the select() get no more telegrams
+            active = set(self.sources)
+         for source in writable:
+            if source.sock is not None and source in active:
+               self.serve(source, source.writable, now)
+         for source in readable:
+            if source.sock is not None and source in active:
+               self.serve(source, source.readable, now)
+         for source in sources:
+            if source.sock is not None and source in active:
+               self.serve(source, source.check, now)
+
+      with self.lock:
+         self.serving = False
+         for source in self.sources + self.removed:
+            source.close()
+         self.removed = []
+      self.Plugin.verbose("Network reader stopped")
+
+
+
+   def serve(self, source, step, now):
+      # An unexpected error in one source must not end the thread and silence all others.
+      # The source starts over with a new connection after its backoff
+      try:
+         step(now)
+      except Exception as e:
+         self.Plugin.logger.exception("Network source {} failed".format(source.port))
+         source.fail(now, e)
+
+
+
+   def stop(self):
+      self.stopping.set()
+
+
+
+class SmartMeterError(Exception):
+   pass
+
+
+
+class P1PacketError(Exception):
+   pass
+
+
+
+##########################################################################################
+#
+#   Stage timings: how long waiting on the meter, framing, CRC checking, parsing and
+#   storing in Indigo take. Each stage has a histogram with fixed buckets, so recording a
+#   time is a bisect and a counter increment and percentiles come from the bucket counts
+#
+##########################################################################################
+
+# Monotonic where Python has one (3.3 and later), otherwise the best clock timeit knows
+clock = getattr(time, 'monotonic', default_timer)
+
+
+class Histogram(object):
+   # Upper bounds of the buckets in seconds, 1-2-5 steps from 10 us up to 100 s
+   bounds = tuple(step * 10 ** exponent / 1e6 for exponent in range(1, 8) for step in (1, 2, 5)) + (1e2,)
+
+   def __init__(self):
+      self.counts = [0] * (len(self.bounds) + 1)
+      self.count = 0
+      self.total = 0.0
+      self.maximum = 0.0
+
+
+
+   def add(self, seconds):
+      self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+      self.count += 1
+      self.total += seconds
+      if seconds > self.maximum:
+         self.maximum = seconds
+
+
+
+   def percentile(self, fraction):
+      # Upper bound of the bucket holding that fraction of the times, the maximum for the
+      # last bucket. So p95 = 0.005 means 95% took 5 ms or less
+      if not self.count:
+         return 0.0
+      wanted = fraction * self.count
+      seen = 0
+      for bucket, count in enumerate(self.counts):
+         seen += count
+         if seen >= wanted:
+            return min(self.bounds[bucket], self.maximum) if bucket < len(self.bounds) else self.maximum
+      return self.maximum
+
+
+
+   def mean(self):
+      if not self.count:
+         return 0.0
+      return self.total / self.count
+
+
+
+class StageTimings(object):
+   ##########################################################################################
+   #
+   #   Histograms per stage. start() returns None while disabled and stop() returns right
+   #   away on it, so a disabled stage costs two calls and no clock reads:
+   #
+   #      started = TIMINGS.start()
+   #      ...
+   #      TIMINGS.stop('parse', started)
+   #
+   ##########################################################################################
+   stages = ('wait', 'frame', 'crc', 'parse', 'read', 'store', 'push', 'cycle')
+
+   def __init__(self, enabled=False):
+      self.enabled = enabled
+      self.lock = threading.Lock()
+      self.reset()
+
+
+
+   def reset(self):
+      with self.lock:
+         self.histograms = dict((stage, Histogram()) for stage in self.stages)
+
+
+
+   def start(self):
+      if not self.enabled:
+         return None
+      return clock()
+
+
+
+   def stop(self, stage, started):
+      if started is None:
+         return
+      elapsed = clock() - started
+      with self.lock:
+         self.histograms[stage].add(elapsed)
+
+
+
+   def summary(self):
+      # (stage, count, mean, p50, p95, p99, max) per stage, times in seconds
+      with self.lock:
+         return [(stage, h.count, h.mean(), h.percentile(0.5), h.percentile(0.95), h.percentile(0.99), h.maximum)
+                 for stage, h in ((stage, self.histograms[stage]) for stage in self.stages)]
+
+
+# Shared by everything in the plugin process, enabled from the plugin config
+TIMINGS = StageTimings()
+
+
+
+# Test datagram for playing with the data when errors occur. Example live data
+TESTGRAM = (b"/Ene5\\T210-D ESMR5.0\r\n\r\n" +
+            b"1-3:0.2.8(50)\r\n" +
+            b"0-0:1.0.0(210106101849W)\r\n" +
+            b"0-0:96.1.1(4530303438303030303235313238343138)\r\n" +
+            b"1-0:1.8.1(007342.728*kWh)\r\n" +
+            b"1-0:1.8.2(003622.485*kWh)\r\n" +
+            b"1-0:2.8.1(001312.715*kWh)\r\n" +
+            b"1-0:2.8.2(003168.188*kWh)\r\n" +
+            b"0-0:96.14.0(0002)\r\n" +
+            b"1-0:1.7.0(01.971*kW)\r\n" +
+            b"1-0:2.7.0(00.000*kW)\r\n" +
+            b"0-0:96.7.21(00994)\r\n" +
+            b"0-0:96.7.9(00006)\r\n" +
+            b"1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)\r\n" +
+            b"1-0:32.32.0(00002)\r\n" +
+            b"1-0:52.32.0(00002)\r\n" +
+            b"1-0:72.32.0(00002)\r\n" +
+            b"1-0:32.36.0(00000)\r\n" +
+            b"1-0:52.36.0(00000)\r\n" +
+            b"1-0:72.36.0(00000)\r\n" +
+            b"0-0:96.13.0()\r\n" +
+            b"1-0:32.7.0(229.0*V)\r\n" +
+            b"1-0:52.7.0(233.0*V)\r\n" +
+            b"1-0:72.7.0(238.0*V)\r\n" +
+            b"1-0:31.7.0(008*A)\r\n" +
+            b"1-0:51.7.0(001*A)\r\n" +
+            b"1-0:71.7.0(001*A)\r\n" +
+            b"1-0:21.7.0(01.793*kW)\r\n" +
+            b"1-0:41.7.0(00.126*kW)\r\n" +
+            b"1-0:61.7.0(00.051*kW)\r\n" +
+            b"1-0:22.7.0(00.000*kW)\r\n" +
+            b"1-0:42.7.0(00.000*kW)\r\n" +
+            b"1-0:62.7.0(00.000*kW)\r\n" +
+            b"0-1:24.1.0(003)\r\n" +
+            b"0-1:96.1.0(4730303538353330303337363337333139)\r\n" +
+            b"0-1:24.2.1(210106101500W)(02247.105*m3)\r\n" +
+            b"!80B2\r\n")
+
+
+
+##########################################################################################
+#
+#   CRC16/ARC (polynomial 0xA001 reflected, initial value 0) as used in the !XXXX trailer of
+#   DSMR 4 and 5 telegrams. It covers everything from the / up to and including the !
+#
+##########################################################################################
+
+CRC_VALID   = "valid"
+CRC_INVALID = "invalid"
+CRC_MISSING = "missing"
+
+
+def _crc16_table():
+   table = []
+   for byte in range(256):
+      crc = byte
+      for bit in range(8):
+         if crc & 1:
+            crc = (crc >> 1) ^ 0xA001
+         else:
+            crc >>= 1
+      table.append(crc)
+   return table
+
+CRC16_TABLE = _crc16_table()
+
+
+if bytes is str:
+   # Python 2 iterates a str as characters, only a bytearray copy gives the byte values
+   _byte_values = bytearray
+else:
+   def _byte_values(data):
+      return data
+
+
+def crc16(data, start=0, end=None):
+   # data is a bytearray, or bytes under Python 3; islice walks the range without copying it
+   table = CRC16_TABLE
+   crc = 0
+   for byte in itertools.islice(data, start, end):
+      crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+   return crc
+
+
+
+##########################################################################################
+#
+#   Value converters for the OBIS table in P1Packet. Each one gets the value groups of a
+#   line, e.g. [b'210106101500W', b'02247.105*m3'], and returns the field value. SKIP means
+#   the line does not have the expected format; a later line with the same code may still
+#   provide the value, just like a regex search over the whole datagram would
+#
+##########################################################################################
+
+SKIP = object()
+
+
+def _leading_digits(value):
+   end = 0
+   while end < len(value) and value[end:end+1].isdigit():
+      end += 1
+   return value[:end]
+
+
+def _timestamp(value):
+   # 200411171526S -> 2020-04-11T17:15:26
+   v = _leading_digits(value).decode('ascii')
+   if len(v) != 12:
+      return None
+   return "20{}-{}-{}T{}:{}:{}".format(v[0:2],v[2:4],v[4:6],v[6:8],v[8:10],v[10:12])
+
+
+def _number(value, unit):
+   # 004486.031*kWh -> 004486.031 when the unit matches
+   number, star, given = value.partition(b'*')
+   if given != unit or b'.' not in number or not number.replace(b'.', b'', 1).isdigit():
+      return SKIP
+   return number.decode('ascii')
+
+
+def _text(groups):
+   return groups[0].decode('ascii')
+
+
+def _filled(groups):
+   if not groups[0]:
+      return SKIP
+   return groups[0].decode('ascii')
+
+
+def _digits(groups):
+   if not groups[0].isdigit():
+      return SKIP
+   return groups[0].decode('ascii')
+
+
+def _int(groups):
+   if not groups[0].isdigit():
+      return SKIP
+   return int(groups[0])
+
+
+def _digit(groups):
+   if len(groups[0]) != 1 or not groups[0].isdigit():
+      return SKIP
+   return int(groups[0])
+
+
+def _count(groups):
+   # 00002 or 229.0*V -> leading integer part
+   digits = _leading_digits(groups[0])
+   if not digits:
+      return SKIP
+   return int(digits)
+
+
+def _decimal(groups):
+   # 01.793*kW -> 01.793
+   number = groups[0].partition(b'*')[0]
+   if b'.' not in number:
+      return SKIP
+   return number.decode('ascii')
+
+
+def _kwh(groups):
+   return _number(groups[0], b'kWh')
+
+
+def _kw(groups):
+   return _number(groups[0], b'kW')
+
+
+def _threshold(groups):
+   value = _number(groups[0], b'kW')
+   if value is SKIP:
+      return SKIP
+   return float(value)
+
+
+def _ts(groups):
+   return _timestamp(groups[0])
+
+
+def _outage_ts(groups):
+   # (1)(0-0:96.7.19)(180806173744S)(0000000737*s)
+   if len(groups) < 4 or groups[1] != b'0-0:96.7.19':
+      return SKIP
+   return _timestamp(groups[2])
+
+
+def _outage_duration(groups):
+   if len(groups) < 4 or groups[1] != b'0-0:96.7.19':
+      return SKIP
+   return int(_leading_digits(groups[3]) or 0)
+
+
+
+# Converters for the Reading fields, producing numbers instead of strings
+
+def _epoch(value):
+   # 210106101849W -> seconds since 1970 UTC. S is summer time (UTC+2), W winter time (UTC+1),
+   # without a letter (DSMR 2.2) the local time of this Mac is assumed
+   digits = _leading_digits(value)
+   if len(digits) != 12:
+      return SKIP
+   stamp = (2000 + int(digits[0:2]), int(digits[2:4]), int(digits[4:6]),
+            int(digits[6:8]), int(digits[8:10]), int(digits[10:12]), 0, 0, -1)
+   dst = value[12:13]
+   if dst == b'S':
+      return calendar.timegm(stamp) - 7200
+   if dst == b'W':
+      return calendar.timegm(stamp) - 3600
+   return int(mktime(stamp))
+
+
+def _epoch_ts(groups):
+   return _epoch(groups[0])
+
+
+# FROM_TEXT marks a field converted from the text of the field before it, which already
+# checked the unit and format: the number comes from that text instead of the groups
+FROM_TEXT = True
+
+
+def _kwh_number(text):
+   # '004486.031' -> 4486.031
+   return float(text)
+
+
+def _watts_number(text):
+   # '01.971' kW -> 1971.0
+   return float(text) * 1000
+
+
+def _float(groups):
+   # 229.0*V -> 229.0
+   try:
+      return float(groups[0].partition(b'*')[0])
+   except ValueError:
+      return SKIP
+
+
+def _mbus_value(groups):
+   # (210106101500W)(02247.105*m3) -> ('02247.105', 'm3'). DSMR 2.2 sends the unit as a
+   # group of its own and the value on the next line, which parse() adds as the last group:
+   # (120517020000)(08)(60)(1)(0-1:24.2.1)(m3)(00124.477)
+   number, star, unit = groups[-1].partition(b'*')
+   if not star and len(groups) >= 7:
+      unit = groups[5]
+   try:
+      float(number)
+   except ValueError:
+      return SKIP
+   return number.decode('ascii'), unit.decode('ascii')
+
+
+
+def _unhex(value):
+   # Equipment identifiers are sent as hex encoded ASCII
+   if not value:
+      return value
+   return binascii.unhexlify(value).decode('ascii', 'replace')
+
+
+
+class Reading(object):
+   ##########################################################################################
+   #
+   #   One telegram as flat, already converted numbers: power in W, energy in kWh, gas in m3,
+   #   voltage in V, current in A and timestamps in seconds since 1970 (UTC). Field names
+   #   follow the p1meter device states. Filled by P1Packet while parsing, so every value is
+   #   converted exactly once
+   #
+   ##########################################################################################
+   __slots__ = ('timestamp', 'tariff',
+                'usedT1', 'usedT2', 'generatedT1', 'generatedT2',
+                'nowUsage', 'nowGenerated',
+                'usedNowPhase1', 'usedNowPhase2', 'usedNowPhase3',
+                'generatedNowPhase1', 'generatedNowPhase2', 'generatedNowPhase3',
+                'voltageNowPhase1', 'voltageNowPhase2', 'voltageNowPhase3',
+                'currentNowPhase1', 'currentNowPhase2', 'currentNowPhase3',
+                'gasUsed', 'gasTimestamp')
+
+   def __init__(self, **values):
+      for name in self.__slots__:
+         setattr(self, name, values.get(name, 0))
+
+
+
+   def copy(self):
+      other = Reading.__new__(Reading)
+      for name in self.__slots__:
+         setattr(other, name, getattr(self, name))
+      return other
+
+
+
+   def __repr__(self):
+      return "Reading({})".format(", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+
+class P1Packet(object):
+   _datagram = ''
+
+   # OBIS code -> fields filled from that line as (section, field, converter); section None
+   # is a field of the Reading. The datagram is walked once and every line costs a single
+   # dictionary lookup. A field marked FROM_TEXT gets the text the field before it checked
+   # and decoded instead of the groups, so a value is converted once for both
+   obis_fields = {
+      b'1-3:0.2.8':   ((('header',),          'dsmrVersion',  _text),),
+      b'0-0:1.0.0':   ((('header',),          'measured_at',  _ts),
+                       (None,                 'timestamp',    _epoch_ts)),
+      b'0-0:96.1.1':  ((('kwh',),             'eid',          _filled),),
+      b'0-0:96.14.0': ((('kwh',),             'tariff',       _int),
+                       (None,                 'tariff',       _int)),
+      b'0-0:96.3.10': ((('kwh',),             'switch',       _digit),),
+      b'0-0:17.0.0':  ((('kwh',),             'treshold',     _threshold),),
+      b'1-0:1.8.1':   ((('kwh','low'),        'consumed',     _kwh),
+                       (None,                 'usedT1',       _kwh_number,  FROM_TEXT)),
+      b'1-0:2.8.1':   ((('kwh','low'),        'produced',     _kwh),
+                       (None,                 'generatedT1',  _kwh_number,  FROM_TEXT)),
+      b'1-0:1.8.2':   ((('kwh','high'),       'consumed',     _kwh),
+                       (None,                 'usedT2',       _kwh_number,  FROM_TEXT)),
+      b'1-0:2.8.2':   ((('kwh','high'),       'produced',     _kwh),
+                       (None,                 'generatedT2',  _kwh_number,  FROM_TEXT)),
+      b'1-0:1.7.0':   ((('kwh',),             'current_consumed', _kw),
+                       (None,                 'nowUsage',     _watts_number, FROM_TEXT)),
+      b'1-0:2.7.0':   ((('kwh',),             'current_produced', _kw),
+                       (None,                 'nowGenerated', _watts_number, FROM_TEXT)),
+      b'0-0:96.7.21': ((('kwh','outages'),    'shortcount',   _count),),
+      b'0-0:96.7.9':  ((('kwh','outages'),    'longcount',    _count),),
+      b'1-0:99.97.0': ((('kwh','outages'),    'timestamp',    _outage_ts),
+                       (('kwh','outages'),    'duration',     _outage_duration)),
+      b'1-0:32.32.0': ((('kwh','phase1'),     'saggs',        _count),),
+      b'1-0:52.32.0': ((('kwh','phase2'),     'saggs',        _count),),
+      b'1-0:72.32.0': ((('kwh','phase3'),     'saggs',        _count),),
+      b'1-0:32.36.0': ((('kwh','phase1'),     'swells',       _count),),
+      b'1-0:52.36.0': ((('kwh','phase2'),     'swells',       _count),),
+      b'1-0:72.36.0': ((('kwh','phase3'),     'swells',       _count),),
+      b'1-0:32.7.0':  ((('kwh','phase1'),     'volt',         _count),
+                       (None,                 'voltageNowPhase1', _float)),
+      b'1-0:52.7.0':  ((('kwh','phase2'),     'volt',         _count),
+                       (None,                 'voltageNowPhase2', _float)),
+      b'1-0:72.7.0':  ((('kwh','phase3'),     'volt',         _count),
+                       (None,                 'voltageNowPhase3', _float)),
+      b'1-0:31.7.0':  ((('kwh','phase1'),     'amps',         _count),
+                       (None,                 'currentNowPhase1', _float)),
+      b'1-0:51.7.0':  ((('kwh','phase2'),     'amps',         _count),
+                       (None,                 'currentNowPhase2', _float)),
+      b'1-0:71.7.0':  ((('kwh','phase3'),     'amps',         _count),
+                       (None,                 'currentNowPhase3', _float)),
+      b'1-0:21.7.0':  ((('kwh','phase1'),     'usedNow',      _decimal),
+                       (None,                 'usedNowPhase1', _watts_number, FROM_TEXT)),
+      b'1-0:41.7.0':  ((('kwh','phase2'),     'usedNow',      _decimal),
+                       (None,                 'usedNowPhase2', _watts_number, FROM_TEXT)),
+      b'1-0:61.7.0':  ((('kwh','phase3'),     'usedNow',      _decimal),
+                       (None,                 'usedNowPhase3', _watts_number, FROM_TEXT)),
+      b'1-0:22.7.0':  ((('kwh','phase1'),     'producedNow',  _decimal),
+                       (None,                 'generatedNowPhase1', _watts_number, FROM_TEXT)),
+      b'1-0:42.7.0':  ((('kwh','phase2'),     'producedNow',  _decimal),
+                       (None,                 'generatedNowPhase2', _watts_number, FROM_TEXT)),
+      b'1-0:62.7.0':  ((('kwh','phase3'),     'producedNow',  _decimal),
+                       (None,                 'generatedNowPhase3', _watts_number, FROM_TEXT)),
+      b'0-0:96.13.1': ((('msg',),             'code',         _digits),),
+      b'0-0:96.13.0': ((('msg',),             'text',         _filled),),
+   }
+
+   # M-Bus channels 0-1 up to 0-4 carry gas, water, heat or a slave electricity meter. Their
+   # lines are not in obis_fields: parse() indexes them per channel on the way and decodes
+   # every channel afterwards, see decode_mbus(). The type comes from 0-n:24.1.0 (EN 13757-3)
+   mbus_channels = (b'1', b'2', b'3', b'4')
+   mbus_kinds    = {2: 'electricity', 3: 'gas', 4: 'heat', 6: 'warm water', 7: 'water', 12: 'heat', 13: 'heat'}
+   mbus_values   = (b'24.2.1', b'24.2.3', b'24.3.0')   # Value lines, DSMR 5/4 first and 2.2 last
+
+   # Values for fields not found in the datagram. Counters default to 0 where the old regex
+   # parser failed on int(None)
+   defaults = {
+      ('header',):         {'netManager': None, 'meterType': None, 'dsmrVersion': None, 'measured_at': None},
+      ('msg',):            {'code': None, 'text': ''},
+      ('kwh',):            {'eid': None, 'tariff': None, 'switch': None, 'treshold': None,
+                            'current_consumed': None, 'current_produced': None},
+      ('kwh','low'):       {'consumed': None, 'produced': None},
+      ('kwh','high'):      {'consumed': None, 'produced': None},
+      ('kwh','outages'):   {'shortcount': 0, 'longcount': 0, 'timestamp': None, 'duration': 0},
+      ('kwh','phase1'):    {'saggs': 0, 'swells': 0, 'volt': 0, 'amps': 0, 'usedNow': None, 'producedNow': None},
+      ('kwh','phase2'):    {'saggs': 0, 'swells': 0, 'volt': 0, 'amps': 0, 'usedNow': None, 'producedNow': None},
+      ('kwh','phase3'):    {'saggs': 0, 'swells': 0, 'volt': 0, 'amps': 0, 'usedNow': None, 'producedNow': None},
+      ('gas',):            {'unit': 0, 'eid': "30", 'device_type': 0, 'measured_at': None, 'total': 0, 'valve': 0},
+   }
+
+   crc = CRC_MISSING
+   checksum = ""
+   reading = None
+   stamped = True                        # The telegram has a timestamp of its own
+   _memo = None                          # OBIS code -> (line, values) of this telegram
+
+   def __init__(self, datagram, validate=True, previous=None):
+      # previous: the telegram before this one from the same meter. Lines it had too are
+      # not converted again, see parse()
+      self._datagram = datagram
+
+      if previous is not None and datagram == previous._datagram and previous._memo is not None:
+         # Slow meters are sometimes read twice between two telegrams: same CRC, same values.
+         # The sections are shared, only a Reading without timestamp gets a new one
+         self.crc = previous.crc
+         self.checksum = previous.checksum
+         self.stamped = previous.stamped
+         self._memo = previous._memo
+         self._keys = previous._keys
+         self.reading = previous.reading.copy()
+         if not self.stamped:
+            self.reading.timestamp = int(time.time())
+         return
+
+      if validate:
+         started = TIMINGS.start()
+         self.validate()
+         TIMINGS.stop('crc', started)
+
+      started = TIMINGS.start()
+      self._keys = self.parse(previous)
+      TIMINGS.stop('parse', started)
+      self._keys['header']['checksum'] = self.checksum
+
+
+
+   def parse(self, previous=None):
+      # Single pass over the datagram, see obis_fields. A line that is byte for byte the
+      # same as in the previous telegram reuses its converted values: mostly only the
+      # timestamp and the power lines change, so only those cost a conversion
+      keys = {}
+      sections = {}
+      for path in sorted(self.defaults):
+         section = keys
+         for name in path[:-1]:
+            section = section[name]
+         section[path[-1]] = dict(self.defaults[path])
+         sections[path] = section[path[-1]]
+
+      header = sections[('header',)]
+      reading = self.reading = Reading()
+      obis_fields = self.obis_fields
+      mbus_channels = self.mbus_channels
+      channels = {}
+      lines = {}
+      continued = None                   # Values of a 0-n:24.3.0 whose value is on the next line...
+      continued_channel = None           # ...and its channel n
+      found = set()
+      known = previous._memo if previous is not None and previous._memo is not None else {}
+      memo = self._memo = {}
+
+      for line in self._datagram.split(b'\n'):
+         start = line.find(b'(')
+         if start < 0:
+            if line[:1] == b'/' and 'meterType' not in found:
+               # /Ene5\T210-D ESMR5.0
+               #  ^^^ netManager
+               #       ^^^^^^ meterType
+               ident = line[1:].lstrip(b's').rstrip()
+               header['netManager'] = ident[0:3].decode('ascii')
+               rest = ident[5:]
+               header['meterType'] = rest.split()[0].decode('ascii') if rest[:1].strip() else u''
+               found.add('meterType')
+            continue
+
+         code = line[:start]
+         fields = obis_fields.get(code)
+         if fields is None:
+            if code[:2] == b'0-' and code[3:4] == b':' and code[2:3] in mbus_channels:
+               # 0-2:24.2.1(...) -> channels[2][b'24.2.1'], first line per code wins
+               index = channels.setdefault(int(code[2:3]), {})
+               if code[4:] not in index:
+                  index[code[4:]] = line[start+1:line.rfind(b')')].split(b')(')
+                  continued = index[code[4:]] if code[4:] == b'24.3.0' else None
+                  continued_channel = int(code[2:3])
+                  lines.setdefault(continued_channel, []).append(line)
+            elif not code and continued is not None:
+               # DSMR 2.2 sends the value of 0-n:24.3.0 on the next line, it belongs to channel n
+               continued.extend(line[start+1:line.rfind(b')')].split(b')('))
+               continued = None
+               lines[continued_channel].append(line)
+            continue
+
+         continued = None
+         last = known.get(code)
+         if last is not None and last[0] == line:
+            values = last[1]
+         else:
+            groups = line[start+1:line.rfind(b')')].split(b')(')
+            values = []
+            value = SKIP
+            for field in fields:
+               if len(field) == 3:
+                  value = field[2](groups)
+               elif value is not SKIP:
+                  value = field[2](value)
+               if value is not SKIP:
+                  values.append((field, value))
+         memo[code] = (line, values)
+
+         for field, value in values:
+            if field in found:
+               continue
+            if field[0] is None:
+               setattr(reading, field[1], value)
+            else:
+               sections[field[0]][field[1]] = value
+            found.add(field)
+
+      self.decode_mbus(channels, lines, keys, sections[('gas',)], known)
+
+      if not reading.timestamp:
+         # DSMR 2.2 has no timestamp, use the time of reception
+         self.stamped = False
+         reading.timestamp = int(time.time())
+      return keys
+
+
+
+   def decode_mbus(self, channels, lines, keys, gas, known):
+      # keys['mbus'][n] for every channel n in the telegram, each looked up in the index
+      # parse() built: OBIS code without the 0-n: prefix -> value groups. The first gas
+      # channel also fills the gas section and the Reading. A channel with the same lines
+      # as in the previous telegram reuses its entry; the memo has it under the channel number
+      mbus = keys['mbus'] = {}
+      memo = self._memo
+      gas_channel = None
+      for channel in sorted(channels):
+         last = known.get(channel)
+         if last is not None and last[0] == lines[channel]:
+            entry, used, timestamp = last[1]
+         else:
+            entry, used, timestamp = self.decode_channel(channel, channels[channel])
+         memo[channel] = (lines[channel], (entry, used, timestamp))
+         mbus[channel] = entry
+
+         if entry['device_type'] != 3 or gas_channel is not None:
+            continue
+         gas_channel = channel
+         gas['device_type'] = entry['device_type']
+         if entry['eid'] is not None:
+            gas['eid'] = entry['eid']
+         if entry['valve'] is not None:
+            gas['valve'] = entry['valve']
+         if used is not None:
+            gas['measured_at'] = entry['measured_at']
+            gas['total'], gas['unit'] = entry['value'], entry['unit']
+            self.reading.gasUsed = used
+            if timestamp is not SKIP:
+               self.reading.gasTimestamp = timestamp
+
+
+
+   def decode_channel(self, channel, index):
+      # (entry, value as float, timestamp in seconds) of one M-Bus channel
+      device_type = _int(index[b'24.1.0']) if b'24.1.0' in index else SKIP
+      if device_type is SKIP:
+         # Older meters do not send the type; channel 1 was always gas there
+         device_type = 3 if channel == 1 else 0
+      eid = _filled(index[b'96.1.0']) if b'96.1.0' in index else SKIP
+      valve = _digit(index[b'24.4.0']) if b'24.4.0' in index else SKIP
+
+      values = SKIP
+      for code in self.mbus_values:
+         if code in index:
+            values = _mbus_value(index[code])
+            if values is not SKIP:
+               groups = index[code]
+               break
+
+      entry = {
+         'device_type': device_type,
+         'kind':        self.mbus_kinds.get(device_type, 'unknown'),
+         'eid':         None if eid is SKIP else eid,
+         'valve':       None if valve is SKIP else valve,
+         'measured_at': None if values is SKIP else _timestamp(groups[0]),
+         'value':       None if values is SKIP else values[0],
+         'unit':        None if values is SKIP else values[1],
+      }
+      if values is SKIP:
+         return entry, None, SKIP
+      return entry, float(values[0]), _epoch(groups[0])
+
+
+
+   def __getitem__(self, key):
+      return self._keys[key]
+
+
+
+   def states(self):
+      # Device states that come straight from the telegram
+      keys = self._keys
+      reading = self.reading
+      return [
+            {'key':'meterType',                  'value':keys['header']['meterType']},
+            {'key':'netManager',                 'value':keys['header']['netManager']},
+            {'key':'textMessage',                'value':keys['msg']['text']},
+            {'key':'meterID',                    'value':_unhex(keys['kwh']['eid'])},
+            {'key':'checkSum',                   'value':keys['header']['checksum']},
+            {'key':'dsmrVersion',                'value':keys['header']['dsmrVersion']},
+            {'key':'timestamp',                  'value':keys['header']['measured_at']},
+
+            {'key':'currentTariff',              'value':keys['kwh']['tariff']},
+            {'key':'currentNowPhase1',           'value':keys['kwh']['phase1']['amps']},
+            {'key':'currentNowPhase2',           'value':keys['kwh']['phase2']['amps']},
+            {'key':'currentNowPhase3',           'value':keys['kwh']['phase3']['amps']},
+            {'key':'usedNowPhase1',              'value':reading.usedNowPhase1},
+            {'key':'usedNowPhase2',              'value':reading.usedNowPhase2},
+            {'key':'usedNowPhase3',              'value':reading.usedNowPhase3},
+            {'key':'generatedNowPhase1',         'value':reading.generatedNowPhase1},
+            {'key':'generatedNowPhase2',         'value':reading.generatedNowPhase2},
+            {'key':'generatedNowPhase3',         'value':reading.generatedNowPhase3},
+
+            {'key':'outagesLongCount',           'value':keys['kwh']['outages']['longcount']},
+            {'key':'outagesLongRecentDuration',  'value':keys['kwh']['outages']['duration']},
+            {'key':'outagesLongRecentTimestamp', 'value':keys['kwh']['outages']['timestamp']},
+            {'key':'outagesShortCount',          'value':keys['kwh']['outages']['shortcount']},
+
+            {'key':'voltageNowPhase1',           'value':keys['kwh']['phase1']['volt']},
+            {'key':'voltageNowPhase2',           'value':keys['kwh']['phase2']['volt']},
+            {'key':'voltageNowPhase3',           'value':keys['kwh']['phase3']['volt']},
+            {'key':'voltageToHighCountPhase1',   'value':keys['kwh']['phase1']['swells']},
+            {'key':'voltageToHighCountPhase2',   'value':keys['kwh']['phase2']['swells']},
+            {'key':'voltageToHighCountPhase3',   'value':keys['kwh']['phase3']['swells']},
+            {'key':'voltageToLowCountPhase1',    'value':keys['kwh']['phase1']['saggs']},
+            {'key':'voltageToLowCountPhase2',    'value':keys['kwh']['phase2']['saggs']},
+            {'key':'voltageToLowCountPhase3',    'value':keys['kwh']['phase3']['saggs']},
+
+            {'key':'usedT1',                     'value':keys['kwh']['low']['consumed']},
+            {'key':'usedT2',                     'value':keys['kwh']['high']['consumed']},
+            {'key':'generatedT1',                'value':keys['kwh']['low']['produced']},
+            {'key':'generatedT2',                'value':keys['kwh']['high']['produced']},
+
+            {'key':'nowGenerated',               'value':reading.nowGenerated},
+            {'key':'nowUnit',                    'value':"W"},
+            {'key':'nowUsage',                   'value':reading.nowUsage},
+            {'key':'tariffUnit',                 'value':"kWh"},
+
+            {'key':'gastimestamp',               'value':keys['gas']['measured_at']},
+            {'key':'gasused',                    'value':reading.gasUsed},
+            {'key':'gastariffUnit',              'value':keys['gas']['unit']},
+            {'key':'gasMeterID',                 'value':_unhex(keys['gas']['eid'])},
+            {'key':'gasMeterType',               'value':keys['gas']['device_type']},
+            {'key':'gasValve',                   'value':keys['gas']['valve']}
+      ] + self.mbus_states()
+
+
+
+   def mbus_states(self):
+      # State group per M-Bus channel, mbus1Kind up to mbus4Unit. Channels the telegram does
+      # not have are emptied
+      states = []
+      for number in range(1, len(self.mbus_channels) + 1):
+         channel = self._keys['mbus'].get(number, {})
+         prefix = 'mbus{}'.format(number)
+         states += [
+            {'key':prefix + 'Kind',                'value':channel.get('kind', '')},
+            {'key':prefix + 'MeterID',             'value':_unhex(channel.get('eid')) or ''},
+            {'key':prefix + 'Timestamp',           'value':channel.get('measured_at') or ''},
+            {'key':prefix + 'Value',               'value':channel.get('value') or ''},
+            {'key':prefix + 'Unit',                'value':channel.get('unit') or ''},
+         ]
+      return states
+
+
+
+   def validate(self):
+      # Check the !XXXX trailer before spending time on parsing. DSMR 2.2 telegrams end
+      # with a bare ! and carry no CRC
+      end = self._datagram.rfind(b'!')
+      if end < 0:
+         raise P1PacketError("P1Packet without end marker found")
+
+      checksum = self._datagram[end+1:end+5].strip()
+      if not checksum:
+         self.crc = CRC_MISSING
+         return self.crc
+
+      try:
+         given_checksum = int(checksum, 16)
+      except ValueError:
+         raise P1PacketError("P1Packet with unreadable checksum {!r} found".format(checksum))
+
+      calculated_checksum = getattr(self._datagram, 'crc16', None)
+      if calculated_checksum is None:
+         # Not cut by a FrameAssembler, e.g. TESTGRAM
+         start = self._datagram.find(b'/')
+         calculated_checksum = crc16(_byte_values(self._datagram), max(start, 0), end + 1)
+      if given_checksum != calculated_checksum:
+         raise P1PacketError("P1Packet with invalid checksum found: given={:04X}, calculated={:04X}".format(given_checksum, calculated_checksum))
+
+      self.checksum = checksum.decode('ascii')
+      self.crc = CRC_VALID
+      return self.crc
+
+
+
+   def __str__(self):
+       return self._datagram.decode('ascii')
+
+
+
+def parse_frame(job):
+   # Worker for the replay in plugin.py, runs in a separate process. It lives here because
+   # workers can always import this module, plugin.py only loads inside Indigo. Returns the
+   # Reading values as a tuple, which is cheaper to send back than the object
+   frame, verify = job
+   try:
+      reading = P1Packet(frame, verify).reading
+   except P1PacketError as e:
+      return None, str(e)
+   except (ValueError, TypeError, IndexError) as e:
+      return None, "Unreadable telegram: {}".format(e)
+   return tuple(getattr(reading, name) for name in Reading.__slots__), None
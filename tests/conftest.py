@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   The plugin code and the tools are no packages: put both folders on the path, the
+#   same way the scripts in tools/ find smartmeter.py
+#
+##########################################################################################
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for folder in (os.path.join(ROOT, "P1Meter.indigoPlugin", "Contents", "Server Plugin"),
+               os.path.join(ROOT, "tools")):
+   if folder not in sys.path:
+      sys.path.insert(0, folder)
+
+
+
+def pytest_configure(config):
+   config.addinivalue_line("markers", "perf: timing checks against tools/baseline.json and a simulated meter, deselect with -m 'not perf'")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   JsonEndpoint over HTTP: ETags, 304 Not Modified and which headers it sends
+#
+##########################################################################################
+
+import json
+import logging
+import threading
+
+import pytest
+
+from exporters import JsonEndpoint
+
+try:
+   import httplib
+except ImportError:
+   import http.client as httplib
+
+
+
+@pytest.fixture
+def endpoints():
+   started = []
+   def start(document=lambda source: source, **options):
+      endpoint = JsonEndpoint("127.0.0.1", 0, document, logging.getLogger("test_endpoint"), **options)
+      started.append(endpoint)
+      return endpoint
+   yield start
+   for endpoint in started:
+      endpoint.close()
+
+
+
+def request(endpoint, path, etag=None):
+   connection = httplib.HTTPConnection(*endpoint.server.server_address[:2], timeout=10)
+   try:
+      connection.request("GET", path, headers={} if etag is None else {"If-None-Match": etag})
+      response = connection.getresponse()
+      return response.status, dict((name.lower(), value) for name, value in response.getheaders()), response.read()
+   finally:
+      connection.close()
+
+
+
+def test_not_modified(endpoints):
+   endpoint = endpoints()
+   endpoint.update(7, {"id": 7, "usedT1": 1.5})
+   status, headers, body = request(endpoint, "/meters/7")
+   assert status == 200 and json.loads(body.decode("utf-8")) == {"id": 7, "usedT1": 1.5}
+   assert request(endpoint, "/meters/7", headers["etag"])[0] == 304
+   assert request(endpoint, "/meters/8")[0] == 404
+
+   endpoint.update(7, {"id": 7, "usedT1": 1.6})
+   assert request(endpoint, "/meters/7", headers["etag"])[0] == 200
+
+
+
+def test_etag_changes_on_restart(endpoints):
+   # Both count one update, the ETag of the first must not match the second
+   first, second = endpoints(), endpoints()
+   for endpoint in (first, second):
+      endpoint.update(7, {"id": 7})
+   etag = request(first, "/")[1]["etag"]
+   assert request(first, "/", etag)[0] == 304
+   assert request(second, "/", etag)[0] == 200
+   assert request(second, "/meters/7", request(first, "/meters/7")[1]["etag"])[0] == 200
+
+
+
+def test_cors_is_opt_in(endpoints):
+   plain, shared = endpoints(), endpoints(cors=True)
+   for endpoint in (plain, shared):
+      endpoint.update(7, {"id": 7})
+   assert "access-control-allow-origin" not in request(plain, "/")[1]
+   headers = request(shared, "/")[1]
+   assert headers["access-control-allow-origin"] == "*"
+   assert headers["access-control-expose-headers"] == "ETag"
+
+
+
+def test_update_does_not_wait_for_json(endpoints):
+   # A slow document for one client must not hold up the reader that calls update()
+   building = threading.Event()
+   release = threading.Event()
+   def document(source):
+      building.set()
+      release.wait(10)
+      return source
+   endpoint = endpoints(document)
+   endpoint.update(7, {"id": 7, "usedT1": 1.5})
+
+   answers = []
+   client = threading.Thread(target=lambda: answers.append(endpoint.get(7)))
+   client.start()
+   assert building.wait(5)
+   updater = threading.Thread(target=endpoint.update, args=(7, {"id": 7, "usedT1": 1.6}))
+   updater.start()
+   updater.join(2)
+   stalled = updater.is_alive()
+   release.set()
+   client.join(10)
+   assert not stalled
+
+   # The client got the reading its ETag belongs to; that JSON is not cached for the newer one
+   status, etag, body = answers[0]
+   assert json.loads(body.decode("utf-8"))["usedT1"] == 1.5
+   assert endpoint.get(7, etag)[0] == 200
+   assert json.loads(endpoint.get(7)[2].decode("utf-8"))["usedT1"] == 1.6
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   InfluxSink and MqttSink against tools/exportserver.py: line protocol over HTTP and
+#   UDP, gzip, a keep-alive connection the server closed, the spool while the target is
+#   down, and QoS 1 publishes per meter
+#
+##########################################################################################
+
+import json
+import time
+import logging
+import itertools
+import threading
+
+import pytest
+
+import telegrams
+import exportserver
+from smartmeter import P1Packet, Reading
+from exporters import InfluxSink, MqttSink
+
+
+
+class FastInflux(InfluxSink):
+   batch_seconds = 0.1
+   min_retry     = 0.2
+   max_retry     = 0.2
+
+
+
+class FastMqtt(MqttSink):
+   batch_seconds = 0.1
+   min_retry     = 0.2
+   max_retry     = 0.2
+
+
+
+def readings(count):
+   return [P1Packet(telegram).reading for telegram in itertools.islice(telegrams.stream("5"), count)]
+
+
+
+def wait_for(condition, timeout=10):
+   deadline = time.time() + timeout
+   while not condition() and time.time() < deadline:
+      time.sleep(0.05)
+   return condition()
+
+
+
+@pytest.fixture
+def outage():
+   return exportserver.Outage()
+
+
+
+@pytest.fixture
+def serve():
+   servers = []
+   def start(server):
+      thread = threading.Thread(target=server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      servers.append(server)
+      return server
+   yield start
+   for server in servers:
+      server.shutdown()
+      server.server_close()
+
+
+
+@pytest.fixture
+def sinks():
+   started = []
+   yield started
+   for sink in started:
+      sink.close()
+
+
+
+def influx(server, scheme, tmpdir, sinks):
+   url = "{}://127.0.0.1:{}/write?db=p1meter".format(scheme, server.server_address[1])
+   sink = FastInflux(url, "", "p1meter", str(tmpdir.join("influx")), logging.getLogger("test_exporters"))
+   sinks.append(sink)
+   return sink
+
+
+
+def mqtt(broker, tmpdir, sinks):
+   sink = FastMqtt("127.0.0.1", broker.server_address[1], "", "", "p1", str(tmpdir.join("mqtt")),
+                   logging.getLogger("test_exporters"))
+   sinks.append(sink)
+   return sink
+
+
+
+def test_influx_http(outage, serve, sinks, tmpdir):
+   server = serve(exportserver.InfluxServer(("127.0.0.1", 0), outage, idle_timeout=0.5))
+   sink = influx(server, "http", tmpdir, sinks)
+   sent = readings(6)
+   for index, reading in enumerate(sent):
+      sink.add(reading, meter=11 if index % 2 else 22)
+   assert wait_for(lambda: len(server.received) == 6)
+   assert server.gzipped >= 1
+
+   for line, reading in zip(server.received, sent):
+      series, fields, timestamp = line.decode("utf-8").split(" ")
+      assert series in ("p1meter,meter=11", "p1meter,meter=22")
+      fields = dict(field.split("=") for field in fields.split(","))
+      assert sorted(fields) == sorted(Reading.__slots__[1:])
+      assert fields["tariff"] == "{}i".format(reading.tariff)
+      assert float(fields["usedT1"]) == reading.usedT1
+      assert int(timestamp) == reading.timestamp
+
+   # The server closes the idle keep-alive connection, the next batch goes over a new one
+   time.sleep(1)
+   sink.add(sent[0], meter=11)
+   assert wait_for(lambda: len(server.received) == 7)
+   assert server.connections == 2
+   assert wait_for(lambda: len(sink.spool) == 0) and not sink.failing
+
+
+
+def test_influx_udp(outage, serve, sinks, tmpdir):
+   server = serve(exportserver.UdpServer(("127.0.0.1", 0), outage))
+   sink = influx(server, "udp", tmpdir, sinks)
+   for reading in readings(20):
+      sink.add(reading, meter=11)
+   assert wait_for(lambda: len(server.received) == 20)
+   assert all(line.startswith(b"p1meter,meter=11 ") for line in server.received)
+
+
+
+def test_influx_spool(outage, serve, sinks, tmpdir):
+   server = serve(exportserver.InfluxServer(("127.0.0.1", 0), outage))
+   sink = influx(server, "http", tmpdir, sinks)
+   sent = readings(6)
+   outage.forced = True
+   for reading in sent[:3]:
+      sink.add(reading, meter=11)
+   assert wait_for(lambda: sink.spool is not None and len(sink.spool) == 1)
+   for reading in sent[3:]:
+      sink.add(reading, meter=11)
+   assert wait_for(lambda: len(sink.spool) == 2)
+   assert server.received == []
+
+   outage.forced = False
+   assert wait_for(lambda: len(server.received) == 6)
+   assert [int(line.split(b" ")[-1]) for line in server.received] == [reading.timestamp for reading in sent]
+   assert wait_for(lambda: len(sink.spool) == 0)
+
+
+
+def test_mqtt_qos1(outage, serve, sinks, tmpdir):
+   broker = serve(exportserver.Broker(("127.0.0.1", 0), outage))
+   sink = mqtt(broker, tmpdir, sinks)
+   sent = readings(4)
+   for index, reading in enumerate(sent):
+      sink.add(reading, meter=11 if index % 2 else 22)
+   published = lambda: [message for message in broker.messages if message[0].endswith(b"/reading")]
+   assert wait_for(lambda: len(published()) == 4)
+
+   for (topic, payload, qos, retain), reading, meter in zip(published(), sent, [22, 11, 22, 11]):
+      assert topic == "p1/{}/reading".format(meter).encode("ascii")
+      assert qos == 1 and not retain
+      values = json.loads(payload.decode("utf-8"))
+      assert values["meter"] == meter and values["timestamp"] == reading.timestamp
+   # Every PUBACK came back: nothing waits in the spool
+   assert wait_for(lambda: len(sink.spool) == 0) and not sink.failing
+   assert json.loads(broker.retained[b"p1/11/usedT1"].decode("utf-8")) == sent[3].usedT1
+   assert json.loads(broker.retained[b"p1/22/usedT1"].decode("utf-8")) == sent[2].usedT1
+
+
+
+def test_mqtt_spool(outage, serve, sinks, tmpdir):
+   broker = serve(exportserver.Broker(("127.0.0.1", 0), outage))
+   sink = mqtt(broker, tmpdir, sinks)
+   sent = readings(4)
+   outage.forced = True
+   for reading in sent:
+      sink.add(reading, meter=11)
+   assert wait_for(lambda: sink.spool is not None and len(sink.spool) == 1)
+
+   outage.forced = False
+   published = lambda: [message for message in broker.messages if message[0] == b"p1/11/reading"]
+   assert wait_for(lambda: len(published()) == 4)
+   assert [json.loads(message[1].decode("utf-8"))["timestamp"] for message in published()] == [reading.timestamp for reading in sent]
+   assert wait_for(lambda: len(sink.spool) == 0)
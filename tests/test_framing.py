@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   FrameAssembler and the CRC check of P1Packet
+#
+##########################################################################################
+
+import pickle
+import itertools
+
+import pytest
+
+import telegrams
+from smartmeter import (FrameAssembler, Frame, P1Packet, P1PacketError, crc16, TESTGRAM,
+                        CRC_VALID, CRC_MISSING)
+
+
+
+def frames(data, chunk=64):
+   assembler = FrameAssembler()
+   found = []
+   for start in range(0, len(data), chunk):
+      assembler.feed(data[start:start + chunk])
+      found.extend(assembler.frames())
+   return found
+
+
+
+def test_frames_span_reads():
+   stream = list(itertools.islice(telegrams.stream("5", mbus=2), 5))
+   assert frames(b"".join(stream), chunk=7) == stream
+
+
+
+def test_crc_calculated_on_the_buffer():
+   telegram = telegrams.telegram("4")
+   frame, = frames(b"noise" + telegram)
+   assert isinstance(frame, Frame)
+   assert frame.crc16 == crc16(bytearray(telegram), 0, telegram.rfind(b"!") + 1)
+   assert P1Packet(frame).crc == CRC_VALID
+
+
+
+def test_crc_without_assembler():
+   assert P1Packet(TESTGRAM).crc == CRC_VALID
+
+
+
+def test_crc_survives_pickling():
+   # Replay sends frames to worker processes
+   frame, = frames(telegrams.telegram("5"))
+   assert pickle.loads(pickle.dumps(frame, 2)).crc16 == frame.crc16
+
+
+
+def test_bad_crc_rejected():
+   telegram = bytearray(telegrams.telegram("5"))
+   telegram[telegram.find(b"1-0:1.8.1(") + 12] ^= 0x01
+   frame, = frames(bytes(telegram))
+   with pytest.raises(P1PacketError):
+      P1Packet(frame)
+
+
+
+def test_dsmr22_has_no_crc():
+   frame, = frames(telegrams.telegram("2.2"))
+   assert frame.crc16 is None
+   assert P1Packet(frame).crc == CRC_MISSING
+
+
+
+def test_many_starts_without_end():
+   # Garbage full of / and no ! used to recurse once per / until the stack ran out
+   assembler = FrameAssembler(max_size=1024)
+   assembler.feed(b"/a/b/c" * 3000)
+   assert assembler.next_frame() is None
+   assert len(assembler.buffer) <= 1024
+   telegram = telegrams.telegram("5")
+   assembler.feed(telegram)
+   assert assembler.next_frame() == telegram
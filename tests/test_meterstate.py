@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   What plugin.py derives from the telegrams of a meter and the hand-off to the Indigo
+#   writer, see meterstate.py. Periods follow the local calendar, so these run in the time
+#   zone of the meters: Europe/Amsterdam
+#
+##########################################################################################
+
+import json
+import math
+import time
+import logging
+
+import pytest
+
+from smartmeter import Reading
+from meterstate import Aggregator, PublishQueue, DailyExtremes, EnergyAccount, PeakDemand, StateCache
+
+
+
+@pytest.fixture(autouse=True)
+def amsterdam(monkeypatch):
+   monkeypatch.setenv("TZ", "Europe/Amsterdam")
+   time.tzset()
+   yield
+   monkeypatch.undo()
+   time.tzset()
+
+
+
+def local(text):
+   return int(time.mktime(time.strptime(text, "%Y-%m-%d %H:%M")))
+
+
+
+def values(states):
+   return dict((state['key'], state['value']) for state in states)
+
+
+
+def wait_for(condition, timeout=5):
+   deadline = time.time() + timeout
+   while not condition() and time.time() < deadline:
+      time.sleep(0.01)
+   return condition()
+
+
+
+def test_aggregator_integrates():
+   aggregator = Aggregator()
+   start = local("2021-05-01 12:00")
+   aggregator.add(Reading(timestamp=start, nowUsage=1000.0, nowGenerated=300.0))
+   aggregator.add(Reading(timestamp=start + 10, nowUsage=2000.0, nowGenerated=100.0))
+   aggregator.add(Reading(timestamp=start + 20, nowUsage=2000.0, nowGenerated=100.0))
+   window = aggregator.take()
+   # Trapezoids: 1000 to 2000 W and 2000 W, 10 seconds each
+   assert window.usedWh == pytest.approx((1500.0 * 10 + 2000.0 * 10) / 3600)
+   assert window.generatedWh == pytest.approx((200.0 * 10 + 100.0 * 10) / 3600)
+   usage = window.usage
+   assert (usage.count, usage.minimum, usage.minAt, usage.maximum, usage.maxAt) == (3, 1000.0, start, 2000.0, start + 10)
+   assert usage.mean() == pytest.approx(5000.0 / 3)
+   assert window.generation.maximum == 300.0
+
+   # The next window goes on from the last reading of the previous one
+   aggregator.add(Reading(timestamp=start + 30, nowUsage=4000.0))
+   window = aggregator.take()
+   assert window.usedWh == pytest.approx(3000.0 * 10 / 3600)
+   assert window.usage.count == 1
+   assert aggregator.take().usage.mean() == 0.0
+
+
+
+def test_aggregator_gaps():
+   # Longer than max_gap, the same second or back in time: counted, not integrated
+   aggregator = Aggregator()
+   start = local("2021-05-01 12:00")
+   for at in (start, start + Aggregator.max_gap + 1, start + Aggregator.max_gap + 1, start + 10):
+      aggregator.add(Reading(timestamp=at, nowUsage=1000.0))
+   window = aggregator.take()
+   assert window.usedWh == 0.0
+   assert window.usage.count == 4
+   aggregator.add(Reading(timestamp=start + 10 + Aggregator.max_gap, nowUsage=1000.0))
+   assert aggregator.take().usedWh == pytest.approx(1000.0 * Aggregator.max_gap / 3600)
+
+
+
+class Device(object):
+   # The parts of a plugin Meter the PublishQueue uses
+   def __init__(self, devId):
+      self.devId = devId
+      self.name = "meter {}".format(devId)
+      self.coalesced = 0
+      self.dropped = 0
+
+
+
+def test_publish_queue_coalesces():
+   published = []
+   queue = PublishQueue(lambda meter, packet: published.append((meter.devId, packet)), logging.getLogger("test_meterstate"))
+   queue.max_meters = 2
+   first, second, third = Device(1), Device(2), Device(3)
+   assert queue.put(first, "a1")
+   assert queue.put(second, "b1")
+   # A newer telegram replaces the waiting one and keeps its place in line
+   assert queue.put(first, "a2")
+   assert first.coalesced == 1
+   # No slot for a third meter
+   assert not queue.put(third, "c1")
+   assert third.dropped == 1
+   assert list(queue.slots) == [1, 2]
+
+   queue.start()
+   try:
+      assert wait_for(lambda: len(published) == 2)
+      assert published == [(1, "a2"), (2, "b1")]
+      assert queue.put(third, "c2")
+      assert wait_for(lambda: len(published) == 3)
+   finally:
+      queue.stop()
+   assert not queue.is_alive()
+   assert published[-1] == (3, "c2")
+
+
+
+def test_publish_queue_survives_errors():
+   published = []
+   def publish(meter, packet):
+      if packet == "bad":
+         raise ValueError("Indigo said no")
+      published.append(packet)
+   queue = PublishQueue(publish, logging.getLogger("test_meterstate"))
+   queue.start()
+   try:
+      queue.put(Device(1), "bad")
+      assert wait_for(lambda: not queue.slots)
+      queue.put(Device(1), "good")
+      assert wait_for(lambda: published == ["good"])
+      assert queue.is_alive()
+   finally:
+      queue.stop()
+
+
+
+def test_account_periods():
+   account = EnergyAccount()
+   start = local("2021-01-31 22:00")
+   for quarter in range(8):
+      account.add(Reading(timestamp=start + quarter * 900, usedT1=1000 + quarter * 0.25,
+                          generatedT2=10 + quarter * 0.1, gasUsed=500 + quarter * 0.01))
+   states, started = account.take()
+   totals = values(states)
+   assert (totals['intervalUsed'], totals['todayUsed'], totals['monthUsed']) == (1.75, 1.75, 1.75)
+   assert (totals['todayUsedT1'], totals['todayUsedT2'], totals['todayGeneratedT2']) == (1.75, 0.0, 0.7)
+   assert (totals['todayNet'], totals['todayGas']) == (1.05, 0.07)
+   assert started == set()
+
+   # The first reading of February starts the day and the month from the last one of January
+   account.add(Reading(timestamp=start + 8 * 900, usedT1=1002.0, generatedT2=10.8, gasUsed=500.08))
+   states, started = account.take()
+   totals = values(states)
+   assert (totals['intervalUsed'], totals['todayUsed'], totals['monthUsed'], totals['yearUsed']) == (0.25, 0.25, 0.25, 2.0)
+   assert totals['todayNet'] == 0.15
+   assert started == set(['today', 'month'])
+
+
+
+@pytest.mark.parametrize("day,hours", [("2021-03-28", 23), ("2021-10-31", 25), ("2021-06-15", 24)])
+def test_account_dst_days(day, hours):
+   # One kWh an hour: the day has as many kWh as hours
+   account = EnergyAccount()
+   first = local(day + " 00:00") - 900
+   last = local(day + " 23:45")
+   for at in range(first, last + 1, 900):
+      account.add(Reading(timestamp=at, usedT1=(at - first) / 3600.0))
+   assert values(account.states('today'))['todayUsed'] == hours
+
+
+
+def test_account_gap():
+   # After more than max_gap without readings, the new day starts at the first reading
+   account = EnergyAccount()
+   account.add(Reading(timestamp=local("2021-05-01 20:00"), usedT1=1000.0))
+   account.add(Reading(timestamp=local("2021-05-02 08:00"), usedT1=1012.0))
+   assert values(account.states('today'))['todayUsed'] == 0.0
+   assert values(account.states('month'))['monthUsed'] == 12.0
+
+
+
+def test_account_meter_replaced():
+   # The registers of the new meter start low; the totals go on from where they were
+   account = EnergyAccount()
+   start = local("2021-05-01 12:00")
+   account.add(Reading(timestamp=start, usedT2=999.1, gasUsed=300.0))
+   account.add(Reading(timestamp=start + 60, usedT2=1000.1, gasUsed=300.5))
+   account.take()
+   account.add(Reading(timestamp=start + 120, usedT2=0.1, gasUsed=0.2))
+   states, started = account.take()
+   totals = values(states)
+   assert (totals['todayUsed'], totals['todayUsedT2'], totals['todayGas']) == (1.0, 1.0, 0.5)
+   assert (totals['intervalUsed'], totals['intervalUsedT2']) == (0.0, 0.0)
+   # No -0.0 in a device state
+   assert all(math.copysign(1, value) == 1 for value in totals.values() if value == 0)
+
+   account.add(Reading(timestamp=start + 180, usedT2=0.4, gasUsed=0.3))
+   totals = values(account.take()[0])
+   assert (totals['todayUsed'], totals['intervalUsed'], totals['todayGas']) == (1.3, 0.3, 0.6)
+
+
+
+def test_account_snapshot():
+   # Saved as JSON and restored, the totals continue as if nothing happened
+   account = EnergyAccount()
+   start = local("2021-05-01 12:00")
+   for minute in range(5):
+      account.add(Reading(timestamp=start + minute * 60, usedT1=100 + minute * 0.1, generatedT1=20 + minute * 0.2))
+   assert account.changed
+   restored = EnergyAccount(json.loads(json.dumps(account.snapshot())))
+   assert not account.changed
+
+   later = Reading(timestamp=start + 600, usedT1=101.0, generatedT1=22.0)
+   for each in (account, restored):
+      each.add(later)
+   for period in ('today', 'month', 'year'):
+      assert values(restored.states(period)) == values(account.states(period))
+   assert values(restored.states('today'))['todayNet'] == -1.0
+
+
+
+class Load(object):
+   # Readings of a meter drawing kw, a telegram every step seconds, its registers in step.
+   # The first telegram is at the start
+   def __init__(self, demand, at, kw, registers=True, total=1000.0):
+      self.demand = demand
+      self.at = at
+      self.total = total
+      self.registers = registers
+      self.send(kw)
+
+   def run(self, seconds, kw, step=60):
+      for count in range(int(seconds // step)):
+         self.at += step
+         self.total += kw * step / 3600.0
+         self.send(kw)
+
+   def send(self, kw):
+      self.demand.add(Reading(timestamp=self.at, usedT1=self.total if self.registers else 0, nowUsage=kw * 1000))
+
+
+
+def test_demand_windows():
+   # Telegrams half a minute off the quarters: the boundaries are interpolated
+   demand = PeakDemand()
+   load = Load(demand, local("2021-05-01 10:07") + 30, 4.0)
+   load.run(23 * 60, 4.0)                   # Till 10:30:30
+   load.run(17 * 60, 2.0)                   # Till 10:47:30
+   assert demand.start == local("2021-05-01 10:45")
+   assert demand.peakAt == local("2021-05-01 10:15")
+   assert demand.peak == pytest.approx(4.0)
+   # 30 seconds of 4 kW and 14.5 minutes of 2 kW
+   assert demand.previous == pytest.approx((4.0 * 30 + 2.0 * 870) / 900)
+
+   state = values(demand.states())
+   assert state['demandWindowStart'] == "10:45"
+   assert state['demandAverage'] == state['demandProjected'] == 2.0
+   assert state['demandPeak'] == 4.0
+   assert state['demandPeakTime'] == "2021-05-01 10:15"
+
+
+
+def test_demand_power_only():
+   # No registers in the telegrams: the import comes from integrating the power
+   demand = PeakDemand()
+   load = Load(demand, local("2021-05-01 10:00") - 30, 3.0, registers=False)
+   load.run(31 * 60, 3.0, step=10)
+   assert demand.source == "power"
+   assert demand.peak == pytest.approx(3.0)
+   assert demand.previous == pytest.approx(3.0)
+
+
+
+def test_demand_gaps():
+   demand = PeakDemand()
+   load = Load(demand, local("2021-05-01 09:59") + 30, 1.0)
+   load.run(60, 1.0)                        # 10:00:30, the window starts complete
+   load.at += 13 * 60                       # Silent, but the registers still cover the window
+   load.total += 13 / 60.0 * 5.0
+   load.run(120, 1.0)                       # Till 10:15:30
+   assert demand.peakAt == local("2021-05-01 10:00")
+   assert demand.peak == pytest.approx((1.0 * 30 + 5.0 * 780 + 1.0 * 90) / 900)
+
+   # A gap over a boundary: neither window is complete
+   load.at += 20 * 60
+   load.total += 20 / 60.0 * 9.0
+   load.run(120, 1.0)                       # Till 10:37:30
+   assert demand.base is None
+   assert values(demand.states())['demandAverage'] == 0.0
+   load.run(25 * 60, 1.0)                   # Till 11:02:30, the 10:45 window is complete
+   assert demand.previous == pytest.approx(1.0)
+   assert demand.peakAt == local("2021-05-01 10:00")
+
+   # Telegrams that are not newer are ignored
+   before = demand.snapshot()
+   demand.add(Reading(timestamp=load.at - 60, usedT1=load.total + 50, nowUsage=1000))
+   assert demand.snapshot() == before
+
+
+
+def test_demand_month_and_snapshot():
+   demand = PeakDemand()
+   load = Load(demand, local("2021-05-31 23:29") + 30, 6.0)
+   load.run(31 * 60, 6.0)                   # Till 0:00:30, the peak of May at 23:30
+   load.run(31 * 60, 2.0)                   # Till 0:31:30
+   assert demand.month == "202106"
+   assert demand.lastMonthPeak == pytest.approx(6.0)
+   assert demand.peak == pytest.approx((6.0 * 30 + 2.0 * 870) / 900)
+   assert demand.changed
+
+   restored = PeakDemand(json.loads(json.dumps(demand.snapshot())))
+   assert not demand.changed
+   later = Load(restored, load.at, 2.0, total=load.total)
+   load.run(30 * 60, 3.0)
+   later.run(30 * 60, 3.0)
+   assert restored.snapshot() == demand.snapshot()
+   assert values(restored.states()) == values(demand.states())
+
+
+
+def test_extremes_of_the_day():
+   extremes = DailyExtremes()
+   for text, used, produced in [("2021-05-01 03:00", 300.0, 0.0), ("2021-05-01 04:00", 250.0, 0.0),
+                                ("2021-05-01 07:00", 120.0, 0.0),     # Lower, but not at night
+                                ("2021-05-01 13:00", 900.0, 2500.0), ("2021-05-01 18:00", 3100.0, 400.0)]:
+      extremes.add(Reading(timestamp=local(text), nowUsage=used, nowGenerated=produced))
+   state = values(extremes.states())
+   assert (state['minUsedToday'], state['minUsedTime']) == (250.0, "04:00:00")
+   assert (state['maxUsedToday'], state['maxUsedTime']) == (3100.0, "18:00:00")
+   assert (state['maxProducedToday'], state['maxProducedTime']) == (2500.0, "13:00:00")
+
+   # A restart the same day goes on with the saved extremes
+   restored = DailyExtremes(json.loads(json.dumps(extremes.snapshot())))
+   restored.add(Reading(timestamp=local("2021-05-01 20:00"), nowUsage=1000.0))
+   assert values(restored.states()) == state
+
+   # Back over midnight is ignored, the next day starts over
+   extremes.add(Reading(timestamp=local("2021-04-30 23:59"), nowUsage=9000.0))
+   assert values(extremes.states()) == state
+   extremes.add(Reading(timestamp=local("2021-05-02 09:00"), nowUsage=500.0, nowGenerated=50.0))
+   state = values(extremes.states())
+   assert (state['minUsedToday'], state['minUsedTime']) == ("", "")
+   assert (state['maxUsedToday'], state['maxUsedTime']) == (500.0, "09:00:00")
+   assert state['maxProducedToday'] == 50.0
+
+
+
+def test_state_cache_sends_changes():
+   cache = StateCache()
+   now = local("2021-05-01 12:00")
+   def push(states, at, fullRefresh=60):
+      changed, sent, refresh = cache.changes(7, states, fullRefresh, at)
+      cache.stored(7, changed)
+      return values(changed), sent, refresh
+
+   # The first push sends everything, then only changes and statesSent when its count changed
+   assert push([{'key':'a', 'value':1}, {'key':'b', 'value':2}], now) == ({'a':1, 'b':2, 'statesSent':2}, 2, True)
+   assert push([{'key':'a', 'value':1}, {'key':'b', 'value':3}], now + 10) == ({'b':3, 'statesSent':1}, 1, False)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 20) == ({'a':4}, 1, False)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 30) == ({'statesSent':0}, 0, False)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 40) == ({}, 0, False)
+
+   # Every fullRefresh minutes all states again
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 3600) == ({'a':4, 'b':3, 'statesSent':2}, 2, True)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 3660) == ({'statesSent':0}, 0, False)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 9000, fullRefresh=0) == ({}, 0, False)
+
+   # A state set outside the push, and a device that stopped
+   cache.forget(7, 'b')
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 9010, fullRefresh=0) == ({'b':3, 'statesSent':1}, 1, False)
+   cache.forget(7)
+   assert push([{'key':'a', 'value':4}, {'key':'b', 'value':3}], now + 9020) == ({'a':4, 'b':3, 'statesSent':2}, 2, True)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   NetworkReader and TcpSource against tools/tcpserver.py: an error in one telegram or
+#   one source must not silence the others
+#
+##########################################################################################
+
+import time
+import logging
+import argparse
+import threading
+
+import pytest
+
+import tcpserver
+import smartmeter
+from smartmeter import NetworkReader, TcpSource
+
+
+
+class Host(object):
+   # The parts of the plugin that the readers call back into
+   max_telegram_size = 8192
+
+   def __init__(self):
+      self.logger = logging.getLogger("test_network")
+      self.crcCounts = {}
+
+   def verbose(self, logtext):
+      pass
+
+   def countCrc(self, result):
+      self.crcCounts[result] = self.crcCounts.get(result, 0) + 1
+
+
+
+@pytest.fixture
+def bridge():
+   args = argparse.Namespace(dsmr="5", capture=None, interval=0.05, mbus=1, outages=1, drop_after=0, stall_after=0)
+   server = tcpserver.Bridge(("127.0.0.1", 0), args)
+   thread = threading.Thread(target=server.serve_forever)
+   thread.daemon = True
+   thread.start()
+   yield server.server_address
+   server.stopping.set()
+   server.shutdown()
+   server.server_close()
+
+
+
+@pytest.fixture
+def network():
+   reader = NetworkReader(Host())
+   reader.tick = 0.1
+   reader.start()
+   yield reader
+   reader.stop()
+   reader.join(5)
+
+
+
+def wait_for(condition, timeout=5):
+   deadline = time.time() + timeout
+   while not condition() and time.time() < deadline:
+      time.sleep(0.02)
+   return condition()
+
+
+
+def test_failing_handler_keeps_reading(bridge, network):
+   received = []
+   def handler(packet):
+      received.append(packet)
+      if len(received) == 1:
+         raise RuntimeError("handler failed")
+   source = network.add(TcpSource(Host(), bridge[0], bridge[1], handler=handler))
+   assert wait_for(lambda: len(received) >= 3)
+   assert network.is_alive()
+   assert source.sock is not None
+
+
+
+def test_failing_source_keeps_others(bridge, network):
+   good = []
+   broken = TcpSource(Host(), bridge[0], bridge[1])
+   def readable(now):
+      raise RuntimeError("source failed")
+   broken.readable = readable
+   network.add(broken)
+   network.add(TcpSource(Host(), bridge[0], bridge[1], handler=good.append))
+   assert wait_for(lambda: len(good) >= 3)
+   assert network.is_alive()
+   # The broken source was closed and waits for its backoff
+   assert broken.retry_at > 0
+
+
+
+def test_remove_while_selecting(bridge, network, monkeypatch):
+   # remove() from the plugin thread right when the source is handed to select(): the
+   # network thread closes it after the select() and goes on with the other sources
+   good = []
+   removed = TcpSource(Host(), bridge[0], bridge[1], handler=lambda packet: None)
+   select = smartmeter.select.select
+   class Select(object):
+      error = smartmeter.select.error
+      @staticmethod
+      def select(readers, writers, failed, timeout):
+         if removed in readers and removed in network.sources:
+            network.remove(removed)
+         return select(readers, writers, failed, timeout)
+   monkeypatch.setattr(smartmeter, "select", Select)
+
+   network.add(removed)
+   network.add(TcpSource(Host(), bridge[0], bridge[1], handler=good.append))
+   assert wait_for(lambda: removed not in network.sources)
+   assert wait_for(lambda: removed.sock is None)
+   assert wait_for(lambda: len(good) >= 3)
+   assert network.is_alive()
+   assert removed.packets == 0
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   P1Packet.parse() against the regex parser it replaced, on TESTGRAM and on synthetic
+#   telegrams from tools/telegrams.py. The regex parser only lives here as a reference:
+#   it cannot read DSMR 2.2 or an empty outage log, so those telegrams are checked
+#   against the values the generator put in
+#
+##########################################################################################
+
+import re
+import itertools
+
+import pytest
+
+import telegrams
+from smartmeter import P1Packet, Reading, TESTGRAM, CRC_VALID, CRC_MISSING, parse_frame
+
+
+
+class RegexParser(object):
+   # The original parser: one regex search over the whole datagram per field
+
+   def __init__(self, datagram):
+      self._datagram = datagram
+
+
+
+   def parse(self):
+      keys = {}
+      keys['header'] = {}
+      keys['msg'] = {}
+      keys['kwh'] = {}
+      keys['kwh']['low'] = {}
+      keys['kwh']['high'] = {}
+      keys['kwh']['outages'] = {}
+      keys['kwh']['phase1'] = {}
+      keys['kwh']['phase2'] = {}
+      keys['kwh']['phase3'] = {}
+      
+      # /Ene5\T210-D ESMR5.0
+      #  ^^^
+      keys['header']['netManager'] =   self.get(br'^/s*(.{3})')
+
+      # /Ene5\T210-D ESMR5.0
+      #       ^^^^^^
+      keys['header']['meterType'] =    self.get(br'^(?:/s*.{3}.{2})(\S*)(?:.*)')
+
+      # 1-3:0.2.8(50)
+      #           ^^
+      keys['header']['dsmrVersion'] =  self.get(br'^(?:1\-3\:0\.2\.8\()(.*)(?:\))')
+
+      # 0-0:1.0.0(200411171526S)
+      #           ^^^^^^^^^^^^
+      keys['header']['measured_at'] =  self.ts(br'^(?:0-0:1\.0\.0\()(\d*)')
+
+      # 0-0:96.1.1(4530303438303030303235313238343138)
+      #            ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+      keys['kwh']['eid'] =             self.get(br'^0-0:96\.1\.1\(([^)]+)\)')
+
+      # 0-0:96.14.0(0001)
+      #             ^^^^
+      keys['kwh']['tariff'] =          self.get_int(br'^0-0:96\.14\.0\(([0-9]+)\)')
+
+      # 0-0:96.3.10(?)
+      #             ^
+      keys['kwh']['switch'] =          self.get_int(br'^0-0:96\.3\.10\((\d)\)')
+
+      # 0-0:17.0.0(????.??*kW)
+      #            ^^^^^^^
+      keys['kwh']['treshold'] =        self.get_float(br'^0-0:17\.0\.0\(([0-9]{4}\.[0-9]{2})\*kW\)')
+
+      # 1-0:1.8.1(004486.031*kWh)
+      #           ^^^^^^^^^^
+      keys['kwh']['low']['consumed'] =  self.get(br'^1-0:1\.8\.1\(([0-9]+\.[0-9]+)\*kWh\)')
+      
+      # 1-0:2.8.1(000732.442*kWh)
+      #           ^^^^^^^^^^
+      keys['kwh']['low']['produced'] =  self.get(br'^1-0:2\.8\.1\(([0-9]+\.[0-9]+)\*kWh\)')
+
+       # 1-0:1.8.2(002272.913*kWh)
+      #           ^^^^^^^^^^
+      keys['kwh']['high']['consumed'] = self.get(br'^1-0:1\.8\.2\(([0-9]+\.[0-9]+)\*kWh\)')
+      
+      # 1-0:2.8.2(001838.277*kWh)
+      #           ^^^^^^^^^^
+      keys['kwh']['high']['produced'] = self.get(br'^1-0:2\.8\.2\(([0-9]+\.[0-9]+)\*kWh\)')
+
+      # 1-0:1.7.0(00.000*kW)
+      #           ^^^^^^^^^^
+      keys['kwh']['current_consumed'] = self.get(br'^1-0:1\.7\.0\(([0-9]+\.[0-9]+)\*kW\)')
+
+      # 1-0:2.7.0(02.403*kW)
+      #           ^^^^^^^^^^
+      keys['kwh']['current_produced'] = self.get(br'^1-0:2\.7\.0\(([0-9]+\.[0-9]+)\*kW\)')
+
+      # 0-0:96.7.21(00673)
+      #             ^^^^^
+      keys['kwh']['outages']['shortcount'] = int(self.get(br'^0-0:96\.7\.21\((\d*)'))
+
+      # 0-0:96.7.9(00006)
+      #             ^^^^^
+      keys['kwh']['outages']['longcount'] = int(self.get(br'^0-0:96\.7\.9\((\d*)'))
+
+      # 1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)
+      #                             ^^^^^^^^^^^^^
+      keys['kwh']['outages']['timestamp'] = self.ts(br'^(?:1-0:99\.97\.0\([0-9*]\)\(0-0\:96\.7\.19\)\()(\d*)')
+
+      # 1-0:99.97.0(1)(0-0:96.7.19)(180806173744S)(0000000737*s)
+      #                                           ^^^^^^^^^^
+      keys['kwh']['outages']['duration'] = int(self.get(br'^(?:1-0:99\.97\.0\([0-9*]\)\(0-0\:96\.7\.19\)\()\d*[SW]\)\((\d*)'))
+
+      # 1-0:32.32.0(00002)
+      #             ^^^^^
+      keys['kwh']['phase1']['saggs'] = int(self.get(br'^(?:1-0:32\.32\.0\()(\d*)'))
+
+      # 1-0:52.32.0(00002)
+      #             ^^^^^
+      keys['kwh']['phase2']['saggs'] = int(self.get(br'^(?:1-0:52\.32\.0\()(\d*)'))
+
+      # 1-0:72.32.0(00002)
+      #             ^^^^^
+      keys['kwh']['phase3']['saggs'] = int(self.get(br'^(?:1-0:72\.32\.0\()(\d*)'))
+
+      # 1-0:32.36.0(00000)
+      #             ^^^^^
+      keys['kwh']['phase1']['swells'] = int(self.get(br'^(?:1-0:32\.36\.0\()(\d*)'))
+
+      # 1-0:52.36.0(00000)
+      #             ^^^^^
+      keys['kwh']['phase2']['swells'] = int(self.get(br'^(?:1-0:52\.36\.0\()(\d*)'))
+
+      # 1-0:72.36.0(00000)
+      #             ^^^^^
+      keys['kwh']['phase3']['swells'] = int(self.get(br'^(?:1-0:72\.36\.0\()(\d*)'))
+
+      # 1-0:32.7.0(235.0*V)
+      #            ^^^^^
+      keys['kwh']['phase1']['volt'] = int(self.get(br'^(?:1-0:32\.7\.0\()(\d*)'))
+
+      # 1-0:52.7.0(233.0*V)
+      #            ^^^^^
+      keys['kwh']['phase2']['volt'] = int(self.get(br'^(?:1-0:52\.7\.0\()(\d*)'))
+
+      # 1-0:72.7.0(238.0*V)
+      #            ^^^^^
+      keys['kwh']['phase3']['volt'] = int(self.get(br'^(?:1-0:72\.7\.0\()(\d*)'))
+
+      # 1-0:31.7.0(003*A)
+      #            ^^^
+      keys['kwh']['phase1']['amps'] = int(self.get(br'^(?:1-0:31\.7\.0\()(\d*)'))
+
+      # 1-0:51.7.0(003*A)
+      #            ^^^
+      keys['kwh']['phase2']['amps'] = int(self.get(br'^(?:1-0:51\.7\.0\()(\d*)'))
+
+      # 1-0:71.7.0(004*A)
+      #            ^^^
+      keys['kwh']['phase3']['amps'] = int(self.get(br'^(?:1-0:71\.7\.0\()(\d*)'))
+
+      # 1-0:21.7.0(00.000*kW)
+      #            ^^^^^^
+      keys['kwh']['phase1']['usedNow'] = self.get(br'^(?:1-0:21\.7\.0\()(\d*\.\d*)')
+
+      # 1-0:41.7.0(00.000*kW)
+      #            ^^^^^^
+      keys['kwh']['phase2']['usedNow'] = self.get(br'^(?:1-0:41\.7\.0\()(\d*\.\d*)')
+
+      # 1-0:61.7.0(00.000*kW)
+      #            ^^^^^^
+      keys['kwh']['phase3']['usedNow'] = self.get(br'^(?:1-0:61\.7\.0\()(\d*\.\d*)')
+
+      # 1-0:22.7.0(00.768*kW)
+      #            ^^^^^^
+      keys['kwh']['phase1']['producedNow'] = self.get(br'^(?:1-0:22\.7\.0\()(\d*\.\d*)')
+
+      # 1-0:42.7.0(00.699*kW)
+      #            ^^^^^^
+      keys['kwh']['phase2']['producedNow'] = self.get(br'^(?:1-0:42\.7\.0\()(\d*\.\d*)')
+
+      # 1-0:62.7.0(00.935*kW)
+      #            ^^^^^^
+      keys['kwh']['phase3']['producedNow'] = self.get(br'^(?:1-0:62\.7\.0\()(\d*\.\d*)')
+
+      keys['gas'] = {}
+      # 0-1:24.2.1(200411171500S)(00889.906*m3)
+      #                                     ^^
+      keys['gas']['unit'] = self.get(br'^(?:0-1:24\.2\.1(?:\(\d+[SW]\))?)?\([0-9]{5}\.[0-9]{3}(?:\*(\S*))\)', 0)
+
+      # 0-1:96.1.0(4730303538353330303337363337333139)
+      #            ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+      keys['gas']['eid'] = self.get(br'^0-1:96\.1\.0\(([^)]+)\)',"30")
+
+      # 0-1:24.1.0(003)
+      #            ^^^
+      keys['gas']['device_type'] = self.get_int(br'^0-1:24\.1\.0\((\d)+\)',0)
+      
+      # 0-1:24.2.1(200411171500S)(00889.906*m3)
+      #            ^^^^^^^^^^^^^
+      keys['gas']['measured_at'] = self.ts(br'^(?:0-1:24\.[23]\.[01](?:\((\d+)[SW]?\))?)')
+
+      # 0-1:24.2.1(200411171500S)(00889.906*m3)
+      #                           ^^^^^^^^^
+      keys['gas']['total'] = self.get(br'^(?:0-1:24\.2\.1(?:\(\d+[SW]\))?)?\(([0-9]{5}\.[0-9]{3})(?:\*m3)\)', 0)
+
+      # 0-1:24.4.0(????)
+      #            ^^^^
+      keys['gas']['valve'] = self.get_int(br'^0-1:24\.4\.0\((\d)\)',0)
+
+      # 0-0:96.13.1( )
+      #             ^
+      keys['msg']['code'] = self.get(br'^0-0:96\.13\.1\((\d+)\)')
+
+      # 0-0:96.13.0( )
+      #             ^
+      keys['msg']['text'] = self.get(br'^0-0:96\.13\.0\((.+)\)','')
+
+      return keys
+
+
+
+   def get_float(self, regex, default=None):
+      result = self.get(regex, None)
+      if not result:
+         return default
+      return float(result)
+
+
+
+   def get_int(self, regex, default=None):
+      result = self.get(regex, None)
+      if not result:
+         return default
+      return int(result)
+
+
+
+   def get(self, regex, default=None):
+      results = re.search(regex, self._datagram, re.MULTILINE)
+      if not results:
+         return default
+      return results.group(1).decode('ascii')
+
+
+   def ts(self,regex, default=None):
+      results = self.get(regex, None)
+      if not results:
+         return None 
+      v = results
+      if len(v) != 12:
+         return None 
+      return  "20{}-{}-{}T{}:{}:{}".format(v[0:2],v[2:4],v[4:6],v[6:8],v[8:10],v[10:12])
+
+
+
+def flatten(keys, prefix):
+   # {'phase1': {'volt': 229}} -> {'kwh.phase1.volt': 229}
+   flat = {}
+   for key, value in keys.items():
+      if isinstance(value, dict):
+         flat.update(flatten(value, prefix + "." + key))
+      else:
+         flat[prefix + "." + key] = value
+   return flat
+
+
+
+def differences(datagram):
+   packet = P1Packet(datagram)
+   expected = RegexParser(datagram).parse()
+   found = {}
+   wanted = {}
+   for section in expected:
+      wanted.update(flatten(expected[section], section))
+      found.update(flatten(packet[section], section))
+   return dict((field, (value, found.get(field))) for field, value in wanted.items() if found.get(field) != value)
+
+
+
+def test_testgram_parity():
+   assert differences(TESTGRAM) == {}
+
+
+
+@pytest.mark.parametrize("version", ["4", "5"])
+@pytest.mark.parametrize("mbus", [1, 2, 4])
+@pytest.mark.parametrize("text", ["", "Onderhoud aan het net"])
+def test_synthetic_parity(version, mbus, text):
+   for datagram in itertools.islice(telegrams.stream(version, mbus=mbus, outages=1, text=text), 3):
+      assert differences(datagram) == {}
+
+
+
+@pytest.mark.parametrize("version,outages", [("2.2", 0), ("4", 0), ("5", 0), ("5", 10)])
+def test_values_where_regex_fails(version, outages):
+   meter = telegrams.Meter(seed=1, when=1609924729, mbus=2)
+   packet = P1Packet(telegrams.telegram(version, meter, mbus=2, outages=outages, text="Hello"))
+   reading = packet.reading
+   assert packet.crc == (CRC_MISSING if version == "2.2" else CRC_VALID)
+   assert (reading.usedT1, reading.usedT2) == (round(meter.usedT1, 3), round(meter.usedT2, 3))
+   assert (reading.generatedT1, reading.generatedT2) == (round(meter.generatedT1, 3), round(meter.generatedT2, 3))
+   assert reading.tariff == meter.tariff
+   assert reading.gasUsed == round(meter.mbus[0], 3)
+   assert packet['kwh']['outages']['longcount'] == outages
+   assert packet['msg']['text'] == "48656C6C6F"
+
+
+
+def test_next_telegram_reuses_lines():
+   # Parsing with the previous telegram of the meter gives the same result as without
+   first, second = itertools.islice(telegrams.stream("5", mbus=2, outages=3), 2)
+   previous = P1Packet(first)
+   assert P1Packet(second, previous=previous)._keys == P1Packet(second)._keys
+   assert repr(P1Packet(second, previous=previous).reading) == repr(P1Packet(second).reading)
+
+
+
+def test_parse_frame():
+   # The replay worker: values of the Reading, or the reason a telegram was rejected
+   values, error = parse_frame((TESTGRAM, True))
+   assert error is None
+   assert dict(zip(Reading.__slots__, values))['usedT1'] == P1Packet(TESTGRAM).reading.usedT1
+   values, error = parse_frame((TESTGRAM.replace(b"(003)", b"(004)"), True))
+   assert values is None and "checksum" in error
+
+
+
+def test_dsmr22_channels_out_of_order():
+   # The value line of 0-n:24.3.0 belongs to channel n, also when a higher channel came first
+   def reordered(gas):
+      meter = telegrams.Meter(seed=1, when=1609924729, mbus=2)
+      meter.mbus[0] = gas
+      lines = telegrams.telegram("2.2", meter, mbus=2).split(b"\r\n")
+      first = next(index for index, line in enumerate(lines) if line.startswith(b"0-1:"))
+      lines[first:first + 10] = lines[first + 5:first + 10] + lines[first:first + 5]
+      return b"\r\n".join(lines)
+
+   previous = P1Packet(reordered(500.0))
+   assert previous.reading.gasUsed == 500.0
+   packet = P1Packet(reordered(600.0), previous=previous)
+   assert packet.reading.gasUsed == 600.0
+   assert packet['mbus'][1]['value'] == P1Packet(reordered(600.0))['mbus'][1]['value'] != previous['mbus'][1]['value']
+   assert packet._keys == P1Packet(reordered(600.0))._keys
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   The checks of tools/benchmark.py and tools/latency.py as tests: every pipeline stage
+#   against the committed baseline, and the serial path against a simulated meter on a pty
+#
+##########################################################################################
+
+import json
+
+import pytest
+
+import benchmark
+
+pytestmark = pytest.mark.perf
+
+
+
+def test_benchmark_against_baseline():
+   # Loose tolerance: a stage has to get twice as slow, short runs on a busy machine vary
+   with open(benchmark.BASELINE) as f:
+      stored = json.load(f)
+   scale = benchmark.calibrate(0.2) / stored["calibration"]
+   results = benchmark.benchmark(benchmark.PROFILES, benchmark.STAGES, 0.1)
+   assert sorted(results) == sorted(stored["results"])
+   assert benchmark.report(results, stored["results"], 1.0, scale) == []
+
+
+
+@pytest.mark.parametrize("options", [
+   ["--dsmr", "5", "--interval", "0.1", "--count", "20", "--noise", "0.1", "--truncate", "0.1", "--bad-crc", "0.1"],
+   ["--dsmr", "4", "--interval", "0.1", "--count", "5", "--mode", "cycle"],
+   ["--dsmr", "2.2", "--interval", "0.8", "--count", "3"],
+])
+def test_simulated_meter(options):
+   latency = pytest.importorskip("latency")          # Needs a pty
+   args = latency.arguments(options + ["--seed", "5"])
+   run, meter, host, ms = latency.measure(args)
+   assert latency.problems(run, meter, ms, args.count, 100.0) == []
+   assert host.crcCounts.get("invalid", 0) == meter.counts["bad crc"]
@@ -0,0 +1,240 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Benchmark for the telegram pipeline in smartmeter.py
+#
+#   Every stage is timed on synthetic telegrams from telegrams.py, for a number of meter
+#   profiles (DSMR version, M-Bus channels, outage log length and text message):
+#
+#     framing      FrameAssembler on the telegram fed in 64 byte serial reads
+#     crc          crc16 over the telegram
+#     parse        P1Packet.parse(), the single pass tokenizer
+#     parse_next   P1Packet.parse() of the next telegram of the same meter, reusing the
+#                  lines the two have in common
+#     states       P1Packet.states(), the device state dicts
+#
+#   For each stage it reports telegrams/s, µs per telegram and µs per OBIS field. Under
+#   Python 3 it also reports the bytes allocated per telegram (tracemalloc peak).
+#
+#   python benchmark.py --save baseline.json      store the results as a baseline
+#   python benchmark.py --compare baseline.json   exit 1 on stages slower than the baseline
+#   python benchmark.py --check                   the same against the committed baseline.json
+#
+#   Every run also times a fixed piece of plain Python work. Timings are compared relative
+#   to it, so a baseline made on a faster or slower machine still tells a regression apart.
+#
+##########################################################################################
+
+import os
+import sys
+import json
+import platform
+import argparse
+import timeit
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import telegrams
+from smartmeter import FrameAssembler, P1Packet, crc16
+
+try:
+   import tracemalloc
+except ImportError:
+   tracemalloc = None
+
+# name -> telegram() arguments
+PROFILES = [
+   ("dsmr22",            dict(version="2.2", mbus=1, outages=0)),
+   ("dsmr4",             dict(version="4",   mbus=1, outages=1)),
+   ("dsmr5",             dict(version="5",   mbus=1, outages=1)),
+   ("dsmr5-mbus4",       dict(version="5",   mbus=4, outages=1)),
+   ("dsmr5-outages30",   dict(version="5",   mbus=1, outages=30)),
+   ("dsmr5-text",        dict(version="5",   mbus=1, outages=1, text="Onderhoud aan het net op 12 maart tussen 09:00 en 12:00 " * 8)),
+]
+
+CHUNK = 64
+
+# Committed baseline, see --check
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+
+def _fields(telegram):
+   # OBIS data lines, the 2.2 gas continuation line included
+   return sum(1 for line in telegram.split(b"\n") if line[:1].isdigit() or line[:1] == b"(")
+
+
+
+def _framing(telegram, following):
+   chunks = [telegram[start:start + CHUNK] for start in range(0, len(telegram), CHUNK)]
+   assembler = FrameAssembler()
+   def run():
+      for chunk in chunks:
+         assembler.feed(chunk)
+      return assembler.next_frame()
+   return run
+
+
+
+def _crc(telegram, following):
+   data = bytearray(telegram)
+   end = telegram.rfind(b"!") + 1
+   return lambda: crc16(data, 0, end)
+
+
+
+def _parse(telegram, following):
+   return P1Packet(telegram).parse
+
+
+
+def _parse_next(telegram, following):
+   previous = P1Packet(telegram)
+   packet = P1Packet(following)
+   return lambda: packet.parse(previous)
+
+
+
+def _states(telegram, following):
+   return P1Packet(telegram).states
+
+
+
+STAGES = [
+   ("framing",     _framing),
+   ("crc",         _crc),
+   ("parse",       _parse),
+   ("parse_next",  _parse_next),
+   ("states",      _states),
+]
+
+
+
+def measure(run, seconds):
+   # Best of five runs of about seconds/5 each, in µs per call
+   number = 1
+   while True:
+      elapsed = timeit.timeit(run, number=number)
+      if elapsed > seconds / 50.0:
+         break
+      number *= 4
+   number = max(1, int(number * seconds / 5.0 / elapsed))
+   return min(timeit.repeat(run, number=number, repeat=5)) / number * 1e6
+
+
+
+def calibrate(seconds):
+   # µs for a fixed piece of plain Python work: a loop, arithmetic and list indexing like
+   # the CRC and the parser do
+   table = list(range(256))
+   def run():
+      total = 0
+      for value in range(1000):
+         total = (total >> 8) ^ table[(total ^ value) & 0xFF]
+      return total
+   return measure(run, seconds)
+
+
+
+def allocated(run):
+   # Peak of memory allocated during one call, in bytes
+   if tracemalloc is None:
+      return None
+   run()
+   tracemalloc.start()
+   try:
+      run()
+      return tracemalloc.get_traced_memory()[1]
+   finally:
+      tracemalloc.stop()
+
+
+
+def benchmark(profiles, stages, seconds):
+   results = {}
+   for profile, arguments in profiles:
+      # The first telegram of a stream is the one telegram() makes
+      telegram, following = itertools.islice(telegrams.stream(**arguments), 2)
+      fields = _fields(telegram)
+      for stage, setup in stages:
+         run = setup(telegram, following)
+         us = measure(run, seconds)
+         results["{}/{}".format(profile, stage)] = {
+            "bytes":         len(telegram),
+            "fields":        fields,
+            "us":            round(us, 2),
+            "per_second":    int(1e6 / us),
+            "us_per_field":  round(us / fields, 3),
+            "alloc_bytes":   allocated(run),
+         }
+   return results
+
+
+
+def report(results, baseline=None, tolerance=0.2, scale=1.0):
+   # scale: how much slower this machine is than the one that made the baseline
+   print("{:<30} {:>8} {:>12} {:>10} {:>12} {:>10}".format("profile/stage", "fields", "telegrams/s", "us", "us/field", "alloc"))
+   regressions = []
+   for name in sorted(results):
+      result = results[name]
+      line = "{:<30} {:>8} {:>12} {:>10.2f} {:>12.3f} {:>10}".format(
+         name, result["fields"], result["per_second"], result["us"], result["us_per_field"],
+         "-" if result["alloc_bytes"] is None else result["alloc_bytes"])
+      if baseline and name in baseline:
+         change = result["us"] / (baseline[name]["us"] * scale) - 1
+         line += "  {:+.1%}".format(change)
+         if change > tolerance:
+            line += "  SLOWER"
+            regressions.append(name)
+      print(line)
+   return regressions
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Benchmark framing, CRC, parsing and state building")
+   parser.add_argument("--seconds", type=float, default=1.0, help="Time spent per stage and profile")
+   parser.add_argument("--profile", action="append", help="Only run these profiles")
+   parser.add_argument("--stage", action="append", help="Only run these stages")
+   parser.add_argument("--save", metavar="JSON", help="Store the results as a baseline")
+   parser.add_argument("--compare", metavar="JSON", help="Compare with a stored baseline")
+   parser.add_argument("--check", action="store_true", help="Compare with the committed baseline.json")
+   parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline, 0.2 is 20%%")
+   args = parser.parse_args()
+
+   profiles = [profile for profile in PROFILES if not args.profile or profile[0] in args.profile]
+   stages = [stage for stage in STAGES if not args.stage or stage[0] in args.stage]
+
+   compare = args.compare or (BASELINE if args.check else None)
+   calibration = calibrate(args.seconds)
+   baseline = None
+   scale = 1.0
+   if compare:
+      with open(compare) as f:
+         stored = json.load(f)
+      if stored["python"].split(".")[:2] != platform.python_version().split(".")[:2]:
+         print("Baseline was made with Python {}, timings may not compare".format(stored["python"]))
+      baseline = stored["results"]
+      scale = calibration / stored.get("calibration", calibration)
+      print("This machine is {:.2f} times as fast as the one that made the baseline".format(1 / scale))
+
+   results = benchmark(profiles, stages, args.seconds)
+   regressions = report(results, baseline, args.tolerance, scale)
+
+   if args.save:
+      with open(args.save, "w") as f:
+         json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                    "calibration": round(calibration, 3), "results": results}, f, indent=2, sort_keys=True)
+         f.write("\n")
+      print("Saved baseline to {}".format(args.save))
+
+   if regressions:
+      print("{} stage(s) slower than the baseline: {}".format(len(regressions), ", ".join(regressions)))
+      sys.exit(1)
+
+
+
+if __name__ == "__main__":
+   main()
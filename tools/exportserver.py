@@ -0,0 +1,342 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Local stand-in for InfluxDB and an MQTT broker, to try the exporters against
+#
+#   InfluxDB: line protocol is accepted on any path over HTTP, gzip compressed or not,
+#   and over UDP. Every batch is counted and its newest point printed.
+#   MQTT: a small 3.1.1 broker. It acknowledges QoS 1 publishes, keeps retained messages
+#   and forwards to subscribers (+ and # wildcards), so mosquitto_sub can watch along.
+#
+#   To test the spool, the server can go down for a while (--down-at, --down-for): HTTP
+#   answers 503 and MQTT connections are closed or refused, then it comes back. With
+#   --idle-timeout, idle keep-alive connections are closed like InfluxDB does.
+#
+#   Everything received is also kept on the servers (received, messages), so the tests in
+#   tests/test_exporters.py can check it.
+#
+#   python exportserver.py --down-at 60 --down-for 120
+#
+#   Then set the plugin to export to http://127.0.0.1:8086/write?db=p1meter (or
+#   udp://127.0.0.1:8089) and to the MQTT broker 127.0.0.1, port 1883.
+#
+##########################################################################################
+
+import sys
+import time
+import zlib
+import struct
+import argparse
+import threading
+
+try:
+   import socketserver
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+   import SocketServer as socketserver
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+
+class Outage(object):
+   # Down from at until at + duration seconds after the start, or while forced is set
+   def __init__(self, at=0, duration=0):
+      self.started = time.time()
+      self.at = at
+      self.duration = duration
+      self.forced = False
+
+
+
+   def down(self):
+      if self.forced:
+         return True
+      if not self.duration:
+         return False
+      elapsed = time.time() - self.started
+      return self.at <= elapsed < self.at + self.duration
+
+
+
+def report(source, lines):
+   # One line per batch: the number of points and the newest one, shortened
+   newest = lines[-1].decode("utf-8", "replace") if lines else ""
+   print("{:<6} {:>5} points  {}".format(source, len(lines), newest[:100]))
+   sys.stdout.flush()
+
+
+
+class InfluxHandler(BaseHTTPRequestHandler):
+   protocol_version = "HTTP/1.1"          # Keep-alive, like InfluxDB
+
+   def setup(self):
+      # One handler per connection; the timeout closes it after being idle that long
+      self.timeout = self.server.idle_timeout or None
+      self.server.connections += 1
+      BaseHTTPRequestHandler.setup(self)
+
+
+
+   def do_POST(self):
+      body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+      if self.server.outage.down():
+         self.answer(503, b'{"error":"down for testing"}')
+         return
+      if self.headers.get("Content-Encoding") == "gzip":
+         try:
+            body = zlib.decompress(body, 31)
+         except zlib.error as e:
+            self.answer(400, '{{"error":"bad gzip: {}"}}'.format(e).encode("utf-8"))
+            return
+         self.server.gzipped += 1
+      lines = [line for line in body.split(b"\n") if line.strip()]
+      self.server.received.extend(lines)
+      report("http", lines)
+      self.answer(204, b"")
+
+
+
+   def answer(self, status, body):
+      self.send_response(status)
+      self.send_header("Content-Length", str(len(body)))
+      if body:
+         self.send_header("Content-Type", "application/json")
+      self.end_headers()
+      self.wfile.write(body)
+
+
+
+   def log_message(self, format, *args):
+      pass
+
+
+
+class InfluxServer(socketserver.ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, address, outage, idle_timeout=0):
+      HTTPServer.__init__(self, address, InfluxHandler)
+      self.outage = outage
+      self.idle_timeout = idle_timeout   # Seconds, 0 keeps idle connections open
+      self.received = []                 # Every line of line protocol, in order
+      self.connections = 0
+      self.gzipped = 0                   # Batches that came gzip compressed
+
+
+
+class UdpHandler(socketserver.BaseRequestHandler):
+
+   def handle(self):
+      if self.server.outage.down():
+         return
+      lines = [line for line in self.request[0].split(b"\n") if line.strip()]
+      self.server.received.extend(lines)
+      report("udp", lines)
+
+
+
+class UdpServer(socketserver.ThreadingUDPServer):
+
+   def __init__(self, address, outage):
+      socketserver.ThreadingUDPServer.__init__(self, address, UdpHandler)
+      self.outage = outage
+      self.received = []
+
+
+
+def _string(data, offset):
+   # MQTT UTF-8 string at offset -> (bytes, offset after it)
+   length = struct.unpack("!H", data[offset:offset + 2])[0]
+   return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+
+def _packet(kind, body):
+   header = bytearray([kind])
+   length = len(body)
+   while True:
+      byte = length % 128
+      length //= 128
+      header.append(byte | 0x80 if length else byte)
+      if not length:
+         return bytes(header) + body
+
+
+
+def _matches(pattern, topic):
+   # MQTT topic filter with + for one level and # for the rest
+   parts = pattern.split(b"/")
+   levels = topic.split(b"/")
+   for index, part in enumerate(parts):
+      if part == b"#":
+         return True
+      if index >= len(levels) or (part != b"+" and part != levels[index]):
+         return False
+   return len(parts) == len(levels)
+
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, address, outage):
+      socketserver.TCPServer.__init__(self, address, MqttClient)
+      self.outage = outage
+      self.lock = threading.Lock()
+      self.clients = set()
+      self.retained = {}
+      self.messages = []                 # (topic, payload, QoS, retain) of every publish
+
+
+
+   def publish(self, topic, payload):
+      # Forward to every subscriber with QoS 0
+      packet = _packet(0x30, struct.pack("!H", len(topic)) + topic + payload)
+      with self.lock:
+         clients = list(self.clients)
+      for client in clients:
+         if any(_matches(pattern, topic) for pattern in client.patterns):
+            client.send(packet)
+
+
+
+class MqttClient(socketserver.BaseRequestHandler):
+
+   def setup(self):
+      self.patterns = set()
+      self.sendLock = threading.Lock()
+      self.name = "{}:{}".format(*self.client_address[:2])
+      self.published = 0
+
+
+
+   def send(self, data):
+      with self.sendLock:
+         try:
+            self.request.sendall(data)
+         except (IOError, OSError):
+            pass
+
+
+
+   def recv(self, count):
+      data = b""
+      while len(data) < count:
+         chunk = self.request.recv(count - len(data))
+         if not chunk:
+            raise EOFError()
+         data += chunk
+      return data
+
+
+
+   def read(self):
+      first = bytearray(self.recv(1))[0]
+      length = 0
+      shift = 0
+      while True:
+         byte = bytearray(self.recv(1))[0]
+         length += (byte & 0x7F) << shift
+         shift += 7
+         if not byte & 0x80:
+            break
+      return first, self.recv(length)
+
+
+
+   def handle(self):
+      server = self.server
+      if server.outage.down():
+         print("mqtt   {} refused, down for testing".format(self.name))
+         return
+      with server.lock:
+         server.clients.add(self)
+      try:
+         while True:
+            first, body = self.read()
+            if server.outage.down():
+               print("mqtt   {} closed, down for testing".format(self.name))
+               break
+            kind = first & 0xF0
+            if kind == 0x10:
+               clientId = _string(body, 10)[0]
+               print("mqtt   {} connected as {}".format(self.name, clientId.decode("utf-8", "replace")))
+               self.send(_packet(0x20, b"\x00\x00"))
+            elif kind == 0x30:
+               qos = (first >> 1) & 0x03
+               topic, offset = _string(body, 0)
+               if qos:
+                  self.send(_packet(0x40, body[offset:offset + 2]))
+                  offset += 2
+               payload = body[offset:]
+               server.messages.append((topic, payload, qos, bool(first & 0x01)))
+               if first & 0x01:
+                  server.retained[topic] = payload
+               elif topic.endswith(b"/reading"):
+                  self.published += 1
+                  if self.published % 10 == 1:
+                     report("mqtt", [payload])
+               server.publish(topic, payload)
+            elif kind == 0x80:
+               offset = 2
+               granted = bytearray()
+               while offset < len(body):
+                  pattern, offset = _string(body, offset)
+                  offset += 1
+                  self.patterns.add(pattern)
+                  granted.append(0)
+               self.send(_packet(0x90, body[:2] + bytes(granted)))
+               for topic, payload in sorted(server.retained.items()):
+                  if any(_matches(pattern, topic) for pattern in self.patterns):
+                     self.send(_packet(0x31, struct.pack("!H", len(topic)) + topic + payload))
+            elif kind == 0xC0:
+               self.send(_packet(0xD0, b""))
+            elif kind == 0xE0:
+               break
+      except (EOFError, IOError, OSError):
+         pass
+      finally:
+         with server.lock:
+            server.clients.discard(self)
+      print("mqtt   {} gone after {} readings".format(self.name, self.published))
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Stand in for InfluxDB and an MQTT broker")
+   parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+   parser.add_argument("--http-port", type=int, default=8086, help="InfluxDB HTTP port")
+   parser.add_argument("--udp-port", type=int, default=8089, help="InfluxDB UDP port")
+   parser.add_argument("--mqtt-port", type=int, default=1883, help="MQTT broker port")
+   parser.add_argument("--down-at", type=float, default=0, help="Go down this many seconds after the start")
+   parser.add_argument("--down-for", type=float, default=0, help="Stay down this many seconds, 0 is never down")
+   parser.add_argument("--idle-timeout", type=float, default=0, help="Close idle HTTP connections after this many seconds")
+   args = parser.parse_args()
+
+   outage = Outage(args.down_at, args.down_for)
+   servers = [InfluxServer((args.host, args.http_port), outage, args.idle_timeout),
+              UdpServer((args.host, args.udp_port), outage),
+              Broker((args.host, args.mqtt_port), outage)]
+   for server in servers:
+      thread = threading.Thread(target=server.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+   print("InfluxDB on http://{0}:{1} and udp://{0}:{2}, MQTT on {0}:{3}, stop with Ctrl-C".format(
+         args.host, args.http_port, args.udp_port, args.mqtt_port))
+   try:
+      while True:
+         time.sleep(1)
+   except KeyboardInterrupt:
+      pass
+   for server in servers:
+      server.shutdown()
+      server.server_close()
+
+
+
+if __name__ == "__main__":
+   main()
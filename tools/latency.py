@@ -0,0 +1,223 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   End to end latency of the serial path, against simulator.py
+#
+#   Starts a simulated meter on a pty and reads it with the plugin's own classes, the way
+#   the plugin does in either read mode:
+#
+#     stream   SmartMeterReader keeps the port open and hands over every telegram
+#     cycle    SmartMeter is opened, reads one telegram and is closed again
+#
+#   Latency is the time from the last byte of a telegram on the wire to the parsed
+#   P1Packet. With faults injected the summary shows how many clean telegrams still made
+#   it through, and --busy adds threads competing for the interpreter like a loaded
+#   Indigo server.
+#
+#   python latency.py --dsmr 5 --count 60 --noise 0.1 --truncate 0.1 --bad-crc 0.1
+#
+#   With --check MS it exits 1 when fewer than --count telegrams arrived, a clean telegram
+#   was missed, a read failed or the p95 latency is above MS milliseconds.
+#
+##########################################################################################
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import simulator
+from smartmeter import SmartMeter, SmartMeterReader, SmartMeterError, P1PacketError, CRC_INVALID
+from serial.serialutil import SerialException
+
+
+
+class Host(object):
+   ##########################################################################################
+   #
+   #   The parts of the plugin that SmartMeter and SmartMeterReader call back into
+   #
+   ##########################################################################################
+   max_telegram_size = 8192
+
+   def __init__(self, debug=False):
+      self.logger = logging.getLogger("latency")
+      self.debug = debug
+      self.crcCounts = {}
+
+
+
+   def verbose(self, logtext):
+      if self.debug:
+         self.logger.debug(logtext)
+
+
+
+   def countCrc(self, result):
+      self.crcCounts[result] = self.crcCounts.get(result, 0) + 1
+
+
+
+class Run(object):
+   # Telegrams received in one harness run, matched with the sent ones afterwards
+   def __init__(self, meter):
+      self.meter = meter
+      self.packets = []
+      self.errors = 0
+      self.unknown = 0                   # Received telegrams that were not sent clean
+
+
+
+   def received(self, packet):
+      self.packets.append((packet._datagram, time.time()))
+
+
+
+   def latencies(self):
+      # The simulator notes a telegram as sent after its last write, which a fast reader
+      # can beat, so only match once it has stopped
+      latencies = []
+      unknown = 0
+      for datagram, parsed in self.packets:
+         sent = self.meter.sent.pop(datagram, None)
+         if sent is None:
+            unknown += 1
+         else:
+            latencies.append(parsed - sent)
+      return latencies, unknown
+
+
+
+def _busy(stopping):
+   # Pure Python work holding the interpreter lock
+   while not stopping.is_set():
+      sum(value * value for value in range(10000))
+
+
+
+def stream(host, run, settings, count, timeout):
+   reader = SmartMeterReader(host, run.meter.port, handler=run.received, **settings)
+   reader.retry_delay = 1
+   reader.start()
+   deadline = time.time() + timeout
+   while len(run.packets) < count and time.time() < deadline and run.meter.is_alive():
+      time.sleep(0.1)
+   reader.stop()
+   reader.join(5)
+
+
+
+def cycle(host, run, settings, count, timeout):
+   deadline = time.time() + timeout
+   while len(run.packets) < count and time.time() < deadline and run.meter.is_alive():
+      meter = None
+      try:
+         meter = SmartMeter(host, run.meter.port, **settings)
+         packet = meter.read_one_packet()
+         host.countCrc(packet.crc)
+         run.received(packet)
+      except P1PacketError:
+         host.countCrc(CRC_INVALID)
+      except (SmartMeterError, SerialException, ValueError, TypeError) as e:
+         host.logger.warning("Reading failed: {}".format(e))
+         run.errors += 1
+      finally:
+         if meter is not None:
+            meter.disconnect()
+
+
+
+def percentile(values, fraction):
+   if not values:
+      return float("nan")
+   values = sorted(values)
+   return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+
+def arguments(argv=None):
+   parser = argparse.ArgumentParser(description="Measure wire to reading latency against a simulated meter")
+   simulator.add_arguments(parser)
+   parser.add_argument("--mode", choices=("stream", "cycle"), default="stream", help="Read mode of the plugin")
+   parser.add_argument("--count", type=int, default=30, help="Telegrams to receive")
+   parser.add_argument("--busy", type=int, default=0, help="Threads keeping the interpreter busy")
+   parser.add_argument("--check", type=float, metavar="MS", help="Exit 1 on missed telegrams or a p95 latency above MS")
+   parser.add_argument("--debug", action="store_true", help="Show the SmartMeter debug output")
+   return parser.parse_args(argv)
+
+
+
+def measure(args):
+   ##########################################################################################
+   #
+   #   One run against a simulated meter, returns the Run, the stopped Simulator, the Host
+   #   with the CRC counts and the latencies in ms
+   #
+   ##########################################################################################
+   meter = simulator.simulator(args, track=True)
+   settings = dict(simulator.SERIAL[args.dsmr], baudrate=meter.baudrate)
+   host = Host(args.debug)
+   run = Run(meter)
+
+   stopping = threading.Event()
+   for number in range(args.busy):
+      threading.Thread(target=_busy, args=(stopping,), name="busy {}".format(number)).start()
+
+   meter.start()
+   try:
+      read = stream if args.mode == "stream" else cycle
+      read(host, run, settings, args.count, args.count * meter.interval * 2 + 10)
+   finally:
+      stopping.set()
+      meter.stop()
+
+   latencies, run.unknown = run.latencies()
+   return run, meter, host, [latency * 1000 for latency in latencies]
+
+
+
+def problems(run, meter, ms, count, limit):
+   # Why a run fails --check, empty when it passes. The clean telegram on the wire when the
+   # reader stopped is not counted as missed
+   found = []
+   if len(run.packets) < count:
+      found.append("only {} of {} telegrams received".format(len(run.packets), count))
+   if len(meter.sent) > 1:
+      found.append("{} clean telegrams missed".format(len(meter.sent)))
+   if run.errors:
+      found.append("{} reads failed".format(run.errors))
+   if ms and percentile(ms, 0.95) > limit:
+      found.append("p95 latency {:.1f} ms above {:.1f} ms".format(percentile(ms, 0.95), limit))
+   return found
+
+
+
+def main():
+   args = arguments()
+   logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(levelname)s %(message)s")
+
+   run, meter, host, ms = measure(args)
+   sent = meter.counts
+   print("Sent:      {}".format(", ".join("{} {}".format(sent[kind], kind) for kind in sorted(sent))))
+   print("Received:  {} clean, {} other, {} read errors, CRC {}".format(
+      len(ms), run.unknown, run.errors, ", ".join("{} {}".format(count, result) for result, count in sorted(host.crcCounts.items()))))
+   print("Missed:    {} clean telegrams, {} bytes not read".format(len(meter.sent), meter.lost))
+   print("Latency:   p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+      percentile(ms, 0.5), percentile(ms, 0.95), percentile(ms, 0.99), max(ms) if ms else float("nan")))
+
+   if args.check is not None:
+      found = problems(run, meter, ms, args.count, args.check)
+      if found:
+         print("Check failed: {}".format(", ".join(found)))
+         sys.exit(1)
+      print("Check passed")
+
+
+
+if __name__ == "__main__":
+   main()
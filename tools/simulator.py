@@ -0,0 +1,231 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   P1 meter simulator on a pseudo-terminal
+#
+#   Opens a pty and sends telegrams on it like a meter on a P1 cable: at the DSMR cadence
+#   (DSMR 5 every second, older meters every 10 seconds) and at the wire speed of the baud
+#   rate, 9600 7E1 for DSMR 2.2 and 115200 8N1 for DSMR 4 and 5. Telegrams come from
+#   telegrams.py or from a capture file. Noise, truncated telegrams and bad CRCs can be
+#   injected at random. Point the plugin, or latency.py, at the printed port.
+#
+#   python simulator.py --dsmr 2.2 --noise 0.05 --truncate 0.05 --bad-crc 0.05
+#
+##########################################################################################
+
+import os
+import sys
+import time
+import errno
+import random
+import argparse
+import threading
+import fcntl
+import termios
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import telegrams
+from smartmeter import FrameAssembler
+
+# Serial settings the plugin uses per DSMR version, see Meter.serialSettings()
+SERIAL = {
+   "2.2": dict(baudrate=9600,   bytesize=7, parity="E", stopbits=1, xonxoff=0, timeout=10),
+   "4":   dict(baudrate=115200, bytesize=8, parity="N", stopbits=1, xonxoff=0, timeout=10),
+   "5":   dict(baudrate=115200, bytesize=8, parity="N", stopbits=1, xonxoff=0, timeout=10),
+}
+
+CLEAN    = "clean"
+NOISE    = "noise"
+TRUNCATE = "truncated"
+BAD_CRC  = "bad crc"
+
+
+
+def _parity(byte):
+   # 7E1 character as an 8N1 reader sees it: the even parity bit ends up in bit 7
+   byte &= 0x7F
+   return byte | (bin(byte).count("1") & 1) << 7
+
+
+
+def captured(path):
+   # Telegrams from a capture file, over and over
+   while True:
+      assembler = FrameAssembler()
+      with open(path, "rb") as f:
+         for chunk in iter(lambda: f.read(65536), b""):
+            assembler.feed(chunk)
+            for frame in assembler.frames():
+               yield frame
+
+
+
+class Simulator(threading.Thread):
+   ##########################################################################################
+   #
+   #   Writes telegrams to the master side of a pty; port is the slave side to read from.
+   #   With track set, sent keeps the time the last byte of every clean telegram went out
+   #
+   ##########################################################################################
+   chunk_size = 16                       # Bytes per write, the UART FIFO of a P1 cable
+
+   def __init__(self, source, interval, baudrate=115200, bytesize=8, parity="N",
+                noise=0.0, truncate=0.0, bad_crc=0.0, wire_parity=False, seed=None, track=False, **kwargs):
+      threading.Thread.__init__(self, name="P1 simulator")
+      self.daemon = True
+      self.source = source
+      self.interval = interval
+      self.baudrate = baudrate
+      self.bytesize = bytesize
+      self.faults = ((NOISE, noise), (TRUNCATE, truncate), (BAD_CRC, bad_crc))
+      self.wire_parity = wire_parity and bytesize == 7
+      self.random = random.Random(seed)
+      self.track = track
+      self.lock = threading.Lock()
+      self.stopping = threading.Event()
+      self.sent = {}                     # Clean telegram -> time its last byte was sent, if tracked
+      self.counts = dict((kind, 0) for kind in (CLEAN, NOISE, TRUNCATE, BAD_CRC))
+      self.lost = 0                      # Bytes nobody read in time, as on a real line
+
+      self.master, self.slave = os.openpty()
+      self.port = os.ttyname(self.slave)
+      self.configure(parity)
+      fcntl.fcntl(self.master, fcntl.F_SETFL, fcntl.fcntl(self.master, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+
+   def configure(self, parity):
+      # Give the pty the line settings of the meter so stty and the reader see them
+      tty.setraw(self.slave)
+      attrs = termios.tcgetattr(self.slave)
+      speed = getattr(termios, "B{}".format(self.baudrate))
+      attrs[2] &= ~(termios.CSIZE | termios.PARENB | termios.PARODD)
+      attrs[2] |= termios.CS7 if self.bytesize == 7 else termios.CS8
+      if parity in ("E", "O"):
+         attrs[2] |= termios.PARENB | (termios.PARODD if parity == "O" else 0)
+      attrs[4] = attrs[5] = speed
+      termios.tcsetattr(self.slave, termios.TCSANOW, attrs)
+
+
+
+   def inject(self, telegram):
+      for kind, chance in self.faults:
+         if chance and self.random.random() < chance:
+            break
+      else:
+         return CLEAN, telegram
+
+      r = self.random
+      if kind == NOISE:
+         garbage = bytearray(r.randrange(256) for count in range(r.randint(1, 64)))
+         return kind, bytes(garbage) + telegram
+      if kind == TRUNCATE:
+         return kind, telegram[:r.randint(1, len(telegram) - 2)]
+      # Change one digit of a value, the CRC stays as it was
+      data = bytearray(telegram)
+      digits = [index for index in range(telegram.find(b"\n"), telegram.rfind(b"!")) if 48 <= data[index] <= 57]
+      index = r.choice(digits)
+      data[index] = 48 + (data[index] - 47) % 10
+      return kind, bytes(data)
+
+
+
+   def write(self, data):
+      # Send at wire speed: start bit, data bits, parity and stop bit make 10 bits a byte
+      if self.bytesize == 7:
+         data = bytearray(_parity(byte) if self.wire_parity else byte & 0x7F for byte in bytearray(data))
+      per_byte = 10.0 / self.baudrate
+      started = time.time()
+      for offset in range(0, len(data), self.chunk_size):
+         chunk = bytes(data[offset:offset + self.chunk_size])
+         delay = started + (offset + len(chunk)) * per_byte - time.time()
+         if delay > 0:
+            time.sleep(delay)
+         try:
+            os.write(self.master, chunk)
+         except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+               raise
+            self.lost += len(chunk)
+      return time.time()
+
+
+
+   def run(self):
+      deadline = time.time()
+      for telegram in self.source:
+         if self.stopping.is_set():
+            break
+         kind, data = self.inject(telegram)
+         finished = self.write(data)
+         with self.lock:
+            self.counts[kind] += 1
+            if kind == CLEAN and self.track:
+               self.sent[telegram] = finished
+         deadline += self.interval
+         self.stopping.wait(max(0, deadline - time.time()))
+      self.stopping.set()
+
+
+
+   def stop(self):
+      self.stopping.set()
+      self.join(5)
+      os.close(self.master)
+      os.close(self.slave)
+
+
+
+def add_arguments(parser):
+   parser.add_argument("--dsmr", choices=telegrams.VERSIONS, default="5", help="DSMR version, sets cadence and line settings")
+   parser.add_argument("--capture", help="Send the telegrams from this capture file instead")
+   parser.add_argument("--interval", type=float, help="Seconds between telegrams, default 1 for DSMR 5 and 10 otherwise")
+   parser.add_argument("--baudrate", type=int, help="Override the baud rate of the DSMR version")
+   parser.add_argument("--mbus", type=int, default=1, help="Number of M-Bus channels, 1 to 4")
+   parser.add_argument("--outages", type=int, default=1, help="Entries in the long outage log")
+   parser.add_argument("--noise", type=float, default=0.0, help="Chance of garbage before a telegram")
+   parser.add_argument("--truncate", type=float, default=0.0, help="Chance of a telegram cut short")
+   parser.add_argument("--bad-crc", type=float, default=0.0, help="Chance of a changed digit under an unchanged CRC")
+   parser.add_argument("--wire-parity", action="store_true", help="Send the 7E1 parity bit in bit 7, as an 8N1 reader would see it")
+   parser.add_argument("--seed", type=int, help="Seed for the telegrams and the faults")
+
+
+
+def simulator(args, track=False):
+   interval = args.interval or (1 if args.dsmr == "5" else 10)
+   if args.capture:
+      source = captured(args.capture)
+   else:
+      source = telegrams.stream(args.dsmr, interval, seed=args.seed or 0, when=int(time.time()),
+                                mbus=args.mbus, outages=args.outages)
+   settings = dict(SERIAL[args.dsmr])
+   if args.baudrate:
+      settings["baudrate"] = args.baudrate
+   return Simulator(source, interval, noise=args.noise, truncate=args.truncate, bad_crc=args.bad_crc,
+                    wire_parity=args.wire_parity, seed=args.seed, track=track, **settings)
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Simulate a P1 meter on a pseudo-terminal")
+   add_arguments(parser)
+   args = parser.parse_args()
+
+   meter = simulator(args)
+   meter.start()
+   print("Sending DSMR {} telegrams on {}, stop with Ctrl-C".format(args.dsmr, meter.port))
+   try:
+      while meter.is_alive():
+         meter.join(1)
+   except KeyboardInterrupt:
+      pass
+   meter.stop()
+   print("Sent {}, {} bytes not read".format(", ".join("{} {}".format(count, kind) for kind, count in sorted(meter.counts.items())), meter.lost))
+
+
+
+if __name__ == "__main__":
+   main()
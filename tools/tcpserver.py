@@ -0,0 +1,109 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Local stand-in for a network P1 bridge (ser2net, an Ethernet or WiFi P1 dongle)
+#
+#   Every client that connects gets its own stream of telegrams from telegrams.py or a
+#   capture file, at the DSMR cadence. To test reconnecting, connections can be closed
+#   after a number of telegrams (--drop-after) or left open without sending anything
+#   (--stall-after), which the plugin should notice through its idle timeout.
+#
+#   python tcpserver.py --port 2323 --dsmr 5 --drop-after 30
+#
+#   Then set the plugin to a network P1 bridge on 127.0.0.1, port 2323.
+#
+##########################################################################################
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+try:
+   import socketserver
+except ImportError:
+   import SocketServer as socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import telegrams
+import simulator
+
+
+
+class Bridge(socketserver.ThreadingMixIn, socketserver.TCPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, address, args):
+      socketserver.TCPServer.__init__(self, address, Stream)
+      self.args = args
+      self.interval = args.interval or (1 if args.dsmr == "5" else 10)
+      self.stopping = threading.Event()
+
+
+
+   def telegrams(self):
+      args = self.args
+      if args.capture:
+         return simulator.captured(args.capture)
+      return telegrams.stream(args.dsmr, self.interval, when=int(time.time()), mbus=args.mbus, outages=args.outages)
+
+
+
+class Stream(socketserver.BaseRequestHandler):
+
+   def handle(self):
+      server = self.server
+      args = server.args
+      client = "{}:{}".format(*self.client_address[:2])
+      print("{} connected".format(client))
+      sent = 0
+      deadline = time.time()
+      try:
+         for telegram in server.telegrams():
+            if args.stall_after and sent >= args.stall_after:
+               print("{} stalled after {} telegrams".format(client, sent))
+               server.stopping.wait()
+               break
+            self.request.sendall(telegram)
+            sent += 1
+            if args.drop_after and sent >= args.drop_after:
+               print("{} dropped after {} telegrams".format(client, sent))
+               break
+            deadline += server.interval
+            if server.stopping.wait(max(0, deadline - time.time())):
+               break
+      except (IOError, OSError) as e:
+         print("{} gone after {} telegrams: {}".format(client, sent, e))
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Serve telegrams over TCP like a network P1 bridge")
+   parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+   parser.add_argument("--port", type=int, default=2323, help="TCP port to listen on")
+   parser.add_argument("--dsmr", choices=telegrams.VERSIONS, default="5", help="DSMR version")
+   parser.add_argument("--capture", help="Send the telegrams from this capture file instead")
+   parser.add_argument("--interval", type=float, help="Seconds between telegrams, default 1 for DSMR 5 and 10 otherwise")
+   parser.add_argument("--mbus", type=int, default=1, help="Number of M-Bus channels, 1 to 4")
+   parser.add_argument("--outages", type=int, default=1, help="Entries in the long outage log")
+   parser.add_argument("--drop-after", type=int, default=0, help="Close a connection after this many telegrams")
+   parser.add_argument("--stall-after", type=int, default=0, help="Stop sending on a connection after this many telegrams")
+   args = parser.parse_args()
+
+   server = Bridge((args.host, args.port), args)
+   print("Serving DSMR {} telegrams on {}:{}, stop with Ctrl-C".format(args.dsmr, args.host, args.port))
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   server.stopping.set()
+   server.server_close()
+
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,205 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Synthetic DSMR telegrams, built from the shape of TESTGRAM in smartmeter.py
+#
+#   telegram() returns one complete telegram for DSMR 2.2, 4.x or 5.0 with 1 to 4 M-Bus
+#   channels, an outage log of any length and an optional text message. DSMR 4 and 5
+#   telegrams get a valid CRC. stream() returns an endless series of telegrams with
+#   increasing timestamps and registers, for the benchmark and the meter simulator.
+#
+#   python telegrams.py --dsmr 4 --mbus 2 --outages 10 --text "Hello" --count 3
+#
+##########################################################################################
+
+import os
+import sys
+import random
+import argparse
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "P1Meter.indigoPlugin", "Contents", "Server Plugin"))
+
+from smartmeter import crc16
+
+VERSIONS = ("2.2", "4", "5")
+
+# Identification line and P1 version per DSMR version. 2.2 has no 1-3:0.2.8 line
+HEADERS = {
+   "2.2": ("/ISk5\\2MT382-1004", None),
+   "4":   ("/KFM5KAIFA-METER", "42"),
+   "5":   ("/Ene5\\T210-D ESMR5.0", "50"),
+}
+
+# M-Bus device types: gas, heat, cold water, water
+MBUS_TYPES = (3, 4, 6, 7)
+
+
+
+class Meter(object):
+   ##########################################################################################
+   #
+   #   Register values of a simulated meter. step() moves them forward as if the meter ran
+   #   for the given number of seconds
+   #
+   ##########################################################################################
+   def __init__(self, seed=None, when=None, mbus=1):
+      self.random = random.Random(seed)
+      self.when = int(when if when is not None else time.time())
+      self.usedT1 = 7342.728
+      self.usedT2 = 3622.485
+      self.generatedT1 = 1312.715
+      self.generatedT2 = 3168.188
+      self.mbus = [2247.105 + 100 * channel for channel in range(mbus)]
+      self.shortOutages = 994
+      self.step(0)
+
+
+
+   def step(self, seconds):
+      self.when += seconds
+      r = self.random
+      self.phases = [r.uniform(0, 2.5) for phase in range(3)]
+      self.generating = [0.0] * 3
+      if r.random() < 0.3:
+         self.generating[r.randrange(3)] = r.uniform(0, 3.5)
+      used = sum(self.phases)
+      generated = sum(self.generating)
+      hours = seconds / 3600.0
+      if self.tariff == 1:
+         self.usedT1 += used * hours
+         self.generatedT1 += generated * hours
+      else:
+         self.usedT2 += used * hours
+         self.generatedT2 += generated * hours
+      self.mbus = [value + r.uniform(0, 0.001) * seconds for value in self.mbus]
+      return self
+
+
+
+   @property
+   def tariff(self):
+      hour = time.localtime(self.when).tm_hour
+      return 1 if hour < 7 or hour >= 23 else 2
+
+
+
+def _ts(when, dst=True):
+   # DSMR timestamp YYMMDDhhmmssX, X is S (summer) or W (winter)
+   local = time.localtime(when)
+   return time.strftime("%y%m%d%H%M%S", local) + ("S" if dst and local.tm_isdst > 0 else "W")
+
+
+
+def _hex(text):
+   if not isinstance(text, bytes):
+      text = text.encode("utf-8")
+   return "".join("{:02X}".format(byte) for byte in bytearray(text))
+
+
+
+def telegram(version="5", meter=None, mbus=1, outages=1, text=""):
+   ##########################################################################################
+   #
+   #   One telegram as bytes, lines ending in CRLF as sent by the meter
+   #
+   ##########################################################################################
+   if version not in HEADERS:
+      raise ValueError("Unknown DSMR version {!r}, use one of {}".format(version, ", ".join(VERSIONS)))
+   if not 1 <= mbus <= 4:
+      raise ValueError("A meter has 1 to 4 M-Bus channels, not {}".format(mbus))
+   if meter is None:
+      meter = Meter(seed=0, when=1609924729, mbus=mbus)
+
+   ident, p1version = HEADERS[version]
+   old = version == "2.2"
+   kwh = "{:09.3f}*kWh" if old else "{:010.3f}*kWh"
+   kw = "{:07.2f}*kW" if old else "{:06.3f}*kW"
+
+   lines = [ident, ""]
+   if p1version:
+      lines.append("1-3:0.2.8({})".format(p1version))
+      lines.append("0-0:1.0.0({})".format(_ts(meter.when)))
+   lines.append("0-0:96.1.1({})".format(_hex("E0048000025128418")))
+   lines.append(("1-0:1.8.1(" + kwh + ")").format(meter.usedT1))
+   lines.append(("1-0:1.8.2(" + kwh + ")").format(meter.usedT2))
+   lines.append(("1-0:2.8.1(" + kwh + ")").format(meter.generatedT1))
+   lines.append(("1-0:2.8.2(" + kwh + ")").format(meter.generatedT2))
+   lines.append("0-0:96.14.0({:04d})".format(meter.tariff))
+   lines.append(("1-0:1.7.0(" + kw + ")").format(sum(meter.phases)))
+   lines.append(("1-0:2.7.0(" + kw + ")").format(sum(meter.generating)))
+
+   if old:
+      lines.append("0-0:17.0.0(999*A)")
+      lines.append("0-0:96.3.10(1)")
+      lines.append("0-0:96.13.1()")
+      lines.append("0-0:96.13.0({})".format(_hex(text)))
+      for channel in range(1, mbus + 1):
+         lines.append("0-{}:24.1.0({})".format(channel, MBUS_TYPES[channel - 1]))
+         lines.append("0-{}:96.1.0({})".format(channel, _hex("G00585300376373{:02d}".format(channel))))
+         lines.append("0-{}:24.3.0({})(00)(60)(1)(0-{}:24.2.1)(m3)".format(channel, _ts(meter.when - meter.when % 3600, False)[:12], channel))
+         lines.append("({:09.3f})".format(meter.mbus[channel - 1]))
+         lines.append("0-{}:24.4.0(1)".format(channel))
+      lines.append("!")
+      return ("\r\n".join(lines) + "\r\n").encode("ascii")
+
+   lines.append("0-0:96.7.21({:05d})".format(meter.shortOutages))
+   lines.append("0-0:96.7.9({:05d})".format(outages))
+   log = "".join("({})({:010d}*s)".format(_ts(meter.when - 86400 * (outages - entry)), 300 + 37 * entry)
+                 for entry in range(outages))
+   lines.append("1-0:99.97.0({})(0-0:96.7.19){}".format(outages, log))
+   for code in ("32.32.0", "52.32.0", "72.32.0", "32.36.0", "52.36.0", "72.36.0"):
+      lines.append("1-0:{}(00002)".format(code))
+   if version == "4":
+      lines.append("0-0:96.13.1()")
+   lines.append("0-0:96.13.0({})".format(_hex(text)))
+   for phase, code in enumerate(("32", "52", "72")):
+      lines.append("1-0:{}.7.0({:05.1f}*V)".format(code, 229.0 + 4 * phase + meter.random.uniform(-1, 1)))
+   for phase, code in enumerate(("31", "51", "71")):
+      lines.append("1-0:{}.7.0({:03d}*A)".format(code, int(meter.phases[phase] * 1000 / 230)))
+   for phase, code in enumerate(("21", "41", "61")):
+      lines.append(("1-0:{}.7.0(" + kw + ")").format(code, meter.phases[phase]))
+   for phase, code in enumerate(("22", "42", "62")):
+      lines.append(("1-0:{}.7.0(" + kw + ")").format(code, meter.generating[phase]))
+   for channel in range(1, mbus + 1):
+      lines.append("0-{}:24.1.0({:03d})".format(channel, MBUS_TYPES[channel - 1]))
+      lines.append("0-{}:96.1.0({})".format(channel, _hex("G00585300376373{:02d}".format(channel))))
+      lines.append("0-{}:24.2.1({})({:09.3f}*m3)".format(channel, _ts(meter.when - meter.when % 300), meter.mbus[channel - 1]))
+
+   body = ("\r\n".join(lines) + "\r\n!").encode("ascii")
+   return body + "{:04X}\r\n".format(crc16(bytearray(body))).encode("ascii")
+
+
+
+def stream(version="5", interval=None, seed=0, when=1609924729, mbus=1, outages=1, text=""):
+   # Endless series of telegrams. DSMR 5 meters send every second, older ones every 10 s
+   if interval is None:
+      interval = 1 if version == "5" else 10
+   meter = Meter(seed=seed, when=when, mbus=mbus)
+   while True:
+      yield telegram(version, meter, mbus, outages, text)
+      meter.step(interval)
+
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Print synthetic DSMR telegrams")
+   parser.add_argument("--dsmr", choices=VERSIONS, default="5", help="DSMR version")
+   parser.add_argument("--mbus", type=int, default=1, help="Number of M-Bus channels, 1 to 4")
+   parser.add_argument("--outages", type=int, default=1, help="Entries in the long outage log")
+   parser.add_argument("--text", default="", help="Text message")
+   parser.add_argument("--count", type=int, default=1, help="Number of telegrams")
+   args = parser.parse_args()
+
+   out = getattr(sys.stdout, "buffer", sys.stdout)
+   telegrams = stream(args.dsmr, mbus=args.mbus, outages=args.outages, text=args.text)
+   for count in range(args.count):
+      out.write(next(telegrams))
+   out.flush()
+
+
+
+if __name__ == "__main__":
+   main()